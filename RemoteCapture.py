@@ -5,19 +5,33 @@
 # Will have a Http interface to start and stop the captures and monitor the sessions
 # We want to Connect/Monitor/Disconnect to a server. Then Start and Stop a screen capture to video file
 #
+# One process records many servers (sessions), each with its own connection and video file.
+# The video encoding runs in a pool of processes, one per core by default (-ep), shared by all the files.
+# The encoder is OpenCV, PyAV or an ffmpeg process (-ve), see videoencoders.py.
+#
 
-import sys, os
-import cv2
+import sys, os, time
+import datetime
 import numpy as np
 import rfb
+from framebuffer import Framebuffer, Damage, Cursor
+from encodingselect import EncodingSelector, name as encodingname
+from rfbreplay import StreamTap
+from metrics import Registry, Histogram, Sampled
+from videoworker import VideoWorker, PoolWriter, EncoderPool, FrameClock, POLICIES
+from videoencoders import ENCODERS, OpenCVEncoder, PyAVEncoder, FFmpegEncoder
 import threading
+import functools
 import argparse 
-import msvcrt  # Windows only!
+try:
+    import msvcrt  # Windows only! The keys of mainloop
+except ImportError:
+    msvcrt = None   # stop with Ctrl-C
 from PIL import Image
 from timeit import default_timer as timer
 from twisted.python import usage, log
 from twisted.application import internet, service
-from twisted.internet import reactor, protocol, endpoints
+from twisted.internet import reactor, protocol, endpoints, threads
 from twisted.web import server, resource
 
 # Init PIL to make sure it will not try to import plugin libraries
@@ -25,87 +39,383 @@ from twisted.web import server, resource
 Image.preinit()
 Image.init()
 
-lasterror = "No Error"
+RETRYDELAY = 10     # seconds between attempts to connect to a server that is not there
+ENCODINGS = {
+    "raw": rfb.RAW_ENCODING,
+    "hextile": rfb.HEXTILE_ENCODING,
+    "zlib": rfb.ZLIB_ENCODING,
+    "zrle": rfb.ZRLE_ENCODING,
+    "tight": rfb.TIGHT_ENCODING,
+}
+
+class CaptureMetrics(object):
+    # What goes on the /metrics page (-metrics). The counters per session and encoding are the RFBClient.encodingStats,
+    # read when the page is rendered, the histograms time every rectangle, callback and video frame of all the sessions.
+    def __init__(self, manager):
+        self.registry = Registry()
+        self.decode = self.registry.add(Histogram("rfb_decode_rectangle_seconds", "Decode time of one rectangle",
+                                                  "encoding", labelformat=encodingname))
+        self.callback = self.registry.add(Histogram("rfb_callback_seconds", "Time in the RFBClient callbacks", "callback"))
+        self.encode = self.registry.add(Histogram("video_encode_seconds", "Time to encode and write one video frame"))
+        for (n, name, help) in [(0, "rectangles", "Rectangles decoded"), (1, "pixels", "Pixels decoded"),
+                                (2, "bytes", "Bytes received"), (3, "seconds", "Seconds spent decoding")]:
+            self.registry.add(Sampled(f"rfb_decode_{name}_total", help, "counter",
+                                      lambda n=n: [((session.name, encoding), stats[n]) for session in manager.list()
+                                                   for (encoding, stats) in sorted((session.decodeStats or {}).items())],
+                                      ("session", "encoding"), labelformat=(str, encodingname)))
+        def sessions(value):
+            return lambda: [(session.name, value(session)) for session in manager.list()]
+        self.registry.add(Sampled("video_frames_written_total", "Frames handed to the video encoder", "counter",
+                                  sessions(lambda session: session.frameswritten), "session"))
+        self.registry.add(Sampled("video_frames_skipped_total", "Frames repeated, the screen had not changed or the tick was late", "counter",
+                                  sessions(lambda session: session.framesskipped), "session"))
+        for (name, help) in [("queued", "Frames queued for the video encoder"), ("dropped", "Frames dropped by the queue overflow policy, repeated instead"),
+                             ("encoded", "Frames encoded to the video file"), ("repeated", "Repeats of the last frame encoded to the video file")]:
+            self.registry.add(Sampled(f"video_frames_{name}_total", help, "counter",
+                                      sessions(lambda session, name=name: getattr(session.video, name)), "session"))
+        self.registry.add(Sampled("video_frame_buffers_allocated_total", "Frame buffers allocated, the others are reused", "counter",
+                                  sessions(lambda session: session.video.allocated), "session"))
+        self.registry.add(Sampled("video_queue_frames", "Frames waiting for the video encoder", "gauge",
+                                  sessions(lambda session: session.video.pending()), "session"))
+        self.registry.add(Sampled("rfb_sessions", "Sessions by state", "gauge",
+                                  lambda: [(state, sum(1 for session in manager.list() if session.state() == state))
+                                           for state in ("connecting", "connected", "recording")], "state"))
+
+class Session(object):
+    # One VNC server and its recording. The connection (RFBTest) comes and goes, the session stays until removed.
+    # Start and stop are flags, picked up by the connection on its next triggerupdate.
+    def __init__(self, name, host, port, password, videofolder, video, videofilename="output.mp4"):
+        self.name = name
+        self.host = host
+        self.port = port
+        self.password = password
+        self.videofolder = videofolder
+        self.videofilename = videofilename
+        self.video = video          # VideoWorker, encodes and writes the frames of this session
+        self.startrecordingflag = False
+        self.stoprecordingflag = False
+        self.recording = False
+        self.connected = False
+        self.removed = False        # no more reconnecting
+        self.lasterror = "No Error"
+        self.frameswritten = 0      # frames handed to the video encoder
+        self.framesskipped = 0      # frames repeated, the screen had not changed (or the tick was late)
+        self.selector = None        # EncodingSelector of the connection, for the status page
+        self.decodeStats = None     # encodingStats of the connection, for the /metrics page
+        self.service = None         # the internet.TCPClient connecting to the server
+        self.retry = None           # IDelayedCall of the next connection attempt after a failed one
+
+    def state(self):
+        if self.recording:
+            return "recording"
+        return "connected" if self.connected else "connecting"
+
+    def closeFile(self):
+        # Close off the recorded video file...
+        if self.recording:
+            self.recording = False
+            self.video.close()      # the frames still queued are written first
+            print(f"{self.name}: Closed the Video File")
+
+class SessionManager(object):
+    # The sessions of this process, all on the one reactor. Each has its own RFBTestFactory and VideoWorker,
+    # the VideoWorkers share the encoder pool.
+    def __init__(self, application, videofolder, password, nocursor, pool=None, maxframes=30, policy="drop-oldest", timeout=1.0, timestamps=False,
+                 encoder=None):
+        self.application = application
+        self.videofolder = videofolder
+        self.password = password
+        self.nocursor = nocursor
+        self.pool = pool            # EncoderPool, None to encode on the VideoWorker threads
+        self.maxframes = maxframes
+        self.policy = policy
+        self.timeout = timeout
+        self.timestamps = timestamps    # a name.csv with the time of each frame next to each video file
+        # Opens the video files, runs where the frames are encoded: a process of the encoder pool
+        # (or the VideoWorker thread without a pool). OpenCV's avc1 needs openh264-1.8.0-win64.dll
+        self.encoder = OpenCVEncoder("avc1") if encoder is None else encoder
+        self.sessions = {}
+
+    def list(self):
+        return [self.sessions[name] for name in sorted(self.sessions)]
+
+    def get(self, name=None):
+        # The named session, without a name the only one there is
+        if name is None:
+            return self.sessions[next(iter(self.sessions))] if len(self.sessions) == 1 else None
+        return self.sessions.get(name)
+
+    def add(self, name, host, port=5900, password=None, videofolder=None, videofilename=None):
+        if name in self.sessions:
+            raise ValueError(f"Session {name} exists already")
+        opener = self.encoder if self.pool is None else functools.partial(PoolWriter, self.pool, self.encoder)
+        video = VideoWorker(opener, maxframes=self.maxframes, policy=self.policy, timeout=self.timeout,
+                            histogram=RFBTest.metrics.encode if RFBTest.metrics else None, timestamps=self.timestamps)
+        session = Session(name, host, port, self.password if password is None else password,
+                          videofolder or self.videofolder, video, videofilename or f"{name}.mp4")
+        self.sessions[name] = session
+        # connect to this host and port, and reconnect if we get disconnected
+        session.service = internet.TCPClient(host, port, RFBTestFactory(session, nocursor=self.nocursor))
+        session.service.setServiceParent(self.application)
+        session.service.startService()
+        print(f"Session {name}: {host}:{port}")
+        return session
+
+    def remove(self, name):
+        session = self.sessions.pop(name)
+        session.removed = True
+        session.closeFile()
+        if session.retry is not None and session.retry.active():
+            session.retry.cancel()          # no reconnecting after the server was down
+        session.service.stopService()       # drops the connection
+        session.service.disownServiceParent()
+        # Stopping waits for the files to be finished, on a thread, the other sessions go on meanwhile
+        threads.deferToThread(session.video.stop).addErrback(log.err)
+
+    def stop(self):
+        # The reactor is stopping, finish the files being written
+        for session in self.list():
+            session.closeFile()
+            session.video.stop()
+        if self.pool is not None:
+            self.pool.shutdown()
 
 class RFBTest(rfb.RFBClient):
-    # Class static - we only allow one instance the way we are using it - 
-    # hacky, but pythons single threading means we want a single program instance per session recorder so as to spread the CPU load.
-    startrecordingflag = False
-    stoprecordingflag = False
-    recording = False
-    videofilename = "output.mp4"
-    videofolder = "."
+    # Class static, the options of all the sessions. What belongs to one session (and its recording) is in self.session.
+    tightcompress = None    # Tight compress level 0..9, None to not use Tight
+    tightquality = None     # Tight JPEG quality 0..9, None for lossless Tight only
+    encoding = "auto"       # preferred encoding, "auto" picks the cheapest one as we go
+    bitsperpixel = None     # ask the server for 16 or 8 bpp on slow links, None to keep its format
+    maxscreen = (1920, 1200)    # largest expected screen (width, height), reserved up front
+    tapfile = None          # record what the server sends to this capture file, for rfbreplay.py
+    metrics = None          # CaptureMetrics with -metrics, None times nothing at all
+    fps = 10.0              # frames per second of the videos, and the polling rate
+    channels = "BGR"        # the framebuffer in OpenCV's channel order, frames go to the writer as they are
+    segmentseconds = None   # start a new segment file after this long, None for one file per recording (and resize)
+    segmentbytes = None     # or once the file on disk is this big
+    segmenttemplate = None  # file names of the segments, see segmentFilename, None for name.mp4, name-1.mp4...
+
+    def connectionMade(self):
+        rfb.RFBClient.connectionMade(self)
+        self.session = self.factory.session
+        self.video = self.session.video
+        self.session.connected = True
+        if self.tapfile:
+            # One capture per connection, the time and session in front of the name keep them apart
+            (folder, name) = os.path.split(self.tapfile)
+            self.tap = StreamTap(os.path.join(folder, time.strftime("%Y%m%d-%H%M%S-") + f"{self.session.name}-" + name))
+
+    def connectionLost(self, reason):
+        self.session.connected = False
+        if self.tap is not None:
+            self.tap.close()
+            self.tap = None
 
     def vncConnectionMade(self):
-        self.screen = None
-        self.cursor = None
+        # Reserve the largest expected mode, resizes during a VM boot are then just a view change
+        self.framebuffer = Framebuffer(self.width, self.height, capacity=self.maxscreen)
+        self.damage = Damage(self.framebuffer)
+        self.cursor = Cursor()     # drawn over the frames as they are written, not into the framebuffer
         self.FirstTime = True
-        self.image_mode = "RGBX"
+        self.session.decodeStats = self.encodingStats
+        if self.metrics is not None:
+            # The timing wrappers replace the methods of just this instance, without -metrics nothing is timed
+            self.decodeHistogram = self.metrics.decode
+            self.updateRectangle = self.metrics.callback.timed(self.updateRectangle, "updateRectangle")
+            self.commitUpdate = self.metrics.callback.timed(self.commitUpdate, "commitUpdate")
+        self.setImageMode()
 
         print("Screen format: depth=%d bytes_per_pixel=%r" % (self.depth, self.bpp))
         print("Desktop name: %r" % self.name)
-        rfb.RFBClient.setEncodings(self,[rfb.RAW_ENCODING, rfb.COPY_RECTANGLE_ENCODING ])
+        # Tight (+JPEG) keeps the bandwidth down on slow links
+        tight = self.tightcompress is not None or self.tightquality is not None
+        if self.encoding == "auto":
+            # Measure what the encodings cost on this link and this CPU and switch to the cheapest,
+            # ZRLE usually wins on a slow link, RAW on loopback
+            candidates = [rfb.ZRLE_ENCODING, rfb.RAW_ENCODING, rfb.HEXTILE_ENCODING]
+            if tight:
+                candidates.insert(0, rfb.TIGHT_ENCODING)
+        else:
+            candidates = [ENCODINGS[self.encoding]]
+        self.selector = EncodingSelector(candidates)
+        self.session.selector = self.selector
+        self.updatestart = None
+        self.ticks = 0
+        self.sendEncodings(self.selector.current)
         rfb.RFBClient.framebufferUpdateRequest(self)
 
-    def OpenFile(self, filename):        
-        print(f"Opening the Video File for writing {filename}")
-        SCREEN_SIZE = (1920, 1080) # Do this dynamically later
-        fourcc = cv2.VideoWriter_fourcc(*"avc1")    # XVID, H264 - needs openh264-1.8.0-win64.dll , HVEC
-        fps = 10.0
-        # create the video write object
-        self.out = cv2.VideoWriter(filename, fourcc, fps, (SCREEN_SIZE))
-        RFBTest.recording = True
+    def sendEncodings(self, preferred):
+        # The server uses the first encoding in the list it knows, RAW always works
+        encodings = [preferred, rfb.COPY_RECTANGLE_ENCODING]
+        if preferred != rfb.RAW_ENCODING:
+            encodings.append(rfb.RAW_ENCODING)
+        # Servers that know these push updates as they happen (see endOfContinuousUpdates),
+        # the others just ignore them and we keep polling
+        encodings += [rfb.PSEUDO_CONTINUOUS_UPDATES_ENCODING, rfb.PSEUDO_FENCE_ENCODING]
+        # Tell us about screen size changes (updateDesktopSize) instead of just sending bigger rectangles
+        encodings += [rfb.PSEUDO_EXTENDED_DESKTOP_SIZE_ENCODING, rfb.PSEUDO_DESKTOP_SIZE_ENCODING]
+        # Get the cursor shape and position (updateCursor, updatePointerPos) and keep it out of the screen.
+        # Servers that don't know PointerPos keep the position to themselves, use -nc for those.
+        if not self.factory.nocursor:
+            encodings += [rfb.PSEUDO_CURSOR_ENCODING, rfb.PSEUDO_POINTER_POS_ENCODING]
+        if self.tightcompress is not None:
+            encodings.append(rfb.PSEUDO_COMPRESS_LEVEL_ENCODING + self.tightcompress)
+        if self.tightquality is not None:
+            encodings.append(rfb.PSEUDO_QUALITY_LEVEL_ENCODING + self.tightquality)
+        print(f"Preferred encoding {encodingname(preferred)}")
+        rfb.RFBClient.setEncodings(self, encodings)
+
+    def adaptEncoding(self):
+        # Called once a second, feeds the decoder measurements to the selector and
+        # re-issues SetEncodings when another encoding is cheaper (or needs measuring).
+        now = timer()
+        self.selector.sample(now, self.encodingStats)
+        encoding = self.selector.choose(now)
+        if encoding is not None:
+            self.sendEncodings(encoding)
+            if self.selector.probing is not None:
+                # A full screen gives the probe something to measure, even if nothing changes
+                rfb.RFBClient.framebufferUpdateRequest(self, incremental=0)
+
+    def OpenFile(self, filename, start=None):
+        # start is the frame of the timeline the file starts with, the next one by default
+        print(f"{self.session.name}: Opening the Video File for writing {filename}")
+        # A video file has one frame size, the screen size when it is opened (see rollSegment).
+        # H.264 (4:2:0) needs even sizes, an odd width or height gets a black line added by writeFrame.
+        SCREEN_SIZE = (self.framebuffer.width + self.framebuffer.width % 2, self.framebuffer.height + self.framebuffer.height % 2)
+        self.videosize = SCREEN_SIZE
+        self.filename = filename
+        self.segmentstart = self.clock.frames if start is None else start
+        # A file starts with a whole frame, a repeat would have nothing to repeat
+        self.damage.reset()
+        # the video write object is created on the encoder thread, after the frames of any previous file.
+        # The segments of a recording are listed in name.segments.csv once they are finished.
+        (name, ext) = os.path.splitext(os.path.join(self.session.videofolder, self.session.videofilename))
+        self.video.open(filename, SCREEN_SIZE, self.fps, f"{name}.segments.csv")
+        self.session.recording = True
         return
 
+    def segmentFilename(self):
+        # The file of segment self.segment of the recording. A template (-sf) has the fields
+        # {name} and {ext} of the recording's file name, {n} the segment number, {session} and {start},
+        # the datetime of the segment start, e.g. {name}-{start:%Y%m%d-%H%M%S}{ext}
+        (name, ext) = os.path.splitext(self.session.videofilename)
+        if self.segmenttemplate is not None:
+            filename = self.segmenttemplate.format(name=name, ext=ext, n=self.segment, session=self.session.name,
+                                                   start=datetime.datetime.now())
+        elif self.segment == 0:
+            filename = self.session.videofilename
+        else:
+            filename = f"{name}-{self.segment}{ext}"
+        return os.path.join(self.session.videofolder, filename)
+
+    def rollSegment(self, start=None):
+        # Close this file and continue the recording in the next segment file. The screen size changed
+        # (frames of the wrong size would be dropped or mangled by the writer), or the segment is full.
+        # Closing is queued, the encoder finishes the file in the background.
+        self.CloseFile()
+        self.segment += 1
+        self.OpenFile(self.segmentFilename(), start)
+
+    def segmentFull(self, frame):
+        # Frame would go past -sm minutes of the segment, or the file on disk is past -smb megabytes.
+        # A segment has at least one frame.
+        if frame == self.segmentstart:
+            return False
+        if self.segmentseconds is not None and frame - self.segmentstart >= self.segmentseconds * self.fps:
+            return True
+        if self.segmentbytes is not None:
+            try:
+                return os.path.getsize(self.filename) >= self.segmentbytes
+            except OSError:
+                return False    # not created yet by the encoder
+        return False
+
+    def resizeScreen(self, width, height):
+        # Only a view change within the reserved capacity of the framebuffer
+        print(f"Screen size {self.framebuffer.width}x{self.framebuffer.height} -> {width}x{height}")
+        if self.session.recording:
+            # The changes since the last frame go in a last frame of the old size, taking the next slot
+            # of the timeline a little early. The rectangles of this update are not in the damage yet,
+            # so the whole screen is compared.
+            self.damage.add([(0, 0, self.framebuffer.width, self.framebuffer.height)])
+            self.emitFrames(least=1)
+        self.framebuffer.resize(width, height)
+        if self.continuousUpdates:
+            # The region of the continuous updates is the screen of when they were enabled,
+            # the server would push the old area only (like TigerVNC's viewer, enable it again)
+            self.enableContinuousUpdates(1, 0, 0, width, height)
+        if self.session.recording:
+            self.rollSegment()
+
+    def updateDesktopSize(self, width, height):
+        # DesktopSize / ExtendedDesktopSize from the server
+        if (width, height) != (self.framebuffer.width, self.framebuffer.height):
+            self.resizeScreen(width, height)
+
     def CloseFile(self):
-        # Close off the recorded video file...
-        RFBTest.recording = False
-        self.out.release()
-        print("Closed the Video File")
+        self.session.closeFile()
         return
 
     def setImageMode(self):
-        # Extracts color ordering and 24 vs. 32 bpp info out of the pixel format information
-        if self._version_server == 3.889:
+        # The pixel format layer in rfb converts any 8, 16 or 32 bpp format to RGB (rfb.PixelFormat),
+        # so the server format is kept unless fewer bits are wanted on a slow link.
+        if self.bitsperpixel == 16 or self._version_server == 3.889:
             self.setPixelFormat(
                     bpp = 16, depth = 16, bigendian = 0, truecolor = 1,
                     redmax = 31, greenmax = 63, bluemax = 31,
                     redshift = 11, greenshift = 5, blueshift = 0
                     )
-            self.image_mode = "BGR;16"
-        elif (self.truecolor and (not self.bigendian) and self.depth == 24
-                and self.redmax == 255 and self.greenmax == 255 and self.bluemax == 255):
-
-            pixel = ["X"] * self.bypp
-            offsets = [offset // 8 for offset in (self.redshift, self.greenshift, self.blueshift)]
-            for offset, color in zip(offsets, "RGB"):
-                pixel[offset] = color
-            self.image_mode = "".join(pixel)
-        else:
-            self.setPixelFormat()
+        elif self.bitsperpixel == 8:
+            self.setPixelFormat(
+                    bpp = 8, depth = 8, bigendian = 0, truecolor = 1,
+                    redmax = 7, greenmax = 7, bluemax = 3,
+                    redshift = 0, greenshift = 3, blueshift = 6
+                    )
 
     def updateCursor(self, x, y, width, height, image, mask):
-        if self.factory.nocursor:
-            return
-
+        # New cursor shape, (x, y) is the hotspot. Only kept here, it is drawn when a frame is written.
         if not width or not height:
-            self.cursor = None
-
-        self.cursor = Image.frombytes('RGBX', (width, height), image)
-        self.cmask = Image.frombytes('1', (width, height), mask)
-        self.cfocus = x, y
-        self.drawCursor()
-
-    def drawCursor(self):
-        if not self.cursor:
+            self.cursor.shape(x, y, None, None)
             return
-
-        if not self.screen:
-            return
-
-        x = self.x - self.cfocus[0]
-        y = self.y - self.cfocus[1]
-        self.screen.paste(self.cursor, (x, y), self.cmask)
+        pixels = self.toPixels(image, width, height)
+        mask = np.unpackbits(np.frombuffer(mask, np.uint8).reshape(height, -1), axis=1)[:, :width].astype(bool)
+        self.cursor.shape(x, y, pixels, mask)
+
+    def updatePointerPos(self, x, y):
+        self.cursor.move(x, y)
+
+    def emitFrames(self, least=0):
+        # The frames due on the timeline since the last call, at least least. Slots that were missed
+        # (a late tick, a busy reactor) repeat the frame before, the last one gets the screen as it is now.
+        due = self.clock.due(least=least)
+        for frame in range(self.clock.frames - due, self.clock.frames):
+            if self.segmentFull(frame):
+                self.rollSegment(frame)
+            # Idle screens are most of the time, only encode a new frame if something changed.
+            # frame() compares just the dirty rectangles with the last frame, a moving pointer counts too.
+            # The first frame of a segment file is always written.
+            if frame in (self.clock.frames - 1, self.segmentstart) and (self.damage.frame() or self.cursor.changed):
+                self.writeFrame(self.clock.slot(frame))
+            else:
+                self.video.repeat(self.clock.slot(frame))
+                self.session.framesskipped += 1
+
+    def writeFrame(self, slot):
+        # The encoder thread gets its own copy of the frame, the framebuffer keeps changing while it encodes.
+        # The copy goes in a buffer the VideoWorker is done with, no new array per frame. The cursor is
+        # drawn into the copy, the framebuffer stays clean.
+        (width, height) = self.videosize
+        frame = self.video.buffer((height, width, 3))
+        # Odd sizes are padded to even with black. A reused buffer may have had a screen in the padding
+        # (an even size before a resize), so it is cleared each frame, it is one row and column at most.
+        screen = frame[:self.framebuffer.height, :self.framebuffer.width]
+        np.copyto(screen, self.framebuffer.array)
+        frame[self.framebuffer.height:, :] = 0
+        frame[:, self.framebuffer.width:] = 0
+        self.cursor.paint(screen)
+        self.video.write(frame, slot)   # queued, the overflow policy may drop it (or another one)
+        self.session.frameswritten += 1
 
     def updateRectangle(self, x, y, width, height, data):
         # print(f"Update Rectangle ({x},{y}), {width}, {height} ")
@@ -113,86 +423,125 @@ class RFBTest(rfb.RFBClient):
         if not data:
             return
 
-        size = (width, height)
-        update = Image.frombytes('RGB', size, data, 'raw', self.image_mode)
-        if not self.screen:
-            self.screen = update
+        self.growScreen(x, y, width, height)
+        self.framebuffer.update(x, y, self.toPixels(data, width, height))
+
+    def growScreen(self, x, y, width, height):
         # track upward screen resizes, often occurs during os boot of VMs
         # When the screen is sent in chunks (as observed on VMWare ESXi), the canvas
         # needs to be resized to fit all existing contents and the update.
-        elif self.screen.size[0] < (x+width) or self.screen.size[1] < (y+height):
-            new_size = (max(x+width, self.screen.size[0]), max(y+height, self.screen.size[1]))
-            new_screen = Image.new("RGB", new_size, "black")
-            new_screen.paste(self.screen, (0, 0))
-            new_screen.paste(update, (x, y))
-            self.screen = new_screen
-        else:
-            self.screen.paste(update, (x, y))
-
-        self.drawCursor()       
+        # Servers that announce the new size with DesktopSize don't get here.
+        # Updates, fills (solid tiles of Hextile, ZRLE, RRE and Tight) and copies all grow it.
+        if self.framebuffer.width < (x+width) or self.framebuffer.height < (y+height):
+            self.resizeScreen(max(x+width, self.framebuffer.width), max(y+height, self.framebuffer.height))
+
+    def fillRectangle(self, x, y, width, height, color):
+        self.growScreen(x, y, width, height)
+        self.framebuffer.fill(x, y, width, height, self.toPixels(color, 1, 1)[0, 0])
+
+    def copyRectangle(self, srcx, srcy, x, y, width, height):
+        # A source beyond the screen is grown into too, it is black like the rest of a new area
+        self.growScreen(min(x, srcx), min(y, srcy), max(x, srcx) - min(x, srcx) + width, max(y, srcy) - min(y, srcy) + height)
+        self.framebuffer.copy(srcx, srcy, x, y, width, height)
             
+    def endOfContinuousUpdates(self):
+        # The server supports continuous updates. Turn them on, from now on damage is pushed
+        # as it happens instead of waiting for the next request from triggerupdate. Some servers
+        # announce them again on every SetEncodings (adaptEncoding), they are on already then.
+        if not self.continuousUpdates:
+            print("Server supports Continuous Updates, no more polling")
+            self.enableContinuousUpdates()
+
     def beginUpdate(self):
         # called before a series of updateRectangle(), copyRectangle() or fillRectangle().
         # Probably prevent trying to get a copy of the image to add to the video file at this point.
         # Unlock on the commitupdate. Otherwise likely to get wonky images.
         # print(f"Begin Update")
+        # Remember where the update started, to tell link time from decode time
+        self.updatestart = (timer(), self.decodeTotals())
         return
 
+    def decodeTotals(self):
+        # (bytes, decode seconds) over all encodings so far
+        return (sum(s[2] for s in self.encodingStats.values()), sum(s[3] for s in self.encodingStats.values()))
+
     def commitUpdate(self, rectangles=None):
         # called after a series of updateRectangle(), copyRectangle() or fillRectangle() are finished.
         # typicaly, here is the place to request the next screen update with FramebufferUpdateRequest(incremental=1).
         # argument is a list of tuples (x,y,w,h) with the updated rectangles.
     
-        # Every 100msec we should dump the screen image into a queue, so we dont hold this up, 
-        # and the main loop can write the queue to the video file.
-        # Would make opening and closing the video file simpler and cleaner. Try and avoid a memory copy...
-        # Need a timer to see if we have waited 100msec, or we got here sooner. Maybe the request rate - trigger update should be 2 x the fps.
+        # The frames are taken by triggerupdate on the timeline of the FrameClock, not here. Updates come when
+        # the screen changes, the frames at a fixed rate, whether the server sends anything or not.
 
-        
+        if self.updatestart is not None:
+            (start, (size, decode)) = self.updatestart
+            (endsize, enddecode) = self.decodeTotals()
+            self.selector.update(timer(), endsize - size, timer() - start, enddecode - decode)
+            self.updatestart = None
+
+        # Collect the dirty rectangles until the next frame is due
+        self.damage.add(rectangles or [])
 
         if (self.FirstTime):            
-            self.start = timer()
             self.FirstTime = False     
-            reactor.callLater(0.1, self.triggerupdate)    # 100msec, 10 per sec (calls itself from that pont on..)       
-        else:
-            # Only write out the buffer every 100msec
-            end = timer()
-            if (end - self.start >= 0.1):
-                self.start += 0.1
-                # We may not always be capturing the session
-                if (self.recording == True):
-                    frame = np.array(self.screen)   # Convert PIL image to OpenCV image
-                    self.out.write(frame)    # Write the frame to the video file
+            self.nexttick = timer() + 1.0 / self.fps
+            reactor.callLater(1.0 / self.fps, self.triggerupdate)    # 100msec at 10 fps (calls itself from that pont on..)
         return
 
-    # Self calling function to run every 100msec.
+    # Self calling function to run every frame, 100msec at 10 fps.
     def triggerupdate(self):
-        if (RFBTest.startrecordingflag == True):   # Thread protection???
-            RFBTest.startrecordingflag = False
-            self.OpenFile(os.path.join(RFBTest.videofolder, RFBTest.videofilename))
-
-        if (RFBTest.stoprecordingflag == True):   # Thread protection???
-            RFBTest.stoprecordingflag = False
+        session = self.session
+        if not self.transport.connected:
+            return      # this connection is gone, the next one has its own triggerupdate
+
+        if (session.startrecordingflag == True):   # Set on the reactor thread too (Web, mainloop)
+            session.startrecordingflag = False
+            session.closeFile()     # a start while recording starts a new file
+            self.segment = 0
+            self.clock = FrameClock(self.fps)     # frame 0 is now, the segments after it carry on with the clock
+            self.OpenFile(self.segmentFilename())
+
+        if (session.stoprecordingflag == True):
+            session.stoprecordingflag = False
             self.CloseFile()
 
-        rfb.RFBClient.framebufferUpdateRequest(self,incremental=1)
-        reactor.callLater(0.1, self.triggerupdate)
+        # We may not always be capturing the session
+        if session.recording:
+            self.emitFrames()
+        else:
+            self.damage.reset()
+
+        # Poll, unless the server pushes the updates on its own
+        if not self.continuousUpdates:
+            rfb.RFBClient.framebufferUpdateRequest(self,incremental=1)
+
+        # Once a second, see if another encoding is cheaper
+        self.ticks += 1
+        if (self.encoding == "auto") and (self.ticks % max(1, round(self.fps)) == 0):
+            self.adaptEncoding()
+
+        # The next tick on time, a late one doesn't push the ones after it back (the FrameClock catches up)
+        self.nexttick = max(self.nexttick + 1.0 / self.fps, timer())
+        reactor.callLater(self.nexttick - timer(), self.triggerupdate)
         return
 
 class RFBTestFactory(rfb.RFBFactory):
 
-    def __init__(self, password = None, shared = 0):
+    def __init__(self, session, shared = 0, nocursor = False):
         #self.deferred = Deferred()
         self.protocol = RFBTest
-        self.password = password
+        self.session = session
+        self.password = session.password
         self.shared = shared
+        self.nocursor = nocursor    # True leaves the cursor in the screen, drawn by the server
 
     def clientConnectionLost(self, connector, reason):
-        lasterror = f"Connection lost: {reason}"
-        print(lasterror)
+        self.session.lasterror = f"Connection lost: {reason}"
+        print(f"{self.session.name}: {self.session.lasterror}")
         try:
-            self.protocol.CloseFile(self.protocol)
-            connector.connect()         # Try re-establishing the connection - depending on reason???
+            self.session.closeFile()
+            if not self.session.removed:
+                connector.connect()         # Try re-establishing the connection - depending on reason???
 
         except Exception as e:
             # woa, this means that something bad happened,
@@ -206,90 +555,230 @@ class RFBTestFactory(rfb.RFBFactory):
             pass             
 
     def clientConnectionFailed(self, connector, reason):
-        lasterror = f"Connection failed: {reason}"
-        print(lasterror)
-        self.protocol.CloseFile(self.protocol)
-        reactor.stop()
-        
-def mainloop( dum=None):
+        # The other sessions carry on, try this server again later
+        self.session.lasterror = f"Connection failed: {reason}"
+        print(f"{self.session.name}: {self.session.lasterror}")
+        self.session.closeFile()
+        if not self.session.removed:
+            self.session.retry = reactor.callLater(RETRYDELAY, self.retry, connector)
+
+    def retry(self, connector):
+        # remove() cancels the retry, a session removed meanwhile stays down anyway
+        self.session.retry = None
+        if not self.session.removed:
+            connector.connect()
+
+def mainloop(manager):
     # gui 'mainloop', it is called repeated by twisteds mainloop by using callLater
     print(".",end='')
     no_work = False
 
-    if msvcrt.kbhit():
+    if msvcrt is not None and msvcrt.kbhit():
         key = msvcrt.getch()
         print(key) 
         if (key == b'q'):
             print('Exiting')
             no_work = True
         elif (key == b'S'):
-            print('Start Recording')
-            RFBTest.startrecordingflag = True
+            print('Start Recording, all sessions')
+            for session in manager.list():
+                session.startrecordingflag = True
         elif (key == b's'):
-            print('Stop Recording')
-            RFBTest.stoprecordingflag = True
+            print('Stop Recording, all sessions')
+            for session in manager.list():
+                session.stoprecordingflag = True
         else:
             print("Only valid keys are 'q', 'S'tart recording, 's'top recording")
     
     if (not no_work):
-        reactor.callLater(2, mainloop)
+        reactor.callLater(2, mainloop, manager)
     else:
         reactor.callLater(0.01, reactor.stop)
 
-# Start of Main
-log.startLogging(sys.stdout)
+class Web(resource.Resource):
+    # /                                                 status of all the sessions
+    # /startrecord?filename=name.mp4&session=name       session can be left out when there is just one
+    # /stoprecord?session=name
+    # /addsession?session=name&host=host&port=5900&password=secret&folder=folder
+    # /removesession?session=name
+    # /metrics                                          Prometheus, with -metrics
+    isLeaf = True
 
-parser = argparse.ArgumentParser() 
-parser.add_argument("-hp", dest='httpport', default=5001, type=int, help = "HTTP Listen Port")
-parser.add_argument("-vt", dest='vncserver', default='localhost', help = "VNC Target IP Address")
-parser.add_argument("-vf", dest='videofolder', default='v:\WS10', help = "Target Video Folder")
-parser.add_argument("-pwd", dest='password', default='Energy123', help = "VNC Password")
-args = parser.parse_args() 
+    def __init__(self, manager, encoding):
+        resource.Resource.__init__(self)
+        self.manager = manager
+        self.encoding = encoding
 
-RFBTest.videofolder = args.videofolder
+    def render_GET(self, request):
 
-application = service.Application("rfb test") # create Application
+        def arg(name, default=None):
+            value = request.args.get(name.encode('utf-8'))
+            return default if value is None else value[0].decode('utf-8')
 
-# connect to this host and port, and reconnect if we get disconnected
-vncClient = internet.TCPClient(args.vncserver, 5900, RFBTestFactory(password=args.password)) # create the service
-vncClient.setServiceParent(application)
-vncClient.startService()
-
-class Web(resource.Resource):
-    isLeaf = True
-    def render_GET(self, request):
+        if request.path in (b'/startrecord', b'/stoprecord', b'/removesession'):
+            session = self.manager.get(arg('session'))
+            if session is None:
+                return f"<html>No session {arg('session', '')}, one of {', '.join(self.manager.sessions)}</html>".encode('utf-8')
 
         if (request.path == b'/startrecord'):
-            filename = request.args.get(b'filename')
+            filename = arg('filename')
             if (filename is not None):
-                RFBTest.videofilename = filename[0].decode('utf-8')
-                RFBTest.startrecordingflag = True
-                return f"<html>Start Recording to {RFBTest.videofilename}</html>".encode('utf-8')
+                session.videofilename = filename
+                session.startrecordingflag = True
+                return f"<html>{session.name}: Start Recording to {session.videofilename}</html>".encode('utf-8')
             else:
                 return f"<html>Start Recording Failed, missing filename parameter</html>".encode('utf-8')
 
         if (request.path == b'/stoprecord'):
-            RFBTest.stoprecordingflag = True
-            RFBTest.videofilename = None
-            return "<html>Stopped Recording</html>".encode('utf-8')
+            session.stoprecordingflag = True
+            return f"<html>{session.name}: Stopped Recording</html>".encode('utf-8')
+
+        if (request.path == b'/addsession'):
+            (name, host) = (arg('session'), arg('host'))
+            if name is None or host is None:
+                return "<html>Add Session Failed, missing session or host parameter</html>".encode('utf-8')
+            try:
+                self.manager.add(name, host, int(arg('port', '5900')), arg('password'), arg('folder'))
+            except ValueError as e:
+                return f"<html>Add Session Failed, {e}</html>".encode('utf-8')
+            return f"<html>Added Session {name}</html>".encode('utf-8')
+
+        if (request.path == b'/removesession'):
+            self.manager.remove(session.name)
+            return f"<html>Removed Session {session.name}</html>".encode('utf-8')
+
+        if (request.path == b'/metrics'):
+            # Prometheus text format
+            if RFBTest.metrics is None:
+                request.setResponseCode(404)
+                return "Metrics are off, start with -metrics\n".encode('utf-8')
+            request.setHeader(b'content-type', b'text/plain; version=0.0.4')
+            return RFBTest.metrics.registry.render().encode('utf-8')
 
         if (request.path == b'/'):
-            return f"<html>Remote Capture (VNC) Server for VNC Client {args.vncserver}, <br>Last Error: {lasterror}<br>Currently Recording: {RFBTest.recording}</html>".encode('utf-8')
-
-        return f"<html>Remote Capture (VNC) Server for VNC Client {args.vncserver}, Illegal Path {request.path}</html>".encode('utf-8')
-
-resource = Web()
-resource.putChild(b'startrecord', Web())
-resource.putChild(b'stoprecord', Web())
-site = server.Site(resource)
-endpoint = endpoints.TCP4ServerEndpoint(reactor, args.httpport)
-endpoint.listen(site)
-
-reactor.callLater(0.2, mainloop)    # 200msec later..
-#reactor.callLater(60, reactor.stop) # Only run for a minute - how we exit...
-
-reactor.run()  
-
-print("Main Program Exit\n")    
-
-
+            html = f"<html>Remote Capture (VNC) Server, {len(self.manager.sessions)} sessions"
+            if self.manager.pool is not None:
+                html += f", encoder processes with {', '.join(str(files) for files in self.manager.pool.files)} files open"
+            for session in self.manager.list():
+                html += f"<h3>{session.name}</h3>VNC Client {session.host}:{session.port}, {session.state()}<br>Last Error: {session.lasterror}"
+                html += f"<br>Currently Recording: {session.recording}<br>Frames Written: {session.frameswritten}, Repeated (unchanged): {session.framesskipped}"
+                html += f"{self.videoStatus(session)}{self.encodingStatus(session)}"
+            return (html + "</html>").encode('utf-8')
+
+        return f"<html>Remote Capture (VNC) Server, Illegal Path {request.path}</html>".encode('utf-8')
+
+    def videoStatus(self, session):
+        video = session.video
+        html = f"<br>Video Encoder: queued {video.queued}, dropped {video.dropped}, encoded {video.encoded}, repeated {video.repeated}, waiting {video.pending()}/{video.maxframes} ({video.policy}), {video.allocated} frame buffers, {video.finalizing} files closing"
+        if video.lasterror is not None:
+            html += f", {video.errors} errors, last {video.lasterror}"
+        return html
+
+    def encodingStatus(self, session):
+        # Measurements of the last seconds per encoding and the latest decisions
+        selector = session.selector
+        if selector is None:
+            return ""
+        def fmt(value, format):
+            return "-" if value is None else format % value
+        bandwidth = selector.bandwidth()
+        html = f"<br>Encoding: {self.encoding}, link {fmt(bandwidth and bandwidth / 1e6, '%.1f')} MB/s"
+        html += "<table border=1><tr><th>Encoding</th><th>In Use</th><th>Rectangles</th><th>Pixels</th><th>Bytes</th><th>Decode s</th>"
+        html += "<th>Bytes/Pixel</th><th>Decode ns/Pixel</th><th>Cost ms/Mpixel</th></tr>"
+        for (name, inuse, rectangles, pixels, size, seconds, bpp, nspp, cost) in selector.status():
+            html += f"<tr><td>{name}</td><td>{'*' if inuse else ''}</td><td>{rectangles}</td><td>{pixels}</td><td>{size}</td><td>{seconds:.3f}</td>"
+            html += f"<td>{fmt(bpp, '%.3f')}</td><td>{fmt(nspp, '%.1f')}</td><td>{fmt(cost and cost * 1e3, '%.1f')}</td></tr>"
+        html += "</table>"
+        for (when, decision) in selector.decisions:
+            html += f"{time.strftime('%H:%M:%S', time.localtime(time.time() - timer() + when))} {decision}<br>"
+        return html
+
+def main():
+    log.startLogging(sys.stdout)
+
+    parser = argparse.ArgumentParser() 
+    parser.add_argument("-hp", dest='httpport', default=5001, type=int, help = "HTTP Listen Port")
+    parser.add_argument("-vt", dest='vncserver', default=None, help = "VNC Target IP Address, localhost without -vt and -s")
+    parser.add_argument("-vp", dest='vncport', default=5900, type=int, help = "VNC Target Port")
+    parser.add_argument("-s", dest='sessions', default=[], action='append', help = "More sessions NAME=HOST[:PORT], also see /addsession")
+    parser.add_argument("-vf", dest='videofolder', default='v:\WS10', help = "Target Video Folder")
+    parser.add_argument("-pwd", dest='password', default='Energy123', help = "VNC Password")
+    parser.add_argument("-tc", dest='tightcompress', default=None, type=int, choices=range(10), help = "Use Tight encoding with this compress level")
+    parser.add_argument("-tq", dest='tightquality', default=None, type=int, choices=range(10), help = "Use Tight encoding with JPEG of this quality level")
+    parser.add_argument("-enc", dest='encoding', default='auto', choices=['auto'] + list(ENCODINGS), help = "Preferred encoding, auto measures and picks the cheapest")
+    parser.add_argument("-bpp", dest='bitsperpixel', default=None, type=int, choices=[8, 16], help = "Ask the server for 16 or 8 bits per pixel, for slow links")
+    parser.add_argument("-ms", dest='maxscreen', default='1920x1200', help = "Largest expected screen size WIDTHxHEIGHT, memory for it is reserved up front")
+    parser.add_argument("-nc", dest='nocursor', action='store_true', help = "Let the server draw the cursor into the screen, for servers without PointerPos")
+    parser.add_argument("-tap", dest='tapfile', default=None, help = "Record the server stream to this capture file (.rfbcap or .rfbcap.gz), see rfbreplay.py")
+    parser.add_argument("-metrics", dest='metrics', action='store_true', help = "Time the decoders, callbacks and video encoding for the /metrics page")
+    parser.add_argument("-vq", dest='videoqueue', default=30, type=int, help = "Frames queued for the video encoder before the overflow policy applies")
+    parser.add_argument("-vqp", dest='videopolicy', default='drop-oldest', choices=POLICIES, help = "What to drop when the video encoder falls behind")
+    parser.add_argument("-vqt", dest='videotimeout', default=1.0, type=float, help = "Seconds the block policy waits for room in the queue")
+    parser.add_argument("-fps", dest='fps', default=10.0, type=float, help = "Frames per second of the videos, on the wall clock")
+    parser.add_argument("-ts", dest='timestamps', action='store_true', help = "Write the time of each frame to a .csv next to each video file")
+    parser.add_argument("-sm", dest='segmentminutes', default=None, type=float, help = "Start a new segment file every so many minutes of recording")
+    parser.add_argument("-smb", dest='segmentmegabytes', default=None, type=float, help = "Start a new segment file once the file is this many MB")
+    parser.add_argument("-sf", dest='segmenttemplate', default=None, help = "Segment file names, e.g. {name}-{n:03d}{ext} or {name}-{start:%%Y%%m%%d-%%H%%M%%S}{ext}, also {session}")
+    parser.add_argument("-ve", dest='encoder', default='opencv', choices=list(ENCODERS), help = "Video encoder, opencv (-fourcc), or pyav and ffmpeg with the x264 options below")
+    parser.add_argument("-fourcc", dest='fourcc', default='avc1', help = "OpenCV codec, avc1 (H.264, needs the openh264 DLL on Windows), mp4v, XVID...")
+    parser.add_argument("-codec", dest='codec', default='libx264', help = "pyav and ffmpeg codec")
+    parser.add_argument("-preset", dest='preset', default='veryfast', help = "x264 preset, ultrafast .. veryslow, slower is more CPU for smaller files")
+    parser.add_argument("-crf", dest='crf', default=23, type=int, help = "x264 constant quality 0..51, lower is better and bigger")
+    parser.add_argument("-gop", dest='gop', default=None, type=int, help = "Frames from one keyframe to the next, the codec default without")
+    parser.add_argument("-threads", dest='threads', default=0, type=int, help = "Encoder threads per file, 0 for one per core, fewer with many sessions")
+    parser.add_argument("-ffmpeg", dest='ffmpeg', default='ffmpeg', help = "The ffmpeg executable of -ve ffmpeg")
+    parser.add_argument("-ep", dest='encoders', default=os.cpu_count(), type=int, help = "Encoder processes, shared by the files being recorded, 0 to encode in this process")
+    args = parser.parse_args() 
+
+    RFBTest.tightcompress = args.tightcompress
+    RFBTest.tightquality = args.tightquality
+    RFBTest.encoding = args.encoding
+    RFBTest.bitsperpixel = args.bitsperpixel
+    RFBTest.tapfile = args.tapfile
+    RFBTest.fps = args.fps
+    RFBTest.segmentseconds = args.segmentminutes * 60 if args.segmentminutes else None
+    RFBTest.segmentbytes = args.segmentmegabytes * 1e6 if args.segmentmegabytes else None
+    RFBTest.segmenttemplate = args.segmenttemplate
+    RFBTest.maxscreen = tuple(int(n) for n in args.maxscreen.lower().split('x'))
+
+    application = service.Application("rfb test") # create Application
+
+    if args.encoder == 'opencv':
+        encoder = OpenCVEncoder(args.fourcc)
+    elif args.encoder == 'pyav':
+        encoder = PyAVEncoder(args.codec, args.preset, args.crf, args.gop, args.threads)
+    else:
+        encoder = FFmpegEncoder(args.codec, args.preset, args.crf, args.gop, args.threads, args.ffmpeg)
+
+    pool = EncoderPool(args.encoders) if args.encoders else None
+    manager = SessionManager(application, args.videofolder, args.password, args.nocursor, pool=pool,
+                             maxframes=args.videoqueue, policy=args.videopolicy, timeout=args.videotimeout, timestamps=args.timestamps,
+                             encoder=encoder)
+    if args.metrics:
+        RFBTest.metrics = CaptureMetrics(manager)
+    if args.vncserver is not None or not args.sessions:
+        manager.add(args.vncserver or 'localhost', args.vncserver or 'localhost', args.vncport, videofilename="output.mp4")
+    for spec in args.sessions:
+        (name, target) = spec.split('=', 1)
+        (host, _, port) = target.partition(':')
+        manager.add(name, host, int(port or 5900))
+    # Finish the files being written when the reactor stops
+    reactor.addSystemEventTrigger('before', 'shutdown', manager.stop)
+
+    root = Web(manager, args.encoding)
+    for path in (b'startrecord', b'stoprecord', b'addsession', b'removesession', b'metrics'):
+        root.putChild(path, Web(manager, args.encoding))
+    site = server.Site(root)
+    endpoint = endpoints.TCP4ServerEndpoint(reactor, args.httpport)
+    endpoint.listen(site)
+
+    reactor.callLater(0.2, mainloop, manager)    # 200msec later..
+    #reactor.callLater(60, reactor.stop) # Only run for a minute - how we exit...
+
+    reactor.run()  
+
+    print("Main Program Exit\n")    
+
+# The encoder processes import this file again (on Windows), only the first one runs
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,194 @@
+"""
+Pick the cheapest RFB encoding for the link and the CPU.
+
+The RFBClient counts rectangles, pixels, bytes and decode seconds per
+encoding (RFBClient.encodingStats). The EncodingSelector samples these
+counters, keeps the measurements of the last seconds per encoding and
+estimates the link bandwidth from the time the updates take to arrive.
+
+The cost of an encoding is the time a pixel needs on the wire plus the
+time it needs in the decoder. A compressing encoding like ZRLE wins on a
+slow link, RAW wins on loopback where decoding is the only cost. An
+encoding without fresh measurements is probed for a few seconds from
+time to time, the server only sends what is asked for first. A probe
+asks for a full screen, so an encoding that lost by a wide margin is
+probed half as often each time it loses again, and the encodings
+without compression are not probed at all once the link is slow: a Raw
+1080p screen is 8 MB.
+
+MIT License
+"""
+# flake8: noqa
+
+from collections import deque
+
+import rfb
+
+NAMES = {
+    rfb.RAW_ENCODING: "Raw",
+    rfb.COPY_RECTANGLE_ENCODING: "CopyRect",
+    rfb.RRE_ENCODING: "RRE",
+    rfb.CORRE_ENCODING: "CoRRE",
+    rfb.HEXTILE_ENCODING: "Hextile",
+    rfb.ZLIB_ENCODING: "Zlib",
+    rfb.TIGHT_ENCODING: "Tight",
+    rfb.ZLIBHEX_ENCODING: "ZlibHex",
+    rfb.ZRLE_ENCODING: "ZRLE",
+    rfb.PSEUDO_CURSOR_ENCODING: "Cursor",
+    rfb.PSEUDO_DESKTOP_SIZE_ENCODING: "DesktopSize",
+    rfb.PSEUDO_POINTER_POS_ENCODING: "PointerPos",
+    rfb.PSEUDO_EXTENDED_DESKTOP_SIZE_ENCODING: "ExtendedDesktopSize",
+}
+
+#no zlib, as many bytes as pixels or close to it on a busy screen
+UNCOMPRESSED = (rfb.RAW_ENCODING, rfb.RRE_ENCODING, rfb.CORRE_ENCODING, rfb.HEXTILE_ENCODING)
+
+
+def name(encoding):
+    return NAMES.get(encoding, str(encoding))
+
+
+class EncodingSelector(object):
+    """rolling measurements and the choice of the preferred encoding.
+       candidates are the encodings to choose from, the first one is
+       used until there are measurements."""
+
+    def __init__(self, candidates, window=10.0, probe_interval=60.0, probe_time=3.0,
+                 min_pixels=1000000, hysteresis=0.2, max_probe_interval=960.0, backoff=2.0, slow_link=12.5e6):
+        self.candidates = list(candidates)
+        self.window = window                    # seconds of measurements kept
+        self.probe_interval = probe_interval    # re-measure after this many seconds
+        self.probe_time = probe_time            # seconds a probe lasts
+        self.min_pixels = min_pixels            # pixels needed for a decision
+        self.hysteresis = hysteresis            # needed gain to switch, 0.2 is 20%
+        self.max_probe_interval = max_probe_interval    # longest re-measure interval of a loser
+        self.backoff = backoff                  # a probe costing this many times the best one lost
+        self.slow_link = slow_link              # bytes per second, below no UNCOMPRESSED probes
+        self.slowlink = False                   # the link was slow when last measured
+        self.current = self.candidates[0]
+        self.probing = None                     # time the probe started
+        self._before = None                     # encoding in use before the probe
+        self.decisions = deque(maxlen=10)       # (time, text)
+        # encoding -> deque of (time, rectangles, pixels, bytes, seconds)
+        self._samples = dict((encoding, deque()) for encoding in self.candidates)
+        self._last = {}                         # previous counters
+        self._measured = {}                     # encoding -> time of the last sample
+        self._interval = {}                     # encoding -> probe interval after losing, if backed off
+        self._updates = deque()                 # (time, bytes, transfer seconds)
+
+    def sample(self, now, stats):
+        """take the differences of the RFBClient.encodingStats counters"""
+        for encoding, counters in stats.items():
+            last = self._last.get(encoding, (0, 0, 0, 0.0))
+            diff = [c - l for c, l in zip(counters, last)]
+            self._last[encoding] = tuple(counters)
+            if encoding in self._samples and diff[0]:
+                self._samples[encoding].append((now,) + tuple(diff))
+                self._measured[encoding] = now
+        # only the encoding in use gets new samples, the others keep
+        # their last window until they are probed again
+        for encoding, samples in self._samples.items():
+            while samples and samples[0][0] < self._measured[encoding] - self.window:
+                samples.popleft()
+
+    def update(self, now, size, seconds, decode):
+        """a framebuffer update of size bytes arrived in seconds, decode of
+           these were spent in the decoders. the rest is the link."""
+        if size < 16384:
+            return  # too small to say anything about the bandwidth
+        self._updates.append((now, size, max(seconds - decode, 0.0)))
+        while self._updates and self._updates[0][0] < now - self.window:
+            self._updates.popleft()
+
+    def bandwidth(self):
+        """bytes per second of the link, None if not known"""
+        size = sum(u[1] for u in self._updates)
+        seconds = sum(u[2] for u in self._updates)
+        if not size:
+            return None
+        if seconds < 1e-3:
+            return float('inf')
+        return size / seconds
+
+    def measurement(self, encoding):
+        """(rectangles, pixels, bytes, seconds) in the window"""
+        samples = self._samples[encoding]
+        return tuple(sum(s[n] for s in samples) for n in range(1, 5))
+
+    def cost(self, encoding):
+        """seconds per megapixel on the link and in the decoder, None if
+           there are not enough measurements"""
+        (rectangles, pixels, size, seconds) = self.measurement(encoding)
+        bandwidth = self.bandwidth()
+        if pixels < self.min_pixels or bandwidth is None:
+            return None
+        return (size / bandwidth + seconds) / pixels * 1e6
+
+    def choose(self, now):
+        """the encoding to use from now on, None if it stays the same"""
+        before = None
+        bandwidth = self.bandwidth()
+        if bandwidth is not None:
+            self.slowlink = bandwidth < self.slow_link
+        if self.probing is not None:
+            if now - self.probing < self.probe_time:
+                return None
+            self.probing = None
+            before = self._before
+            self._backoff(now, self.current)
+        else:
+            # anything not measured lately gets a probe
+            for encoding in self.candidates:
+                if encoding != self.current and self._probeDue(now, encoding):
+                    self.probing = now
+                    self._before = self.current
+                    return self._switch(now, encoding, "probe")
+        costs = [(self.cost(encoding), encoding) for encoding in self.candidates]
+        costs = [c for c in costs if c[0] is not None]
+        if costs:
+            (best_cost, best) = min(costs)
+            current_cost = self.cost(self.current)
+            if best == self.current:
+                return None
+            if current_cost is None or best_cost * (1 + self.hysteresis) < current_cost:
+                return self._switch(now, best, "%.1f ms/Mpixel" % (best_cost * 1e3))
+        # no better choice after a probe, back to what was used before
+        if before is not None and before != self.current:
+            return self._switch(now, before, "probe done")
+        return None
+
+    def _probeDue(self, now, encoding):
+        if self.slowlink and encoding in UNCOMPRESSED:
+            return False
+        interval = self._interval.get(encoding, self.probe_interval)
+        return encoding not in self._measured or now - self._measured[encoding] >= interval
+
+    def _backoff(self, now, probed):
+        """probe the encoding half as often if it lost by a wide margin,
+           as often as the others if not"""
+        cost = self.cost(probed)
+        others = [self.cost(encoding) for encoding in self.candidates if encoding != probed]
+        others = [c for c in others if c is not None]
+        if cost is not None and others and cost > min(others) * self.backoff:
+            interval = min(self._interval.get(probed, self.probe_interval) * 2, self.max_probe_interval)
+            self._interval[probed] = interval
+            self.decisions.append((now, "%s lost, next probe in %d s" % (name(probed), interval)))
+        else:
+            self._interval.pop(probed, None)
+
+    def _switch(self, now, encoding, reason):
+        self.decisions.append((now, "%s -> %s (%s)" % (name(self.current), name(encoding), reason)))
+        self.current = encoding
+        return encoding
+
+    def status(self):
+        """one row per candidate: name, in use, rectangles, pixels, bytes,
+           decode seconds, bytes per pixel, decode ns per pixel, cost"""
+        rows = []
+        for encoding in self.candidates:
+            (rectangles, pixels, size, seconds) = self.measurement(encoding)
+            rows.append((name(encoding), encoding == self.current, rectangles, pixels, size, seconds,
+                         size / pixels if pixels else None,
+                         seconds / pixels * 1e9 if pixels else None,
+                         self.cost(encoding)))
+        return rows
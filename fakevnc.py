@@ -0,0 +1,467 @@
+#!/usr/bin/python
+#
+# Fake VNC servers for load and throughput tests of RemoteCapture.py
+#
+# Does the RFB 3.3, 3.7 and 3.8 handshakes with or without VNC
+# authentication and serves a scripted desktop at a fixed frame rate:
+#
+#   idle     nothing changes after the first screen
+#   video    a noise area changes every frame
+#   scroll   a text page scrolls up, CopyRect plus the new lines
+#   resize   video, and the resolution changes every few seconds
+#
+# Updates are sent in the first encoding of the client's SetEncodings
+# that is allowed with -e. Start N servers on consecutive ports and point
+# N capture sessions at them to see how many one box can sustain, every
+# server reports the updates and bytes it sent.
+#
+# python fakevnc.py -n 20 -p 5900 -W 1280 -H 720 -f 10 -s video -e zrle hextile raw
+#
+
+import sys
+import os
+import argparse
+from struct import pack, unpack
+from timeit import default_timer as timer
+import numpy as np
+from twisted.python import log
+from twisted.internet import protocol, reactor, task
+import rfb
+import rfbsynth
+
+ENCODINGS = {
+    'raw': rfb.RAW_ENCODING,
+    'hextile': rfb.HEXTILE_ENCODING,
+    'zlib': rfb.ZLIB_ENCODING,
+    'zlibhex': rfb.ZLIBHEX_ENCODING,
+    'zrle': rfb.ZRLE_ENCODING,
+    'tight': rfb.TIGHT_ENCODING,
+}
+
+VERSIONS = {
+    3.3: b"RFB 003.003\n",
+    3.7: b"RFB 003.007\n",
+    3.8: b"RFB 003.008\n",
+}
+
+
+# --- scripted desktops
+# tick() moves the desktop on by one frame and returns what changed:
+# ("update", x, y, width, height), ("copy", srcx, srcy, x, y, width, height)
+# or ("resize", width, height). screen is a HxWx3 RGB array, key() tells
+# the screen content apart. desktops go round in a loop of a few states,
+# so the encoded rectangles can be cached, see PAYLOADS.
+
+class IdleDesktop(object):
+
+    def __init__(self, width, height, seed=0):
+        self.seed = seed
+        self.state = 0
+        self._draw(width, height)
+
+    def _draw(self, width, height):
+        self.screen = np.ascontiguousarray(rfbsynth.desktop(width, height, self.seed)[:, :, :3])
+
+    def key(self):
+        return (type(self).__name__, self.screen.shape, self.seed, self.state)
+
+    def tick(self, n):
+        return []
+
+
+class VideoDesktop(IdleDesktop):
+    loop = 16       # different noise frames
+
+    def tick(self, n):
+        height, width = self.screen.shape[:2]
+        vh, vw = height // 4, width // 4
+        vx, vy = width // 2, height // 2
+        self.state = n % self.loop
+        self.screen[vy:vy + vh, vx:vx + vw] = _noise(vw, vh, self.seed + self.state)
+        return [("update", vx, vy, vw, vh)]
+
+
+_NOISE = {}
+
+def _noise(width, height, seed):
+    """video like noise, the same for all connections"""
+    key = (width, height, seed)
+    if key not in _NOISE:
+        _NOISE[key] = np.random.RandomState(seed).randint(0, 256, size=(height, width, 3)).astype(np.uint8)
+    return _NOISE[key]
+
+
+class ScrollDesktop(IdleDesktop):
+    step = 16       # lines per frame
+
+    def _draw(self, width, height):
+        #4 screens of text, then it starts over
+        self.page = rfbsynth.document(width, (height * 4) // self.step * self.step, self.seed)[:, :, :3]
+        self.screen = np.ascontiguousarray(self.page[:height])
+
+    def tick(self, n):
+        height, width = self.screen.shape[:2]
+        step = self.step
+        self.state = (self.state + step) % self.page.shape[0]
+        self.screen[:-step] = self.screen[step:]
+        self.screen[-step:] = self.page[(self.state + height - step) % self.page.shape[0]:][:step]
+        return [("copy", 0, step, 0, 0, width, height - step), ("update", 0, height - step, width, step)]
+
+
+class ResizeDesktop(VideoDesktop):
+    period = 50     # frames between the changes
+
+    def __init__(self, width, height, seed=0):
+        VideoDesktop.__init__(self, width, height, seed)
+        self.sizes = [(width, height), (800, 600), (1024, 768)]
+
+    def tick(self, n):
+        if n % self.period == 0:
+            (width, height) = self.sizes[(n // self.period) % len(self.sizes)]
+            if (width, height) != (self.screen.shape[1], self.screen.shape[0]):
+                self._draw(width, height)
+                self.state = 0
+                return [("resize", width, height)]
+        return VideoDesktop.tick(self, n)
+
+
+DESKTOPS = {
+    'idle': IdleDesktop,
+    'video': VideoDesktop,
+    'scroll': ScrollDesktop,
+    'resize': ResizeDesktop,
+}
+
+#prepared rectangles, (desktop key, pixel format, encoding, x, y, width, height)
+#-> rfbsynth.UpdateEncoder.prepare(), shared by all connections. encoding
+#is the expensive part, with this the servers cost little next to the
+#clients they are there to load
+PAYLOADS = {}
+PAYLOADS_MAX = 4096
+
+
+class FakeVNCServer(protocol.Protocol):
+    """one client connection, the server side of rfb.RFBClient"""
+
+    def connectionMade(self):
+        self._packet = rfb.ReceiveBuffer()
+        self.config = self.factory.config
+        self.desktop = DESKTOPS[self.config.script](self.config.width, self.config.height, self.factory.seed)
+        self.pixelFormat = rfb.PixelFormat(*rfbsynth.PIXEL_FORMATS[32])
+        self.format = rfbsynth.PIXEL_FORMATS[32]
+        self.bpp = 32
+        self.encodings = []
+        self._encoders = {}
+        self.requested = None       # incremental flag of the pending FramebufferUpdateRequest
+        self.continuous = False     # EnableContinuousUpdates
+        self.region = None          # (x, y, width, height) of the continuous updates
+        self.announced = False      # EndOfContinuousUpdates sent for the pseudo encoding
+        self.pending = []           # changes the client did not get yet
+        self.frame = 0
+        self.ticker = None
+        self.version = self.config.version
+        self.factory.clients += 1
+        self.transport.write(VERSIONS[self.version])
+        self.expect(self._handleVersion, 12)
+
+    def connectionLost(self, reason):
+        self.factory.clients -= 1
+        if self.ticker is not None and self.ticker.running:
+            self.ticker.stop()
+
+    def send(self, data):
+        self.factory.sent += len(data)
+        self.transport.write(data)
+
+    # --- parser, like rfb.RFBConnection
+
+    def dataReceived(self, data):
+        self._packet.append(data)
+        while len(self._packet) >= self._expected_len:
+            block = self._packet.read(self._expected_len)
+            self._expected_handler(block, *self._expected_args)
+
+    def expect(self, handler, size, *args):
+        self._expected_handler = handler
+        self._expected_len = size
+        self._expected_args = args
+
+    # --- handshake
+
+    def _handleVersion(self, block):
+        #the lower of the two versions
+        client = float(bytes(block[4:11]).replace(b'0', b''))
+        self.version = min(self.version, client) if client in VERSIONS else 3.3
+        sec_type = 2 if self.config.password else 1
+        if self.version < 3.7:
+            self.transport.write(pack("!I", sec_type))
+            self._startSecurity(sec_type)
+        else:
+            self.transport.write(pack("!BB", 1, sec_type))
+            self.expect(self._handleSecurityType, 1)
+
+    def _handleSecurityType(self, block):
+        (sec_type,) = unpack("!B", block)
+        self._startSecurity(sec_type)
+
+    def _startSecurity(self, sec_type):
+        if sec_type == 2:
+            self._challenge = os.urandom(16)
+            self.transport.write(self._challenge)
+            self.expect(self._handleAuthResponse, 16)
+        else:
+            if self.version >= 3.8:
+                self.transport.write(pack("!I", 0))
+            self.expect(self._handleClientInit, 1)
+
+    def _handleAuthResponse(self, block):
+        password = (self.config.password + '\0' * 8)[:8]
+        if bytes(block) == rfb.RFBDes(password).encrypt(self._challenge):
+            self.transport.write(pack("!I", 0))
+            self.expect(self._handleClientInit, 1)
+            return
+        self.transport.write(pack("!I", 1))
+        if self.version >= 3.8:
+            reason = b"authentication failed"
+            self.transport.write(pack("!I", len(reason)) + reason)
+        self.transport.loseConnection()
+
+    def _handleClientInit(self, block):
+        height, width = self.desktop.screen.shape[:2]
+        name = b"fakevnc %s" % self.config.script.encode()
+        self.transport.write(pack("!HH16sI", width, height, pack("!BBBBHHHBBBxxx", *rfbsynth.PIXEL_FORMATS[32]), len(name)) + name)
+        self.ticker = task.LoopingCall(self.tick)
+        self.ticker.start(1.0 / self.config.fps, now=False)
+        self.expect(self._handleMessage, 1)
+
+    # --- client messages
+
+    def _handleMessage(self, block):
+        (msgid,) = unpack("!B", block)
+        if msgid == 0:
+            self.expect(self._handleSetPixelFormat, 19)
+        elif msgid == 2:
+            self.expect(self._handleSetEncodings, 3)
+        elif msgid == 3:
+            self.expect(self._handleUpdateRequest, 9)
+        elif msgid == 4:
+            self.expect(self._handleIgnored, 7)
+        elif msgid == 5:
+            self.expect(self._handleIgnored, 5)
+        elif msgid == 6:
+            self.expect(self._handleCutText, 7)
+        elif msgid == 150:
+            self.expect(self._handleEnableContinuousUpdates, 9)
+        elif msgid == 248:
+            self.expect(self._handleFence, 8)
+        else:
+            log.msg("unknown client message (id %d)" % msgid)
+            self.transport.loseConnection()
+
+    def _handleIgnored(self, block):
+        self.expect(self._handleMessage, 1)
+
+    def _handleSetPixelFormat(self, block):
+        self.format = unpack("!BBBBHHHBBBxxx", block[3:])
+        (bpp, depth, bigendian, truecolor, redmax, greenmax, bluemax, redshift, greenshift, blueshift) = self.format
+        self.bpp = bpp
+        self.pixelFormat = rfb.PixelFormat(bpp, depth, bigendian, truecolor, redmax, greenmax, bluemax,
+                                           redshift, greenshift, blueshift)
+        self._encoders = {}
+        self.expect(self._handleMessage, 1)
+
+    def _handleSetEncodings(self, block):
+        (count,) = unpack("!xH", block)
+        self.expect(self._handleEncodings, 4 * count)
+
+    def _handleEncodings(self, block):
+        self.encodings = list(unpack("!%di" % (len(block) // 4), block))
+        if rfb.PSEUDO_CONTINUOUS_UPDATES_ENCODING in self.encodings and not self.announced:
+            #tells the client continuous updates are supported, once per
+            #connection like TigerVNC
+            self.announced = True
+            self.send(pack("!B", 150))
+        self.expect(self._handleMessage, 1)
+
+    def _handleUpdateRequest(self, block):
+        (incremental, x, y, width, height) = unpack("!BHHHH", block)
+        if not incremental:
+            height, width = self.desktop.screen.shape[:2]
+            self.pending = [("update", 0, 0, width, height)]
+        self.requested = incremental
+        self.flush()
+        self.expect(self._handleMessage, 1)
+
+    def _handleCutText(self, block):
+        (length,) = unpack("!xxxI", block)
+        if length:
+            self.expect(self._handleIgnored, length)
+        else:
+            self.expect(self._handleMessage, 1)
+
+    def _handleEnableContinuousUpdates(self, block):
+        (enable, x, y, width, height) = unpack("!BHHHH", block)
+        self.continuous = bool(enable)
+        if enable:
+            #pushed changes are only of this area, it is sent as it is now
+            self.region = (x, y, width, height)
+            self.pending.append(("update", x, y, width, height))
+            self.flush()
+        else:
+            self.send(pack("!B", 150))
+        self.expect(self._handleMessage, 1)
+
+    def _handleFence(self, block):
+        (flags, length) = unpack("!xxxIB", block)
+        if length:
+            self.expect(self._handleFencePayload, length, flags)
+        else:
+            self._handleFencePayload(b'', flags)
+
+    def _handleFencePayload(self, block, flags):
+        if flags & rfb.FENCE_REQUEST:
+            self.send(pack("!BxxxIB", 248, flags & ~rfb.FENCE_REQUEST, len(block)) + bytes(block))
+        self.expect(self._handleMessage, 1)
+
+    # --- updates
+
+    def tick(self):
+        self.frame += 1
+        changes = self.desktop.tick(self.frame)
+        if not changes:
+            return
+        height, width = self.desktop.screen.shape[:2]
+        if changes[0][0] == "resize":
+            self.pending = changes
+        elif self.pending and any(change[0] == "copy" for change in changes):
+            #a copy on top of changes the client has not seen moves the
+            #wrong pixels, send the whole screen instead
+            self.pending = [("update", 0, 0, width, height)]
+        else:
+            self.pending.extend(change for change in changes if change not in self.pending)
+        self.flush()
+
+    def flush(self):
+        """send the pending changes if the client asked for them"""
+        if not self.pending or (self.requested is None and not self.continuous):
+            return
+        #without a request the changes are pushed, only those in the region
+        clip = self.clip if self.requested is None else (lambda *rectangle: rectangle)
+        self.requested = None
+        height, width = self.desktop.screen.shape[:2]
+        rectangles = []
+        for change in self.pending:
+            if change[0] == "resize":
+                if rfb.PSEUDO_EXTENDED_DESKTOP_SIZE_ENCODING in self.encodings:
+                    rectangles.append(rfbsynth.extended_desktop_size(width, height))
+                elif rfb.PSEUDO_DESKTOP_SIZE_ENCODING in self.encodings:
+                    rectangles.append(rfbsynth.desktop_size(width, height))
+                area = clip(0, 0, width, height)
+            elif change[0] == "copy" and rfb.COPY_RECTANGLE_ENCODING in self.encodings:
+                (srcx, srcy, x, y, w, h) = change[1:]
+                if clip(srcx, srcy, w, h) == (srcx, srcy, w, h) and clip(x, y, w, h) == (x, y, w, h):
+                    rectangles.append((x, y, w, h, rfb.COPY_RECTANGLE_ENCODING, rfbsynth.encode_copyrect(srcx, srcy)))
+                    continue
+                area = clip(x, y, w, h)     #partly outside, the pixels of the part inside
+            else:
+                area = clip(*change[-4:])
+            if area is not None:
+                rectangles += self.rectangles(*area)
+        self.pending = []
+        if not rectangles:
+            return
+        self.send(rfbsynth.framebuffer_update(rectangles))
+        self.factory.updates += 1
+
+    def clip(self, x, y, width, height):
+        """the part of the rectangle in the continuous updates region, None
+           if nothing of it"""
+        (rx, ry, rwidth, rheight) = self.region
+        (left, top) = (max(x, rx), max(y, ry))
+        (right, bottom) = (min(x + width, rx + rwidth), min(y + height, ry + rheight))
+        if left >= right or top >= bottom:
+            return None
+        return (left, top, right - left, bottom - top)
+
+    def encoding(self):
+        """the first encoding of the client that is allowed"""
+        allowed = [ENCODINGS[name] for name in self.config.encodings]
+        for encoding in self.encodings:
+            if encoding in allowed:
+                return encoding
+        return rfb.RAW_ENCODING
+
+    def rectangles(self, x, y, width, height):
+        encoding = self.encoding()
+        if encoding not in self._encoders:
+            self._encoders[encoding] = rfbsynth.UpdateEncoder(encoding, format=self.format)
+        encoder = self._encoders[encoding]
+        if encoding == rfb.TIGHT_ENCODING:
+            return encoder.rectangles(self.pixels(x, y, width, height), x, y)
+        key = (self.desktop.key(), self.format, encoding, x, y, width, height)
+        prepared = PAYLOADS.get(key)
+        if prepared is None:
+            if len(PAYLOADS) >= PAYLOADS_MAX:
+                PAYLOADS.clear()
+            prepared = PAYLOADS[key] = encoder.prepare(self.pixels(x, y, width, height))
+        return [(x, y, width, height, encoding, encoder.finish(prepared))]
+
+    def pixels(self, x, y, width, height):
+        """the area in the pixel format of the client, HxWx(bpp/8)"""
+        area = self.desktop.screen[y:y + height, x:x + width]
+        return np.frombuffer(self.pixelFormat.fromPixels(area), np.uint8).reshape(height, width, -1)
+
+
+class FakeVNCFactory(protocol.ServerFactory):
+    protocol = FakeVNCServer
+
+    def __init__(self, config, seed=0):
+        self.config = config
+        self.seed = seed
+        self.clients = 0
+        self.updates = 0    # FramebufferUpdates sent
+        self.sent = 0       # bytes of the updates
+
+
+def report(servers, last):
+    now = timer()
+    seconds = now - last[0]
+    updates = sum(factory.updates for (port, factory) in servers)
+    sent = sum(factory.sent for (port, factory) in servers)
+    clients = sum(factory.clients for (port, factory) in servers)
+    rates = "%.1f updates/s, %.1f MB/s" % ((updates - last[1]) / seconds, (sent - last[2]) / seconds / 1e6)
+    if clients:
+        print("%d clients, %s, per client %.1f updates/s" % (clients, rates, (updates - last[1]) / seconds / clients))
+    elif updates != last[1]:
+        print("0 clients, %s" % rates)    # the last updates of clients that left
+    last[:] = [now, updates, sent]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake VNC servers with scripted desktops")
+    parser.add_argument("-n", dest='count', default=1, type=int, help="Number of servers")
+    parser.add_argument("-p", dest='port', default=5900, type=int, help="Port of the first server, the others follow")
+    parser.add_argument("-W", dest='width', default=1920, type=int, help="Screen width")
+    parser.add_argument("-H", dest='height', default=1080, type=int, help="Screen height")
+    parser.add_argument("-f", dest='fps', default=10.0, type=float, help="Frames per second of the desktop")
+    parser.add_argument("-s", dest='script', default='video', choices=list(DESKTOPS), help="Desktop script")
+    parser.add_argument("-e", dest='encodings', nargs='+', default=list(ENCODINGS), choices=list(ENCODINGS), help="Encodings the servers may use")
+    parser.add_argument("-v", dest='version', default=3.8, type=float, choices=sorted(VERSIONS), help="Highest RFB version")
+    parser.add_argument("-pwd", dest='password', default=None, help="VNC password, none for no authentication")
+    parser.add_argument("-r", dest='report', default=10.0, type=float, help="Seconds between the reports")
+    config = parser.parse_args()
+
+    log.startLogging(sys.stdout)
+    servers = []
+    for n in range(config.count):
+        factory = FakeVNCFactory(config)
+        reactor.listenTCP(config.port + n, factory)
+        servers.append((config.port + n, factory))
+    print("%d %s servers on ports %d-%d" % (config.count, config.script, config.port, config.port + config.count - 1))
+    task.LoopingCall(report, servers, [timer(), 0, 0]).start(config.report, now=False)
+    reactor.run()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,190 @@
+"""
+Framebuffer for the RFB client callbacks.
+
+The screen is kept in one preallocated HxWx3 uint8 numpy array, the
+RFBClient callbacks (updateRectangle, fillRectangle, copyRectangle) map
+to update(), fill() and copy(), which write into that array in place,
+so decoding a rectangle does not allocate a new image.
+
+MIT License
+"""
+# flake8: noqa
+
+import numpy as np
+
+
+class Framebuffer(object):
+    """HxWx3 uint8 screen, in the channel order of the PixelFormat that
+       decodes into it (RGB by default, RemoteCapture uses BGR for OpenCV).
+       capacity (width, height) reserves memory for the largest expected
+       screen, array is then a view of that and a resize up to the
+       capacity only changes the view, nothing is allocated or copied.
+       such a view is not contiguous, use ascontiguousarray() where that
+       is needed"""
+
+    def __init__(self, width, height, capacity=None):
+        self.width = width
+        self.height = height
+        if capacity is None:
+            capacity = (width, height)
+        self._storage = np.zeros((max(height, capacity[1]), max(width, capacity[0]), 3), dtype=np.uint8)
+        self.array = self._storage[:height, :width]
+
+    @property
+    def capacity(self):
+        return (self._storage.shape[1], self._storage.shape[0])
+
+    def resize(self, width, height):
+        """grow or shrink the screen, keeps the overlapping content and
+           clears the new area"""
+        if width > self._storage.shape[1] or height > self._storage.shape[0]:
+            #beyond the capacity, the new capacity covers both
+            storage = np.zeros((max(height, self._storage.shape[0]), max(width, self._storage.shape[1]), 3),
+                               dtype=np.uint8)
+            storage[:self.height, :self.width] = self.array
+            self._storage = storage
+        else:
+            #parts of an earlier, bigger screen may still be there
+            self._storage[self.height:height, :width] = 0
+            self._storage[:height, self.width:width] = 0
+        self.array = self._storage[:height, :width]
+        self.width = width
+        self.height = height
+
+    def update(self, x, y, pixels):
+        """copy a height x width x 3 array of pixels to (x, y)"""
+        height, width = pixels.shape[:2]
+        self.array[y:y + height, x:x + width] = pixels
+
+    def fill(self, x, y, width, height, color):
+        """fill the area with color, a sequence of 3 channel values.
+           broadcasting one pixel is slow, the first line is filled and
+           then copied to the other lines"""
+        area = self.array[y:y + height, x:x + width]
+        if area.size:
+            area[0] = color
+            area[1:] = area[0]
+
+    def copy(self, srcx, srcy, x, y, width, height):
+        """copy the area (srcx, srcy, width, height) to (x, y).
+           source and target may overlap, numpy detects that and
+           goes through a temporary copy, like memmove()."""
+        np.copyto(self.array[y:y + height, x:x + width],
+                  self.array[srcy:srcy + height, srcx:srcx + width])
+
+
+class Damage(object):
+    """dirty rectangles of a Framebuffer between two frames.
+
+    add() collects the rectangles of the updates (RFBClient.commitUpdate
+    gets them), frame() tells if the screen changed since the last frame.
+    Rectangles with the same content as in the last frame, like a
+    blinking cursor that is back or an update that repaints the same
+    pixels, do not count. For that a copy of the last frame is kept, and
+    only the dirty rectangles are compared and copied."""
+
+    def __init__(self, framebuffer):
+        self.framebuffer = framebuffer
+        self.rectangles = []    # (x, y, width, height) since the last frame
+        self.changed = True     # result of the last frame()
+        self.area = 0           # pixels of the changed rectangles of the last frame()
+        self._last = None       # copy of the screen at the last frame
+
+    def add(self, rectangles):
+        self.rectangles.extend(rectangles)
+
+    def reset(self):
+        """forget the rectangles and the last frame, the next frame()
+           is a changed full screen"""
+        self.rectangles = []
+        self._last = None
+
+    def frame(self):
+        """start the next frame. returns True if the screen differs from
+           the last frame, the changed area in pixels is in self.area"""
+        array = self.framebuffer.array
+        rectangles = self.rectangles
+        self.rectangles = []
+        if self._last is None or self._last.shape != array.shape:
+            self._last = array.copy()
+            self.changed = True
+            self.area = array.shape[0] * array.shape[1]
+            return True
+        area = 0
+        for (x, y, width, height) in rectangles:
+            now = array[y:y + height, x:x + width]
+            last = self._last[y:y + height, x:x + width]
+            if not np.array_equal(now, last):
+                area += now.shape[0] * now.shape[1]
+                last[:] = now
+        self.changed = area > 0
+        self.area = area
+        return self.changed
+
+
+class Cursor(object):
+    """pointer shape and position, kept apart from the Framebuffer.
+
+    With the cursor pseudo encoding the server leaves the cursor out of
+    the screen and sends its shape once. The shape is kept as a
+    premultiplied RGBA array and is only drawn when a frame is emitted:
+    paint() blends the cursor into the copy of the screen that becomes
+    the frame. Decoding never sees the cursor and the screen stays
+    clean."""
+
+    def __init__(self):
+        self.rgba = None        # HxWx4 uint8, RGB premultiplied by alpha
+        self.hotspot = (0, 0)   # (x, y) in the shape that points
+        self.position = None    # (x, y) on the screen, None until known
+        self.changed = False    # new shape or position since the last paint()
+        self._inverse = None    # HxWx1 uint16, 255 - alpha
+
+    def shape(self, hotx, hoty, pixels, mask):
+        """new shape. pixels is HxWx3, mask HxW bool or uint8 alpha.
+           pixels None or empty hides the cursor"""
+        if pixels is None or not pixels.size:
+            self.rgba = None
+        else:
+            alpha = mask.astype(np.uint8) * 255 if mask.dtype == bool else mask
+            rgba = np.empty(pixels.shape[:2] + (4,), dtype=np.uint8)
+            rgba[..., :3] = (pixels * alpha[..., None].astype(np.uint16) + 127) // 255
+            rgba[..., 3] = alpha
+            self.rgba = rgba
+            self._inverse = (255 - alpha).astype(np.uint16)[..., None]
+        self.hotspot = (hotx, hoty)
+        self.changed = True
+
+    def move(self, x, y):
+        if self.position != (x, y):
+            self.position = (x, y)
+            self.changed = True
+
+    def rectangle(self, width, height):
+        """(x, y, width, height) of the cursor on a screen of that size,
+           clipped, None if nothing of it is visible"""
+        if self.rgba is None or self.position is None:
+            return None
+        x = self.position[0] - self.hotspot[0]
+        y = self.position[1] - self.hotspot[1]
+        left, top = max(x, 0), max(y, 0)
+        right = min(x + self.rgba.shape[1], width)
+        bottom = min(y + self.rgba.shape[0], height)
+        if left >= right or top >= bottom:
+            return None
+        return (left, top, right - left, bottom - top)
+
+    def paint(self, array):
+        """blend the cursor over array in place, a copy of the screen.
+           returns the rectangle painted, None if the cursor is not
+           visible"""
+        self.changed = False
+        rectangle = self.rectangle(array.shape[1], array.shape[0])
+        if rectangle is None:
+            return None
+        (left, top, width, height) = rectangle
+        x = left - (self.position[0] - self.hotspot[0])
+        y = top - (self.position[1] - self.hotspot[1])
+        area = array[top:top + height, left:left + width]
+        inverse = self._inverse[y:y + height, x:x + width]
+        area[:] = (area * inverse + 127) // 255 + self.rgba[y:y + height, x:x + width, :3]
+        return rectangle
@@ -0,0 +1,120 @@
+"""
+Counters and timing histograms in the Prometheus text format.
+
+Just what RemoteCapture needs for its /metrics page, without the
+prometheus_client package. A Histogram has one label, observe() is a
+bisect and two additions, so it can go on the decode paths. Counters
+that are kept elsewhere anyway, like RFBClient.encodingStats, are read
+when the page is rendered with a Sampled metric instead of being
+counted twice.
+
+MIT License
+"""
+# flake8: noqa
+
+from bisect import bisect_left
+from timeit import default_timer as timer
+
+#seconds, 10 us to 10 s
+BUCKETS = (1e-5, 3e-5, 1e-4, 3e-4, 1e-3, 3e-3, 0.01, 0.03, 0.1, 0.3, 1.0, 3.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _pairs(label, labelformat, labelvalue):
+    """the (name, text) of the labels, label is a name or a tuple of names
+       with labelformat and labelvalue tuples of the same length"""
+    if not label:
+        return []
+    if isinstance(label, tuple):
+        return [(name, format(value)) for (name, format, value) in zip(label, labelformat, labelvalue)]
+    return [(label, labelformat(labelvalue))]
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, _escape(value)) for (name, value) in pairs) + '}'
+
+
+class Histogram(object):
+    """distribution of values, by the value of a label (or a tuple of
+       them). labelformat turns the label values into text when rendered"""
+
+    def __init__(self, name, help, label=None, buckets=BUCKETS, labelformat=str):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.labelformat = labelformat
+        self.buckets = tuple(buckets)
+        self._values = {}   # label value -> [count per bucket and +Inf, sum]
+
+    def observe(self, value, labelvalue=''):
+        counts = self._values.get(labelvalue)
+        if counts is None:
+            counts = self._values[labelvalue] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def timed(self, func, labelvalue=''):
+        """func, with the seconds of each call observed"""
+        def timed(*args, **kwargs):
+            start = timer()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(timer() - start, labelvalue)
+        return timed
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        for (labelvalue, counts) in sorted(self._values.items()):
+            label = _pairs(self.label, self.labelformat, labelvalue)
+            total = 0
+            for (bound, count) in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                lines.append("%s_bucket%s %d" % (self.name, _labels(label + [('le', bound)]), total))
+            lines.append("%s_sum%s %r" % (self.name, _labels(label), counts[-1]))
+            lines.append("%s_count%s %d" % (self.name, _labels(label), total))
+        return lines
+
+
+class Sampled(object):
+    """a counter or gauge read when rendered. sample() returns a list of
+       (label value, value), the label value is ignored without label.
+       labels as with Histogram"""
+
+    def __init__(self, name, help, type, sample, label=None, labelformat=str):
+        self.name = name
+        self.help = help
+        self.type = type
+        self.sample = sample
+        self.label = label
+        self.labelformat = labelformat
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s %s" % (self.name, self.type)]
+        for (labelvalue, value) in self.sample():
+            label = _pairs(self.label, self.labelformat, labelvalue)
+            lines.append("%s%s %r" % (self.name, _labels(label), value))
+        return lines
+
+
+class Registry(object):
+    """the metrics of a /metrics page"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        """the page, text/plain; version=0.0.4"""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
@@ -4,6 +4,12 @@ RFB protocol implementattion, client side.
 Override RFBClient and RFBFactory in your application.
 See vncviewer.py for an example.
 
+The protocol itself is in RFBConnection, which does no I/O: feed it the
+received bytes with receiveData(), take the bytes to send with
+dataToSend() and the events (ServerInit, RectangleDecoded, Bell, ...)
+with events(). RFBClient is the Twisted protocol on top of it, the
+callbacks are called directly there. See rfbasyncio.py for asyncio.
+
 Reference:
 http://www.realvnc.com/docs/rfbproto.pdf
 
@@ -15,15 +21,17 @@ MIT License
 
 import sys
 import math
+import io
 import zlib
+from collections import namedtuple
 from struct import pack, unpack
-import pyDes
-from twisted.python import usage, log
+from timeit import default_timer as timer
+import numpy as np
+from PIL import Image
+import fastdes
+from twisted.python import log
 from twisted.internet.protocol import Protocol
 from twisted.internet import protocol
-from twisted.application import internet, service
-from twisted.internet import reactor
-#~ from twisted.internet import reactor
 
 # Python3 compatibility replacement for ord(str) as ord(byte)
 if not isinstance(b' ', str):
@@ -41,8 +49,20 @@ TIGHT_ENCODING =                7
 ZLIBHEX_ENCODING =              8
 ZRLE_ENCODING =                 16
 #0xffffff00 to 0xffffffff tight options
+PSEUDO_COMPRESS_LEVEL_ENCODING = -256   #+ level 0..9
+PSEUDO_QUALITY_LEVEL_ENCODING = -32     #+ JPEG quality level 0..9
 PSEUDO_CURSOR_ENCODING =        -239
 PSEUDO_DESKTOP_SIZE_ENCODING =  -223
+PSEUDO_POINTER_POS_ENCODING =   -232
+PSEUDO_EXTENDED_DESKTOP_SIZE_ENCODING = -308
+PSEUDO_FENCE_ENCODING =         -312
+PSEUDO_CONTINUOUS_UPDATES_ENCODING = -313
+
+#Fence flags
+FENCE_BLOCK_BEFORE =    0x00000001
+FENCE_BLOCK_AFTER =     0x00000002
+FENCE_SYNC_NEXT =       0x00000004
+FENCE_REQUEST =         0x80000000
 
 #keycodes
 #for KeyEvent()
@@ -116,66 +136,294 @@ KEY_BackSlash = 0x005C
 KEY_SpaceBar=   0x0020
 
 
-# ZRLE helpers
-def _zrle_next_bit(it, pixels_in_tile):
-    num_pixels = 0
-    while True:
-        b = ord(next(it))
-
-        for n in range(8):
-            value = b >> (7 - n)
-            yield value & 1
-
-            num_pixels += 1
-            if num_pixels == pixels_in_tile:
-                return
-
-
-def _zrle_next_dibit(it, pixels_in_tile):
-    num_pixels = 0
-    while True:
-        b = ord(next(it))
-
-        for n in range(0, 8, 2):
-            value = b >> (6 - n)
-            yield value & 3
-
-            num_pixels += 1
-            if num_pixels == pixels_in_tile:
-                return
-
-
-def _zrle_next_nibble(it, pixels_in_tile):
-    num_pixels = 0
-    while True:
-        b = ord(next(it))
-
-        for n in range(0, 8, 4):
-            value = b >> (4 - n)
-            yield value & 15
-
-            num_pixels += 1
-            if num_pixels == pixels_in_tile:
-                return
+#events of RFBConnection, see RFBConnection.events() and the callbacks
+#that queue them
+ServerInit = namedtuple("ServerInit", "width height name pixelFormat")
+PasswordRequired = namedtuple("PasswordRequired", "")
+AuthFailed = namedtuple("AuthFailed", "reason")
+ConnectionClosed = namedtuple("ConnectionClosed", "reason")
+UpdateBegin = namedtuple("UpdateBegin", "")
+UpdateCommitted = namedtuple("UpdateCommitted", "rectangles")
+RectangleDecoded = namedtuple("RectangleDecoded", "x y width height data")
+RectangleFilled = namedtuple("RectangleFilled", "x y width height color")
+RectangleCopied = namedtuple("RectangleCopied", "srcx srcy x y width height")
+CursorShape = namedtuple("CursorShape", "x y width height image mask")
+PointerPos = namedtuple("PointerPos", "x y")
+DesktopSize = namedtuple("DesktopSize", "width height")
+EndOfContinuousUpdates = namedtuple("EndOfContinuousUpdates", "")
+Bell = namedtuple("Bell", "")
+CutText = namedtuple("CutText", "text")
 
 
-class RFBClient(Protocol):
+# ZRLE helpers
+# packed palette indices, byte value -> indices for 1, 2 and 4 bits per pixel
+_ZRLE_UNPACK = {}
+for _bits in (1, 2, 4):
+    _shifts = np.arange(8 - _bits, -1, -_bits)
+    _ZRLE_UNPACK[_bits] = ((np.arange(256)[:, None] >> _shifts) & ((1 << _bits) - 1)).astype(np.uint8)
+
+
+# Tight helpers
+def _tight_gradient(errors, maxes=(255, 255, 255)):
+    """undo the tight gradient filter, errors is a height x width x 3 array.
+       each value was predicted as left + up - upleft, clamped to 0..max
+       of its channel, 255 for 24 bit TPIXELs.
+       the pixels on one anti-diagonal only depend on the diagonals before,
+       and in the flattened image a diagonal is a slice with step width,
+       so the image is rebuilt one diagonal at a time."""
+    height, width = errors.shape[:2]
+    #decoded values with a row and a column of 0 in front, flattened
+    stride = width + 1
+    maxes = np.array(maxes, dtype=np.int16 if max(maxes) < 256 else np.int32)
+    values = np.zeros(((height + 1) * stride, 3), dtype=maxes.dtype)
+    errors = errors.reshape(-1, 3)
+    for k in range(height + width - 1):
+        first = max(0, k - width + 1)
+        count = min(height - 1, k) - first + 1
+        start = (first + 1) * stride + (k - first) + 1
+        stop = start + width * (count - 1) + 1
+        predicted = values[start - 1:stop - 1:width] + values[start - stride:stop - stride:width]
+        predicted -= values[start - stride - 1:stop - stride - 1:width]
+        np.clip(predicted, 0, maxes, out=predicted)
+        estart = first * width + (k - first)
+        predicted += errors[estart:estart + (width - 1) * (count - 1) + 1:max(width - 1, 1)]
+        predicted &= maxes
+        values[start:stop:width] = predicted
+    return values.reshape(height + 1, stride, 3)[1:, 1:].astype(np.uint8 if maxes.max() < 256 else np.uint16)
+
+
+class ReceiveBuffer(object):
+    """Queue of received bytes for the expect() parser.
+
+    Incoming chunks are only joined once enough data for the next block
+    is there, blocks are then handed out as memoryview slices of the joined
+    data with a read cursor, so draining many small messages does not copy
+    the remaining buffer over and over. The joined data is immutable, a
+    handler may keep a block but should copy it with bytes() if it is
+    small and long lived, the view keeps the whole chunk alive."""
 
     def __init__(self):
-        self._packet = []
-        self._packet_len = 0
+        self._chunks = []       # received, not yet joined data
+        self._view = None       # memoryview of joined data
+        self._pos = 0           # read cursor in _view
+        self._len = 0           # unread bytes in total
+        self.consumed = 0       # bytes read or skipped since the start
+
+    def __len__(self):
+        return self._len
+
+    def append(self, data):
+        if data:
+            self._chunks.append(data)
+            self._len += len(data)
+
+    def read(self, size):
+        """return the next size bytes as memoryview and consume them.
+           the caller has to check len() first."""
+        if self._view is None or self._pos + size > len(self._view):
+            self._join()
+        block = self._view[self._pos:self._pos + size]
+        self._pos += size
+        self._len -= size
+        self.consumed += size
+        return block
+
+    def skip(self, size):
+        """consume size bytes"""
+        self.read(size)
+
+    def peek(self):
+        """return all unread data as bytes without consuming it"""
+        return self.view().tobytes()
+
+    def view(self):
+        """return all unread data as memoryview without consuming it,
+           use skip() for the part that was used"""
+        if self._chunks or self._view is None:
+            self._join()
+        return self._view[self._pos:]
+
+    def _join(self):
+        chunks = self._chunks
+        if self._view is not None and self._pos < len(self._view):
+            chunks.insert(0, self._view[self._pos:])
+        if len(chunks) == 1:
+            data = chunks[0]
+        else:
+            data = b''.join(chunks)
+        self._view = memoryview(data)
+        self._pos = 0
+        self._chunks = []
+
+
+class PixelFormat(object):
+    """RFB pixel format, converts pixel data to height x width x 3 uint8
+    arrays and back.
+
+    The conversion is compiled once per format: byte aligned 8 bit
+    channels are a view (or one fancy index) of the data, 8 and 16 bpp go
+    through a lookup table of all pixel values, other 32 bpp formats are
+    shifted and masked with a small table per channel. Colour mapped 8 bpp
+    uses the colour map from SetColourMapEntries as lookup table.
+    channels is the channel order of the arrays, "RGB" or "BGR"."""
+
+    def __init__(self, bpp=32, depth=24, bigendian=0, truecolor=1, redmax=255, greenmax=255, bluemax=255,
+                 redshift=0, greenshift=8, blueshift=16, channels="RGB"):
+        if bpp not in (8, 16, 32):
+            raise ValueError("%d bits per pixel not supported" % bpp)
+        self.bpp, self.depth, self.bigendian, self.truecolor = bpp, depth, bigendian, truecolor
+        self.redmax, self.greenmax, self.bluemax = redmax, greenmax, bluemax
+        self.redshift, self.greenshift, self.blueshift = redshift, greenshift, blueshift
+        self.channels = channels
+        self.bypp = bpp // 8
+        self.dtype = np.dtype("u%d" % self.bypp).newbyteorder(">" if bigendian else "<")
+        self.colormap = np.zeros((256, 4), dtype=np.uint8)    # 4th byte unused
+        order = [channels.index(c) for c in "RGB"]
+        self._maxes = [(redmax, greenmax, bluemax)[order.index(n)] for n in range(3)]
+        self._shifts = [(redshift, greenshift, blueshift)[order.index(n)] for n in range(3)]
+        #per channel value -> 8 bit
+        self._scales = [(np.arange(m + 1) * 255 + m // 2) // max(m, 1) for m in self._maxes]
+        self._lut = None
+        self._offsets = None
+        #lookup tables hold 4 byte pixels, one 32 bit take() is much faster
+        #than indexing rows of 3 bytes
+        if not truecolor:
+            self._lut = self.colormap.view(np.uint32)[:, 0]
+        elif bpp < 32:
+            values = np.arange(1 << bpp)
+            lut = np.zeros((1 << bpp, 4), dtype=np.uint8)
+            for (n, scale, shift, m) in zip(range(3), self._scales, self._shifts, self._maxes):
+                lut[:, n] = scale[(values >> shift) & m]
+            self._lut = lut.view(np.uint32)[:, 0]
+        elif self._maxes == [255] * 3 and all(shift % 8 == 0 for shift in self._shifts):
+            offsets = [shift // 8 if not bigendian else 3 - shift // 8 for shift in self._shifts]
+            step = offsets[1] - offsets[0]
+            if step in (1, -1) and offsets[2] - offsets[1] == step:
+                #a view, no copy
+                stop = offsets[2] + step
+                self._offsets = slice(offsets[0], stop if stop >= 0 else None, step)
+            else:
+                self._offsets = offsets
+        else:
+            self._scales = [scale.astype(np.uint8) for scale in self._scales]
+
+    def toPixels(self, data, width, height):
+        """data in this format to a height x width x 3 array"""
+        if self._offsets is not None:
+            return np.frombuffer(data, np.uint8, width * height * 4).reshape(height, width, 4)[:, :, self._offsets]
+        values = np.frombuffer(data, self.dtype, width * height).reshape(height, width)
+        if self._lut is not None:
+            return self._lut.take(values).view(np.uint8).reshape(height, width, 4)[:, :, :3]
+        pixels = np.empty((height, width, 3), dtype=np.uint8)
+        for (n, scale, shift, m) in zip(range(3), self._scales, self._shifts, self._maxes):
+            pixels[:, :, n] = scale[(values >> shift) & m]
+        return pixels
+
+    def fromPixels(self, pixels):
+        """height x width x 3 array to data in this format"""
+        pixels = pixels.astype(np.uint32)
+        if not self.truecolor:
+            #nearest colour of the colour map
+            distance = ((pixels[:, :, None, :].astype(np.int32) - self.colormap[:, :3].astype(np.int32)) ** 2).sum(-1)
+            return distance.argmin(-1).astype(np.uint8).tobytes()
+        value = 0
+        for (n, shift, m) in zip(range(3), self._shifts, self._maxes):
+            value = value | ((pixels[:, :, n] * m + 127) // 255) << shift
+        return value.astype(self.dtype).tobytes()
+
+    def ordered(self, rgb):
+        """a R, G, B ordered array in the channel order of the arrays,
+           a view"""
+        if self.channels == "BGR":
+            return rgb[..., ::-1]
+        return rgb
+
+    def cpixelSize(self):
+        """CPIXEL (ZRLE) size, 3 bytes if all colours fit in 24 bits"""
+        if self.truecolor and self.bpp == 32 and self.depth <= 24 and self._cpixelOffset() is not None:
+            return 3
+        return self.bypp
+
+    def _cpixelOffset(self):
+        #the byte offset of the 3 CPIXEL bytes in a pixel, None if the
+        #colours are neither in the least nor the most significant 3 bytes
+        mask = 0
+        for (shift, m) in zip(self._shifts, self._maxes):
+            mask |= m << shift
+        if mask < 1 << 24:
+            low = True
+        elif mask & 0xff == 0:
+            low = False
+        else:
+            return None
+        return 0 if low != bool(self.bigendian) else 1
+
+    def cpixels(self, data, pos, count):
+        """count CPIXELs at pos as (count, bypp) array of pixels"""
+        size = self.cpixelSize()
+        cpixels = np.frombuffer(data, np.uint8, count * size, pos).reshape(count, size)
+        if size == self.bypp:
+            return cpixels
+        #the unused byte set, like an opaque alpha channel
+        pixels = np.full((count, 4), 0xff, dtype=np.uint8)
+        offset = self._cpixelOffset()
+        pixels[:, offset:offset + 3] = cpixels
+        return pixels
+
+    def setColourMapEntries(self, first, colours):
+        """colours is a (n, 3) array of 16 bit red, green, blue"""
+        self.colormap[first:first + len(colours), :3] = self.ordered(np.asarray(colours) >> 8)
+
+
+class RFBConnection(object):
+    """client side of a RFB connection, without any I/O.
+
+    receiveData() parses the bytes from the server and calls the
+    callbacks, the messages to the server are collected for
+    dataToSend(). the default callbacks queue an event for events(),
+    override them or read the events, whatever fits the application."""
+
+    #channel order of the arrays toPixels() returns, "RGB" or "BGR"
+    channels = "RGB"
+
+    def __init__(self, password=None, shared=0):
+        self.password = password    # for VNC authentication, None asks with PasswordRequired
+        self.shared = shared        # 1 leaves the other clients connected
+        self.closed = False         # the connection should be closed, see _close()
+        self._outgoing = []         # messages for dataToSend()
+        self._events = []           # events for events()
+        self.tap = None             # gets all received bytes, see rfbreplay.StreamTap
+        self._packet = ReceiveBuffer()
         self._handler = self._handleInitial
         self._already_expecting = 0
         self._version = None
         self._version_server = None
         self._zlib_stream = zlib.decompressobj(0)
+        self._tight_streams = [zlib.decompressobj() for n in range(4)]
+        self._zlib_raw_stream = zlib.decompressobj()        #Zlib encoding
+        self._zlibhex_raw_stream = zlib.decompressobj()     #ZlibHex raw tiles
+        self._zlibhex_stream = zlib.decompressobj()         #ZlibHex encoded tiles
+        self.framebuffer = None     # set by the application, see toPixels()
+        #decoder cost, encoding -> [rectangles, pixels, bytes, seconds]
+        #since the start of the connection, see _account()
+        self.encodingStats = {}
+        self._decoding = None       # encoding of the rectangle being decoded
+        self._mark = None           # (time, bytes consumed) not accounted yet
+        self._rectangleSeconds = 0.0    # decode seconds of the rectangle so far
+        #metrics.Histogram for the decode seconds of each rectangle by
+        #encoding, None for no per rectangle timing
+        self.decodeHistogram = None
+        self.fenceSupported = False                 # server sent a Fence
+        self.continuousUpdatesSupported = False     # server sent EndOfContinuousUpdates
+        self.continuousUpdates = False              # enabled, the server pushes updates
+        self._continuousUpdatesStopping = False     # enableContinuousUpdates(0) sent, an EndOfContinuousUpdates confirms it
 
     #------------------------------------------------------
     # states used on connection startup
     #------------------------------------------------------
 
     def _handleInitial(self):
-        buffer = b''.join(self._packet)
+        buffer = self._packet.peek()
         if b'\n' in buffer:
             version = 3.3
             if buffer[:3] == b'RFB':
@@ -188,13 +436,11 @@ class RFBClient(Protocol):
                             % version_server)
                     version = max(filter(
                         lambda x: x <= version_server, SUPPORTED_VERSIONS))
-            buffer = buffer[12:]
+            self._packet.skip(12)
             log.msg("Using protocol version %.3f" % version)
             parts = str(version).split('.')
-            self.transport.write(
+            self._send(
                 bytes(b"RFB %03d.%03d\n" % (int(parts[0]), int(parts[1]))))
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
             self._handler = self._handleExpected
             self._version = version
             self._version_server = version_server
@@ -202,9 +448,6 @@ class RFBClient(Protocol):
                 self.expect(self._handleAuth, 4)
             else:
                 self.expect(self._handleNumberSecurityTypes, 1)
-        else:
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
 
     def _handleNumberSecurityTypes(self, block):
         (num_types,) = unpack("!B", block)
@@ -219,7 +462,7 @@ class RFBClient(Protocol):
         valid_types = [sec_type for sec_type in types if sec_type in SUPPORTED_TYPES]
         if valid_types:
             sec_type = max(valid_types)
-            self.transport.write(pack("!B", sec_type))
+            self._send(pack("!B", sec_type))
             if sec_type == 1:
                 if self._version < 3.8:
                     self._doClientInitialization()
@@ -248,10 +491,11 @@ class RFBClient(Protocol):
         self.expect(self._handleConnMessage, waitfor)
 
     def _handleConnMessage(self, block):
-        log.msg("Connection refused: %r" % block)
+        log.msg("Connection refused: %r" % bytes(block))
+        self._close(bytes(block))
 
     def _handleVNCAuth(self, block):
-        self._challenge = block
+        self._challenge = bytes(block)
         self.vncRequestPassword()
         self.expect(self._handleVNCAuthResult, 4)
 
@@ -260,7 +504,7 @@ class RFBClient(Protocol):
         pw = (password + '\0' * 8)[:8]        #make sure its 8 chars long, zero padded
         des = RFBDes(pw)
         response = des.encrypt(self._challenge)
-        self.transport.write(response)
+        self._send(response)
 
     def _handleVNCAuthResult(self, block):
         (result,) = unpack("!I", block)
@@ -271,13 +515,13 @@ class RFBClient(Protocol):
         elif result == 1:   #failed
             if self._version < 3.8:
                 self.vncAuthFailed("authentication failed")
-                self.transport.loseConnection()
+                self._close("authentication failed")
             else:
                 self.expect(self._handleAuthFailed, 4)
         elif result == 2:   #too many
             if self._version < 3.8:
                 self.vncAuthFailed("too many tries to log in")
-                self.transport.loseConnection()
+                self._close("too many tries to log in")
             else:
                 self.expect(self._handleAuthFailed, 4)
         else:
@@ -288,11 +532,11 @@ class RFBClient(Protocol):
         self.expect(self._handleAuthFailedMessage, waitfor)
 
     def _handleAuthFailedMessage(self, block):
-        self.vncAuthFailed(block)
-        self.transport.loseConnection()
+        self.vncAuthFailed(bytes(block))
+        self._close(bytes(block))
 
     def _doClientInitialization(self):
-        self.transport.write(pack("!B", self.factory.shared))
+        self._send(pack("!B", self.shared))
         self.expect(self._handleServerInit, 24)
 
     def _handleServerInit(self, block):
@@ -302,10 +546,13 @@ class RFBClient(Protocol):
          self.redshift, self.greenshift, self.blueshift) = \
            unpack("!BBBBHHHBBBxxx", pixformat)
         self.bypp = self.bpp // 8        #calc bytes per pixel
+        self.pixelFormat = PixelFormat(self.bpp, self.depth, self.bigendian, self.truecolor,
+                                       self.redmax, self.greenmax, self.bluemax,
+                                       self.redshift, self.greenshift, self.blueshift, self.channels)
         self.expect(self._handleServerName, namelen)
 
     def _handleServerName(self, block):
-        self.name = block
+        self.name = bytes(block)
         #callback:
         self.vncConnectionMade()
         self.expect(self._handleConnection, 1)
@@ -317,11 +564,17 @@ class RFBClient(Protocol):
         (msgid,) = unpack("!B", block)
         if msgid == 0:
             self.expect(self._handleFramebufferUpdate, 3)
+        elif msgid == 1:
+            self.expect(self._handleSetColourMapEntries, 5)
         elif msgid == 2:
             self.bell()
             self.expect(self._handleConnection, 1)
         elif msgid == 3:
             self.expect(self._handleServerCutText, 7)
+        elif msgid == 150:
+            self._handleEndOfContinuousUpdates()
+        elif msgid == 248:
+            self.expect(self._handleFence, 8)
         else:
             log.msg("unknown message received (id %d)" % msgid)
             self.expect(self._handleConnection, 1)
@@ -336,32 +589,73 @@ class RFBClient(Protocol):
         if self.rectangles:
             self.expect(self._handleRectangle, 12)
         else:
+            #the time spent in commitUpdate() is not decoding
+            self._account()
+            self._observe()
+            self._decoding = None
             self.commitUpdate(self.rectanglePos)
+            self._account()
             self.expect(self._handleConnection, 1)
 
+    def _account(self, pending=0):
+        """add the time and the bytes since the last call to the stats of
+           the encoding being decoded. pending bytes, already read, are
+           left for the next call"""
+        now = timer()
+        consumed = self._packet.consumed - pending
+        if self._decoding is not None and self._mark is not None:
+            stats = self.encodingStats[self._decoding]
+            stats[2] += consumed - self._mark[1]
+            stats[3] += now - self._mark[0]
+            self._rectangleSeconds += now - self._mark[0]
+        self._mark = (now, consumed)
+
+    def _observe(self):
+        """the rectangle being decoded is done, after _account(). pseudo
+           encodings (negative) are no decoding, not timed"""
+        if self.decodeHistogram is not None and self._decoding is not None and self._decoding >= 0:
+            self.decodeHistogram.observe(self._rectangleSeconds, self._decoding)
+        self._rectangleSeconds = 0.0
+
     def _handleRectangle(self, block):
         (x, y, width, height, encoding) = unpack("!HHHHi", block)
         if self.rectangles:
             self.rectangles -= 1
             self.rectanglePos.append( (x, y, width, height) )
+            #the header is part of the cost of the encoding
+            self._account(len(block))
+            self._observe()
+            self._decoding = encoding
+            if encoding not in self.encodingStats:
+                self.encodingStats[encoding] = [0, 0, 0, 0.0]
+            self.encodingStats[encoding][0] += 1
+            self.encodingStats[encoding][1] += width * height
             if encoding == COPY_RECTANGLE_ENCODING:
                 self.expect(self._handleDecodeCopyrect, 4, x, y, width, height)
             elif encoding == RAW_ENCODING:
                 self.expect(self._handleDecodeRAW, width*height*self.bypp, x, y, width, height)
-            elif encoding == HEXTILE_ENCODING:
+            elif encoding == HEXTILE_ENCODING or encoding == ZLIBHEX_ENCODING:
                 self._doNextHextileSubrect(None, None, x, y, width, height, None, None)
+            elif encoding == ZLIB_ENCODING:
+                self.expect(self._handleDecodeZlib, 4, x, y, width, height)
             elif encoding == CORRE_ENCODING:
                 self.expect(self._handleDecodeCORRE, 4 + self.bypp, x, y, width, height)
             elif encoding == RRE_ENCODING:
                 self.expect(self._handleDecodeRRE, 4 + self.bypp, x, y, width, height)
             elif encoding == ZRLE_ENCODING:
                 self.expect(self._handleDecodeZRLE, 4, x, y, width, height)
+            elif encoding == TIGHT_ENCODING:
+                self.expect(self._handleDecodeTight, 1, x, y, width, height)
             elif encoding == PSEUDO_CURSOR_ENCODING:
                 length = width * height * self.bypp
                 length += int(math.floor((width + 7.0) / 8)) * height
                 self.expect(self._handleDecodePsuedoCursor, length, x, y, width, height)
+            elif encoding == PSEUDO_POINTER_POS_ENCODING:
+                self._handleDecodePointerPos(x, y)
             elif encoding == PSEUDO_DESKTOP_SIZE_ENCODING:
                 self._handleDecodeDesktopSize(width, height)
+            elif encoding == PSEUDO_EXTENDED_DESKTOP_SIZE_ENCODING:
+                self.expect(self._handleDecodeExtendedDesktopSize, 4, x, y, width, height)
             else:
                 log.msg("unknown encoding received (encoding %d)" % encoding)
                 self._doConnection()
@@ -375,6 +669,17 @@ class RFBClient(Protocol):
         self.updateRectangle(x, y, width, height, block)
         self._doConnection()
 
+    # ---  Zlib Encoding
+
+    def _handleDecodeZlib(self, block, x, y, width, height):
+        (compressed_bytes,) = unpack("!L", block)
+        self.expect(self._handleDecodeZlibData, compressed_bytes, x, y, width, height)
+
+    def _handleDecodeZlibData(self, block, x, y, width, height):
+        """raw pixel data through one zlib stream for the connection"""
+        self._drawRectangle(x, y, width, height, self._zlib_raw_stream.decompress(block))
+        self._doConnection()
+
     # ---  CopyRect Encoding
 
     def _handleDecodeCopyrect(self, block, x, y, width, height):
@@ -386,48 +691,85 @@ class RFBClient(Protocol):
 
     def _handleDecodeRRE(self, block, x, y, width, height):
         (subrects,) = unpack("!I", block[:4])
-        color = block[4:]
-        self.fillRectangle(x, y, width, height, color)
+        color = bytes(block[4:])
+        self._fillRectangle(x, y, width, height, color)
         if subrects:
-            self.expect(self._handleRRESubRectangles, (8 + self.bypp) * subrects, x, y)
+            self.expect(self._handleRRESubRectangles, (8 + self.bypp) * subrects, x, y, width, height)
         else:
             self._doConnection()
 
-    def _handleRRESubRectangles(self, block, topx, topy):
+    def _handleRRESubRectangles(self, block, topx, topy, width, height):
         #~ print "_handleRRESubRectangle"
-        pos = 0
-        end = len(block)
-        sz  = self.bypp + 8
-        format = "!%dsHHHH" % self.bypp
-        while pos < end:
-            (color, x, y, width, height) = unpack(format, block[pos:pos+sz])
-            self.fillRectangle(topx + x, topy + y, width, height, color)
-            pos += sz
+        self._drawSubrects(block, ">u2", topx, topy, width, height)
         self._doConnection()
 
     # ---  CoRRE Encoding
 
     def _handleDecodeCORRE(self, block, x, y, width, height):
         (subrects,) = unpack("!I", block[:4])
-        color = block[4:]
-        self.fillRectangle(x, y, width, height, color)
+        color = bytes(block[4:])
+        self._fillRectangle(x, y, width, height, color)
         if subrects:
-            self.expect(self._handleDecodeCORRERectangles, (4 + self.bypp)*subrects, x, y)
+            self.expect(self._handleDecodeCORRERectangles, (4 + self.bypp)*subrects, x, y, width, height)
         else:
             self._doConnection()
 
-    def _handleDecodeCORRERectangles(self, block, topx, topy):
+    def _handleDecodeCORRERectangles(self, block, topx, topy, width, height):
         #~ print "_handleDecodeCORRERectangle"
-        pos = 0
-        end = len(block)
-        sz  = self.bypp + 4
-        format = "!%dsBBBB" % self.bypp
-        while pos < sz:
-            (color, x, y, width, height) = unpack(format, block[pos:pos+sz])
-            self.fillRectangle(topx + x, topy + y, width, height, color)
-            pos += sz
+        self._drawSubrects(block, "u1", topx, topy, width, height)
         self._doConnection()
 
+    def _drawSubrects(self, block, coord, topx, topy, width, height):
+        """draw RRE/CoRRE subrects, pixel value followed by x, y, width,
+           height of type coord each, relative to (topx, topy). later
+           subrects are drawn over earlier ones"""
+        dtype = np.dtype([('pixel', 'u1', (self.bypp,)), ('x', coord), ('y', coord), ('w', coord), ('h', coord)])
+        rects = np.frombuffer(block, dtype)
+        fb = self.framebuffer
+        if fb is None or topx + width > fb.width or topy + height > fb.height:
+            pixels = rects['pixel']
+            for (n, x, y, w, h) in zip(range(len(rects)), rects['x'].tolist(), rects['y'].tolist(),
+                                       rects['w'].tolist(), rects['h'].tolist()):
+                self.fillRectangle(topx + x, topy + y, w, h, pixels[n].tobytes())
+            return
+        colors = self.toPixels(np.ascontiguousarray(rects['pixel']), len(rects), 1)[0]
+        x = rects['x'].astype(np.intp)
+        y = rects['y'].astype(np.intp)
+        w = rects['w'].astype(np.intp)
+        h = rects['h'].astype(np.intp)
+        area = w * h
+        total = int(area.sum())
+        screen = fb.array[topy:topy + height, topx:topx + width]
+        if total > 64 * len(rects) or (x + w > width).any() or (y + h > height).any():
+            #big or broken subrects, one slice each is cheaper (and clips)
+            for (color, x, y, w, h) in zip(colors, x.tolist(), y.tolist(), w.tolist(), h.tolist()):
+                fill = screen[y:y + h, x:x + w]
+                if fill.size:
+                    fill[0] = color
+                    fill[1:] = fill[0]
+            return
+        #all covered pixels at once: owner subrect, row and column of each
+        owner = np.repeat(np.arange(1, len(rects) + 1, dtype=np.int32), area)
+        offset = np.arange(total) - np.repeat(np.cumsum(area) - area, area)
+        wo = w[owner - 1]
+        row = y[owner - 1] + offset // wo
+        column = x[owner - 1] + offset % wo
+        #where subrects overlap the last one wins, the highest number
+        owners = np.zeros(height * width, dtype=np.int32)
+        position = row * width + column
+        np.maximum.at(owners, position, owner)
+        won = owners[position] == owner
+        screen[row[won], column[won]] = colors[owner[won] - 1]
+
+    def _fillRectangle(self, x, y, width, height, color):
+        """fill with color in the pixel format set up earlier, straight
+           into the framebuffer if there is one"""
+        fb = self.framebuffer
+        if fb is not None and x + width <= fb.width and y + height <= fb.height:
+            fb.fill(x, y, width, height, self.toPixels(color, 1, 1)[0, 0])
+        else:
+            self.fillRectangle(x, y, width, height, color)
+
     # ---  Hexile Encoding
 
     def _doNextHextileSubrect(self, bg, color, x, y, width, height, tx, ty):
@@ -446,12 +788,162 @@ class RFBClient(Protocol):
         else:
             tx = x
             ty = y
+        #decode what is already received in one go
+        if ty < y + height and self.framebuffer is not None and len(self._packet):
+            (bg, color, tx, ty) = self._decodeHextileTiles(bg, color, x, y, width, height, tx, ty)
         #more tiles?
         if ty >= y + height:
             self._doConnection()
         else:
             self.expect(self._handleDecodeHextile, 1, bg, color, x, y, width, height, tx, ty)
 
+    def _decodeHextileTiles(self, bg, color, x, y, width, height, tx, ty):
+        """bulk decoder, draws all complete tiles in the receive buffer
+           straight into the framebuffer, starting with the tile at (tx, ty).
+           returns the state for the next tile, the rest of the rectangle
+           is then decoded tile by tile with expect() when it arrives."""
+        screen = self.framebuffer.array
+        if x + width > self.framebuffer.width or y + height > self.framebuffer.height:
+            return (bg, color, tx, ty)
+        buf = self._packet.view()
+        end = len(buf)
+        pos = 0
+        bypp = self.bypp
+        toColor = self._hextileColors()
+        run_x = run_bg = None   # start and colour of plain tiles not drawn yet
+
+        while ty < y + height:
+            tw = th = 16
+            if x + width - tx < 16:   tw = x + width - tx
+            if y + height - ty < 16:  th = y + height - ty
+            if pos >= end:
+                break
+            subencoding = buf[pos]
+            p = pos + 1
+            if subencoding & 0x60:  #ZlibRaw, Zlib (ZlibHex only)
+                if p + 2 > end:
+                    break
+                (size,) = unpack("!H", buf[p:p+2])
+                if p + 2 + size > end:
+                    break
+                if run_x is not None:
+                    screen[ty:ty+th, run_x:tx] = toColor(run_bg)[0, 0]
+                    run_x = None
+                (bg, color) = self._handleZlibHexTile(buf[p+2:p+2+size], subencoding, bg, color, tx, ty, tw, th, toColor)
+                p += 2 + size
+            elif subencoding & 1:     #RAW
+                size = tw*th*bypp
+                if p + size > end:
+                    break
+                if run_x is not None:
+                    screen[ty:ty+th, run_x:tx] = toColor(run_bg)[0, 0]
+                    run_x = None
+                screen[ty:ty+th, tx:tx+tw] = self.toPixels(buf[p:p+size], tw, th)
+                p += size
+            else:
+                size = 0
+                if subencoding & 2:  size += bypp
+                if subencoding & 4:  size += bypp
+                if subencoding & 8:  size += 1
+                if p + size > end:
+                    break
+                subrects = 0
+                if subencoding & 8:     #AnySubrects
+                    subrects = buf[p + size - 1]
+                if subencoding & 16:    #SubrectsColoured
+                    size += (bypp + 2)*subrects
+                else:
+                    size += 2*subrects
+                if p + size > end:
+                    break
+                if not subrects:
+                    #plain tile, collect runs of them in the same colour
+                    if subencoding & 2:     #BackgroundSpecified
+                        bg = buf[p:p+bypp].tobytes()
+                    if subencoding & 4:     #ForegroundSpecified
+                        fg = p + bypp if subencoding & 2 else p
+                        color = buf[fg:fg+bypp].tobytes()
+                    if run_x is None or run_bg != bg:
+                        if run_x is not None:
+                            screen[ty:ty+th, run_x:tx] = toColor(run_bg)[0, 0]
+                        run_x, run_bg = tx, bg
+                else:
+                    if run_x is not None:
+                        screen[ty:ty+th, run_x:tx] = toColor(run_bg)[0, 0]
+                        run_x = None
+                    (bg, color) = self._drawHextileTile(buf, p, subencoding, bg, color, screen[ty:ty+th, tx:tx+tw], toColor)
+                p += size
+            pos = p
+            #next tile
+            tx += 16
+            if tx >= x + width:
+                if run_x is not None:
+                    screen[ty:ty+th, run_x:x+width] = toColor(run_bg)[0, 0]
+                    run_x = None
+                tx = x
+                ty += 16
+
+        if run_x is not None:
+            screen[ty:ty+th, run_x:tx] = toColor(run_bg)[0, 0]
+        self._packet.skip(pos)
+        return (bg, color, tx, ty)
+
+    def _hextileColors(self):
+        """function for pixel value -> 16x16 RGB block, with a cache.
+           copying a whole block is faster than broadcasting one pixel"""
+        colors = {}
+
+        def toColor(pixel):
+            if pixel not in colors:
+                colors[pixel] = np.empty((16, 16, 3), dtype=np.uint8)
+                colors[pixel][:] = self.toPixels(pixel, 1, 1)[0, 0]
+            return colors[pixel]
+        return toColor
+
+    def _drawHextileTile(self, data, p, subencoding, bg, color, tile, toColor):
+        """draw a complete, not raw, hextile tile from data at position p
+           into tile, a view of the framebuffer. returns the new (bg, color)"""
+        bypp = self.bypp
+        th, tw = tile.shape[:2]
+        subrects = 0
+        if subencoding & 2:     #BackgroundSpecified
+            bg = bytes(data[p:p+bypp])
+            p += bypp
+        if subencoding & 4:     #ForegroundSpecified
+            color = bytes(data[p:p+bypp])
+            p += bypp
+        if subencoding & 8:     #AnySubrects
+            subrects = data[p]
+            p += 1
+        tile[:] = toColor(bg)[:th, :tw]
+        if not subrects:
+            return (bg, color)
+        rects = np.frombuffer(data, np.uint8, subrects * (bypp + 2 if subencoding & 16 else 2), p).reshape(subrects, -1)
+        if subencoding & 16:    #SubrectsColoured
+            fills = self.toPixels(np.ascontiguousarray(rects[:, :bypp]), subrects, 1)[0]
+            color = rects[-1, :bypp].tobytes()
+        elif subrects > 16:
+            #all in one colour, the order does not matter. mark the
+            #corners in a difference array, the running sums are the coverage
+            xy = rects[:, 0].astype(np.intp)
+            wh = rects[:, 1].astype(np.intp)
+            sx = xy >> 4
+            sy = xy & 0xf
+            ex = sx + (wh >> 4) + 1
+            ey = sy + (wh & 0xf) + 1
+            corners = np.bincount(np.concatenate((sy*17 + sx, ey*17 + ex)), minlength=289) - \
+                      np.bincount(np.concatenate((sy*17 + ex, ey*17 + sx)), minlength=289)
+            covered = corners.reshape(17, 17).cumsum(0).cumsum(1)[:th, :tw] > 0
+            np.copyto(tile, toColor(color)[:th, :tw], where=covered[:, :, None])
+            fills = []
+        else:
+            fills = [toColor(color)[0, 0]] * subrects
+        for (xy, wh, fill) in zip(rects[:, -2].tolist(), rects[:, -1].tolist(), fills):
+            sx = xy >> 4
+            sy = xy & 0xf
+            tile[sy:sy + (wh & 0xf) + 1, sx:sx + (wh >> 4) + 1] = fill
+        return (bg, color)
+
     def _handleDecodeHextile(self, block, bg, color, x, y, width, height, tx, ty):
         (subencoding,) = unpack("!B", block)
         #calc tile size
@@ -459,7 +951,9 @@ class RFBClient(Protocol):
         if x + width - tx < 16:   tw = x + width - tx
         if y + height - ty < 16:  th = y + height- ty
         #decode tile
-        if subencoding & 1:     #RAW
+        if subencoding & 0x60:  #ZlibRaw, Zlib (ZlibHex only)
+            self.expect(self._handleDecodeZlibHexLength, 2, subencoding, bg, color, x, y, width, height, tx, ty, tw, th)
+        elif subencoding & 1:     #RAW
             self.expect(self._handleDecodeHextileRAW, tw*th*self.bypp, bg, color, x, y, width, height, tx, ty, tw, th)
         else:
             numbytes = 0
@@ -479,11 +973,11 @@ class RFBClient(Protocol):
         subrects = 0
         pos = 0
         if subencoding & 2:     #BackgroundSpecified
-            bg = block[:self.bypp]
+            bg = bytes(block[:self.bypp])
             pos += self.bypp
         self.fillRectangle(tx, ty, tw, th, bg)
         if subencoding & 4:     #ForegroundSpecified
-            color = block[pos:pos+self.bypp]
+            color = bytes(block[pos:pos+self.bypp])
             pos += self.bypp
         if subencoding & 8:     #AnySubrects
             #~ (subrects, ) = unpack("!B", block)
@@ -510,7 +1004,7 @@ class RFBClient(Protocol):
         end = len(block)
         while pos < end:
             pos2 = pos + self.bypp
-            color = block[pos:pos2]
+            color = bytes(block[pos:pos2])
             xy = ord(block[pos2])
             wh = ord(block[pos2+1])
             sx = xy >> 4
@@ -537,6 +1031,57 @@ class RFBClient(Protocol):
         self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
 
 
+    # ---  ZlibHex Encoding
+    # Hextile where tiles can be compressed, flag 0x20 for raw pixel data
+    # and 0x40 for the rest of a normal tile, each with its own zlib stream.
+
+    def _handleDecodeZlibHexLength(self, block, subencoding, bg, color, x, y, width, height, tx, ty, tw, th):
+        (compressed_bytes,) = unpack("!H", block)
+        self.expect(self._handleDecodeZlibHexData, compressed_bytes, subencoding, bg, color, x, y, width, height, tx, ty, tw, th)
+
+    def _handleDecodeZlibHexData(self, block, subencoding, bg, color, x, y, width, height, tx, ty, tw, th):
+        fb = self.framebuffer
+        toColor = None
+        if fb is not None and tx + tw <= fb.width and ty + th <= fb.height:
+            toColor = self._hextileColors()
+        (bg, color) = self._handleZlibHexTile(block, subencoding, bg, color, tx, ty, tw, th, toColor)
+        self._doNextHextileSubrect(bg, color, x, y, width, height, tx, ty)
+
+    def _handleZlibHexTile(self, block, subencoding, bg, color, tx, ty, tw, th, toColor=None):
+        """decompress and draw a ZlibHex tile, into the framebuffer if
+           toColor (see _hextileColors()) is given. returns the new (bg, color)"""
+        if subencoding & 0x20:  #ZlibRaw
+            data = self._zlibhex_raw_stream.decompress(block)
+            self._drawRectangle(tx, ty, tw, th, data)
+            return (bg, color)
+        data = self._zlibhex_stream.decompress(block)
+        if toColor is not None:
+            tile = self.framebuffer.array[ty:ty+th, tx:tx+tw]
+            return self._drawHextileTile(data, 0, subencoding, bg, color, tile, toColor)
+        #through the callbacks
+        bypp = self.bypp
+        p = 0
+        subrects = 0
+        if subencoding & 2:     #BackgroundSpecified
+            bg = data[p:p+bypp]
+            p += bypp
+        if subencoding & 4:     #ForegroundSpecified
+            color = data[p:p+bypp]
+            p += bypp
+        if subencoding & 8:     #AnySubrects
+            subrects = data[p]
+            p += 1
+        self.fillRectangle(tx, ty, tw, th, bg)
+        for n in range(subrects):
+            if subencoding & 16:    #SubrectsColoured
+                color = data[p:p+bypp]
+                p += bypp
+            xy = data[p]
+            wh = data[p+1]
+            p += 2
+            self.fillRectangle(tx + (xy >> 4), ty + (xy & 0xf), (wh >> 4) + 1, (wh & 0xf) + 1, color)
+        return (bg, color)
+
     # ---  ZRLE Encoding
     def _handleDecodeZRLE(self, block, x, y, width, height):
         """
@@ -552,20 +1097,14 @@ class RFBClient(Protocol):
         ty = y
 
         data = self._zlib_stream.decompress(block)
-        it = iter(data)
-
-        def cpixel(i):
-            yield next(i)
-            yield next(i)
-            yield next(i)
-            # Alpha channel
-            yield 0xff
+        pos = 0
+        end = len(data)
+        cpixels = self.pixelFormat.cpixels
+        size = self.pixelFormat.cpixelSize()
 
-        while True:
-            try:
-                subencoding = ord(next(it))
-            except StopIteration:
-                break
+        while pos < end:
+            subencoding = data[pos]
+            pos += 1
 
             # calc tile size
             tw = th = 64
@@ -577,71 +1116,84 @@ class RFBClient(Protocol):
             pixels_in_tile = tw * th
 
             # decode next tile
-            num_pixels = 0
-            pixel_data = bytearray()
             palette_size = subencoding & 127
+            if palette_size:
+                palette = cpixels(data, pos, palette_size)
+                pos += palette_size * size
             if subencoding & 0x80:
-                # RLE
-
-                def do_rle(pixel):
-                    run_length_next = ord(next(it))
-                    run_length = run_length_next
-                    while run_length_next == 255:
-                        run_length_next = ord(next(it))
-                        run_length += run_length_next
-                    pixel_data.extend(pixel * (run_length + 1))
-                    return run_length + 1
-
+                # RLE, collect the runs and expand them in one go
+                run_lengths = []
+                num_pixels = 0
                 if palette_size == 0:
                     # plain RLE
+                    starts = []
                     while num_pixels < pixels_in_tile:
-                        color = bytearray(cpixel(it))
-                        num_pixels += do_rle(color)
-                    if num_pixels != pixels_in_tile:
-                        raise ValueError("too many pixels")
+                        starts.append(pos)
+                        pos += size
+                        value = data[pos]
+                        run_length = value + 1
+                        pos += 1
+                        while value == 255:
+                            value = data[pos]
+                            run_length += value
+                            pos += 1
+                        run_lengths.append(run_length)
+                        num_pixels += run_length
+                    runs = cpixels(np.frombuffer(data, np.uint8)[np.add.outer(starts, range(size))], 0, len(starts))
                 else:
-                    palette = [bytearray(cpixel(it)) for p in range(palette_size)]
-
+                    indices = []
                     while num_pixels < pixels_in_tile:
-                        palette_index = ord(next(it))
+                        palette_index = data[pos]
+                        pos += 1
                         if palette_index & 0x80:
-                            palette_index &= 0x7F
                             # run of length > 1, more bytes follow to determine run length
-                            num_pixels += do_rle(palette[palette_index])
+                            value = data[pos]
+                            run_length = value + 1
+                            pos += 1
+                            while value == 255:
+                                value = data[pos]
+                                run_length += value
+                                pos += 1
+                            indices.append(palette_index & 0x7F)
                         else:
                             # run of length 1
-                            pixel_data.extend(palette[palette_index])
-                            num_pixels += 1
-                    if num_pixels != pixels_in_tile:
-                        raise ValueError("too many pixels")
-
-                self.updateRectangle(tx, ty, tw, th, bytes(pixel_data))
+                            run_length = 1
+                            indices.append(palette_index)
+                        run_lengths.append(run_length)
+                        num_pixels += run_length
+                    runs = palette[indices]
+                if num_pixels != pixels_in_tile:
+                    raise ValueError("too many pixels")
+
+                pixel_data = np.repeat(runs, run_lengths, axis=0)
+                self._drawRectangle(tx, ty, tw, th, pixel_data)
             else:
                 # No RLE
                 if palette_size == 0:
                     # Raw pixel data
-                    pixel_data = b''.join(bytes(cpixel(it)) for _ in range(pixels_in_tile))
-                    self.updateRectangle(tx, ty, tw, th, bytes(pixel_data))
+                    pixel_data = cpixels(data, pos, pixels_in_tile)
+                    pos += pixels_in_tile * size
+                    self._drawRectangle(tx, ty, tw, th, pixel_data)
                 elif palette_size == 1:
                     # Fill tile with plain color
-                    color = bytearray(cpixel(it))
-                    self.fillRectangle(tx, ty, tw, th, bytes(color))
+                    self._fillRectangle(tx, ty, tw, th, palette[0].tobytes())
                 else:
                     if palette_size > 16:
                         raise ValueError(
                             "Palette of size {0} is not allowed".format(palette_size))
 
-                    palette = [bytearray(cpixel(it)) for _ in range(palette_size)]
+                    # packed palette indices, each row padded to a whole byte
                     if palette_size == 2:
-                        next_index = _zrle_next_bit(it, pixels_in_tile)
+                        bits = 1
                     elif palette_size == 3 or palette_size == 4:
-                        next_index = _zrle_next_dibit(it, pixels_in_tile)
+                        bits = 2
                     else:
-                        next_index = _zrle_next_nibble(it, pixels_in_tile)
-
-                    for palette_index in next_index:
-                        pixel_data.extend(palette[palette_index])
-                    self.updateRectangle(tx, ty, tw, th, bytes(pixel_data))
+                        bits = 4
+                    row_bytes = (tw * bits + 7) // 8
+                    packed = np.frombuffer(data, np.uint8, row_bytes * th, pos).reshape(th, row_bytes)
+                    pos += row_bytes * th
+                    indices = _ZRLE_UNPACK[bits][packed].reshape(th, -1)[:, :tw]
+                    self._drawRectangle(tx, ty, tw, th, palette[indices])
 
             # Next tile
             tx = tx + 64
@@ -651,6 +1203,153 @@ class RFBClient(Protocol):
 
         self._doConnection()
 
+    # ---  Tight Encoding
+    # See https://github.com/rfbproto/rfbproto/blob/master/rfbproto.rst#tight-encoding
+
+    def _tightPixelSize(self):
+        """TPIXEL is 3 bytes R, G, B for 24 bit true colour, a pixel otherwise"""
+        if (self.truecolor and self.bpp == 32 and self.depth == 24 and
+                self.redmax == 255 and self.greenmax == 255 and self.bluemax == 255):
+            return 3
+        return self.bypp
+
+    def _tightPixels(self, data, width, height):
+        """TPIXELs to a height x width x 3 array"""
+        if self._tightPixelSize() == 3:
+            return self.pixelFormat.ordered(np.frombuffer(data, np.uint8).reshape(height, width, 3))
+        return self.toPixels(data, width, height)
+
+    def _tightGradient(self, data, width, height):
+        """undo the gradient filter, on the bytes of 3 byte TPIXELs, else
+           on the colour components of the pixel format (16 and 8 bpp)"""
+        if self._tightPixelSize() == 3:
+            return self.pixelFormat.ordered(_tight_gradient(np.frombuffer(data, np.uint8).reshape(height, width, 3)))
+        pf = self.pixelFormat
+        shifts = (pf.redshift, pf.greenshift, pf.blueshift)
+        maxes = (pf.redmax, pf.greenmax, pf.bluemax)
+        values = np.frombuffer(data, pf.dtype, width * height).reshape(height, width).astype(np.uint32)
+        errors = np.stack([(values >> shift) & m for (shift, m) in zip(shifts, maxes)], axis=-1)
+        components = _tight_gradient(errors, maxes).astype(np.uint32)
+        values = (components[..., 0] << shifts[0]) | (components[..., 1] << shifts[1]) | (components[..., 2] << shifts[2])
+        return pf.toPixels(values.astype(pf.dtype).tobytes(), width, height)
+
+    def _handleDecodeTight(self, block, x, y, width, height):
+        (control,) = unpack("!B", block)
+        #lower 4 bits reset the zlib streams
+        for stream in range(4):
+            if control & (1 << stream):
+                self._tight_streams[stream] = zlib.decompressobj()
+        compression = control >> 4
+        if compression == 8:        #FillCompression
+            self.expect(self._handleDecodeTightFill, self._tightPixelSize(), x, y, width, height)
+        elif compression == 9:      #JpegCompression
+            self._expectTightLength(self._handleDecodeTightJPEG, x, y, width, height)
+        elif compression & 8:
+            log.msg("unknown tight compression received (%d)" % compression)
+            self._doConnection()
+        else:                       #BasicCompression
+            stream = compression & 3
+            if compression & 4:     #filter id follows
+                self.expect(self._handleDecodeTightFilter, 1, stream, x, y, width, height)
+            else:
+                self._expectTightData(stream, 0, None, x, y, width, height)
+
+    def _handleDecodeTightFill(self, block, x, y, width, height):
+        self._drawPixels(x, y, width, height, self._tightPixels(block, 1, 1))
+        self._doConnection()
+
+    def _handleDecodeTightJPEG(self, block, x, y, width, height):
+        image = Image.open(io.BytesIO(block))
+        self._drawPixels(x, y, width, height, self.pixelFormat.ordered(np.asarray(image.convert('RGB'))))
+        self._doConnection()
+
+    def _handleDecodeTightFilter(self, block, stream, x, y, width, height):
+        (filter_id,) = unpack("!B", block)
+        if filter_id == 1:      #PaletteFilter
+            self.expect(self._handleDecodeTightPaletteSize, 1, stream, x, y, width, height)
+        elif filter_id in (0, 2):   #CopyFilter, GradientFilter
+            self._expectTightData(stream, filter_id, None, x, y, width, height)
+        else:
+            log.msg("unknown tight filter received (%d)" % filter_id)
+            self._doConnection()
+
+    def _handleDecodeTightPaletteSize(self, block, stream, x, y, width, height):
+        (colors,) = unpack("!B", block)
+        self.expect(self._handleDecodeTightPalette, (colors + 1) * self._tightPixelSize(), stream, x, y, width, height)
+
+    def _handleDecodeTightPalette(self, block, stream, x, y, width, height):
+        palette = self._tightPixels(block, len(block) // self._tightPixelSize(), 1)[0]
+        self._expectTightData(stream, 1, palette, x, y, width, height)
+
+    def _expectTightData(self, stream, filter_id, palette, x, y, width, height):
+        if filter_id == 1:
+            if len(palette) == 2:
+                size = (width + 7) // 8 * height
+            else:
+                size = width * height
+        else:
+            size = width * height * self._tightPixelSize()
+        #less than 12 bytes are sent as they are
+        if size < 12:
+            self.expect(self._handleDecodeTightData, size, None, filter_id, palette, x, y, width, height)
+        else:
+            self._expectTightLength(self._handleDecodeTightData, stream, filter_id, palette, x, y, width, height)
+
+    def _expectTightLength(self, handler, *args):
+        """length as 1 to 3 bytes with 7, 7 and 8 bits, then the data"""
+        self.expect(self._handleTightLength, 1, 0, 0, handler, args)
+
+    def _handleTightLength(self, block, length, shift, handler, args):
+        (value,) = unpack("!B", block)
+        if shift < 14:
+            length |= (value & 0x7f) << shift
+        else:
+            length |= value << shift
+        if value & 0x80 and shift < 14:
+            self.expect(self._handleTightLength, 1, length, shift + 7, handler, args)
+        else:
+            self.expect(handler, length, *args)
+
+    def _handleDecodeTightData(self, block, stream, filter_id, palette, x, y, width, height):
+        if stream is not None:
+            block = self._tight_streams[stream].decompress(block)
+        if filter_id == 1:      #PaletteFilter
+            indices = np.frombuffer(block, np.uint8)
+            if len(palette) == 2:
+                indices = np.unpackbits(indices.reshape(height, -1), axis=1)[:, :width]
+            else:
+                indices = indices.reshape(height, width)
+            pixels = palette[indices]
+        elif filter_id == 2:    #GradientFilter
+            pixels = self._tightGradient(block, width, height)
+        else:
+            pixels = self._tightPixels(block, width, height)
+        self._drawPixels(x, y, width, height, pixels)
+        self._doConnection()
+
+    def _drawRectangle(self, x, y, width, height, data):
+        """draw data in the pixel format set up earlier, straight into
+           the framebuffer if there is one"""
+        fb = self.framebuffer
+        if fb is not None and x + width <= fb.width and y + height <= fb.height:
+            fb.update(x, y, self.toPixels(data, width, height))
+        else:
+            self.updateRectangle(x, y, width, height, bytes(data))
+
+    def _drawPixels(self, x, y, width, height, pixels):
+        """draw a height x width x 3 array, or a single pixel for the
+           whole area. straight into the framebuffer if there is one"""
+        fb = self.framebuffer
+        if fb is not None and x + width <= fb.width and y + height <= fb.height:
+            if pixels.shape[:2] == (1, 1):
+                fb.fill(x, y, width, height, pixels[0, 0])
+            else:
+                fb.update(x, y, pixels)
+        elif pixels.shape[:2] == (1, 1):
+            self.fillRectangle(x, y, width, height, self.pixelFormat.fromPixels(pixels))
+        else:
+            self.updateRectangle(x, y, width, height, self.pixelFormat.fromPixels(pixels))
+
     # --- Pseudo Cursor Encoding
     def _handleDecodePsuedoCursor(self, block, x, y, width, height):
         split = width * height * self.bypp
@@ -659,41 +1358,95 @@ class RFBClient(Protocol):
         self.updateCursor(x, y, width, height, image, mask)
         self._doConnection()
 
+    # --- Pseudo Pointer Position Encoding
+    def _handleDecodePointerPos(self, x, y):
+        self.updatePointerPos(x, y)
+        self._doConnection()
+
     # --- Pseudo Desktop Size Encoding
     def _handleDecodeDesktopSize(self, width, height):
+        self.width, self.height = width, height
         self.updateDesktopSize(width, height)
         self._doConnection()
 
+    # --- Pseudo Extended Desktop Size Encoding
+    def _handleDecodeExtendedDesktopSize(self, block, reason, status, width, height):
+        (screens,) = unpack("!Bxxx", block)
+        self.expect(self._handleDecodeExtendedDesktopSizeScreens, 16 * screens, reason, status, width, height)
+
+    def _handleDecodeExtendedDesktopSizeScreens(self, block, reason, status, width, height):
+        #x is the reason (0 server, 1 this client, 2 other client), y the
+        #status of a SetDesktopSize request, 0 if the size changed
+        if status:
+            log.msg("desktop size change refused (status %d)" % status)
+        else:
+            #(id, x, y, width, height, flags) of each monitor
+            self.screens = [unpack("!IHHHHI", block[n:n + 16]) for n in range(0, len(block), 16)]
+            self.width, self.height = width, height
+            self.updateDesktopSize(width, height)
+        self._doConnection()
+
     # ---  other server messages
 
+    def _handleSetColourMapEntries(self, block):
+        (first, colours) = unpack("!xHH", block)
+        self.expect(self._handleSetColourMapEntriesValue, 6 * colours, first)
+
+    def _handleSetColourMapEntriesValue(self, block, first):
+        self.pixelFormat.setColourMapEntries(first, np.frombuffer(block, ">u2").reshape(-1, 3))
+        self.expect(self._handleConnection, 1)
+
+    def _handleEndOfContinuousUpdates(self):
+        #sent when the server supports the extension (some servers on
+        #every SetEncodings), and when it stops after
+        #enableContinuousUpdates(0). only that one ends them
+        self.continuousUpdatesSupported = True
+        if self._continuousUpdatesStopping:
+            self._continuousUpdatesStopping = False
+            self.continuousUpdates = False
+        self.endOfContinuousUpdates()
+        self.expect(self._handleConnection, 1)
+
+    def _handleFence(self, block):
+        (flags, length) = unpack("!xxxIB", block)
+        self.expect(self._handleFencePayload, length, flags)
+
+    def _handleFencePayload(self, block, flags):
+        self.fenceSupported = True
+        if flags & FENCE_REQUEST:
+            #everything received so far is handled, so all the
+            #ordering the flags ask for is given. send it back
+            self.fence(flags & (FENCE_BLOCK_BEFORE | FENCE_BLOCK_AFTER | FENCE_SYNC_NEXT), bytes(block))
+        self.expect(self._handleConnection, 1)
+
     def _handleServerCutText(self, block):
         (length, ) = unpack("!xxxI", block)
         self.expect(self._handleServerCutTextValue, length)
 
     def _handleServerCutTextValue(self, block):
-        self.copy_text(block)
+        self.copy_text(bytes(block))
         self.expect(self._handleConnection, 1)
 
     #------------------------------------------------------
     # incomming data redirector
     #------------------------------------------------------
-    def dataReceived(self, data):
+    def receiveData(self, data):
         #~ sys.stdout.write(repr(data) + '\n')
         #~ print len(data), ", ", len(self._packet)
+        if self.tap is not None:
+            self.tap.write(data)
         self._packet.append(data)
-        self._packet_len += len(data)
+        self._mark = (timer(), self._packet.consumed)
         self._handler()
+        self._account()
 
     def _handleExpected(self):
-        if self._packet_len >= self._expected_len:
-            buffer = b''.join(self._packet)
-            while len(buffer) >= self._expected_len:
-                self._already_expecting = 1
-                block, buffer = buffer[:self._expected_len], buffer[self._expected_len:]
+        if len(self._packet) >= self._expected_len:
+            self._already_expecting = 1
+            while len(self._packet) >= self._expected_len:
+                block = self._packet.read(self._expected_len)
                 #~ log.msg("handle %r with %r\n" % (block, self._expected_handler.__name__))
                 self._expected_handler(block, *self._expected_args, **self._expected_kwargs)
-            self._packet[:] = [buffer]
-            self._packet_len = len(buffer)
             self._already_expecting = 0
 
     def expect(self, handler, size, *args, **kwargs):
@@ -705,73 +1458,121 @@ class RFBClient(Protocol):
         if not self._already_expecting:
             self._handleExpected()   #just in case that there is already enough data
 
+    #------------------------------------------------------
+    # I/O, the adapters use these
+    #------------------------------------------------------
+    def dataToSend(self):
+        """the bytes to send to the server since the last call"""
+        data = b''.join(self._outgoing)
+        self._outgoing = []
+        return data
+
+    def events(self):
+        """the events since the last call, a list"""
+        events = self._events
+        self._events = []
+        return events
+
+    def _send(self, data):
+        self._outgoing.append(data)
+
+    def _event(self, event):
+        self._events.append(event)
+
+    def _close(self, reason):
+        """the connection should be closed"""
+        self.closed = True
+        self._event(ConnectionClosed(reason))
+
     #------------------------------------------------------
     # client -> server messages
     #------------------------------------------------------
 
     def setPixelFormat(self, bpp=32, depth=24, bigendian=0, truecolor=1, redmax=255, greenmax=255, bluemax=255, redshift=0, greenshift=8, blueshift=16):
         pixformat = pack("!BBBBHHHBBBxxx", bpp, depth, bigendian, truecolor, redmax, greenmax, bluemax, redshift, greenshift, blueshift)
-        self.transport.write(pack("!Bxxx16s", 0, pixformat))
+        self._send(pack("!Bxxx16s", 0, pixformat))
         #rember these settings
         self.bpp, self.depth, self.bigendian, self.truecolor = bpp, depth, bigendian, truecolor
         self.redmax, self.greenmax, self.bluemax = redmax, greenmax, bluemax
         self.redshift, self.greenshift, self.blueshift = redshift, greenshift, blueshift
         self.bypp = self.bpp // 8        #calc bytes per pixel
+        self.pixelFormat = PixelFormat(bpp, depth, bigendian, truecolor, redmax, greenmax, bluemax,
+                                       redshift, greenshift, blueshift, self.channels)
         #~ print self.bypp
 
     def setEncodings(self, list_of_encodings):
-        self.transport.write(pack("!BxH", 2, len(list_of_encodings)))
-        for encoding in list_of_encodings:
-            self.transport.write(pack("!i", encoding))
+        self._send(pack("!BxH", 2, len(list_of_encodings)) +
+                   pack("!%di" % len(list_of_encodings), *list_of_encodings))
 
     def framebufferUpdateRequest(self, x=0, y=0, width=None, height=None, incremental=0):
         if width  is None: width  = self.width - x
         if height is None: height = self.height - y
-        self.transport.write(pack("!BBHHHH", 3, incremental, x, y, width, height))
+        self._send(pack("!BBHHHH", 3, incremental, x, y, width, height))
+
+    def enableContinuousUpdates(self, enable=1, x=0, y=0, width=None, height=None):
+        """let the server send updates of the area as they happen, without
+           framebufferUpdateRequest(). only after the server announced
+           support with endOfContinuousUpdates()"""
+        if width  is None: width  = self.width - x
+        if height is None: height = self.height - y
+        if enable:
+            self.continuousUpdates = True
+            self._continuousUpdatesStopping = False
+        else:
+            self._continuousUpdatesStopping = self.continuousUpdates    # on until the server confirms
+        self._send(pack("!BBHHHH", 150, enable, x, y, width, height))
+
+    def fence(self, flags, payload=b''):
+        """synchronisation point, see the FENCE_ flags.
+           payload is up to 64 bytes the server sends back"""
+        self._send(pack("!BxxxIB", 248, flags, len(payload)) + payload)
 
     def keyEvent(self, key, down=1):
         """For most ordinary keys, the "keysym" is the same as the corresponding ASCII value.
         Other common keys are shown in the KEY_ constants."""
-        self.transport.write(pack("!BBxxI", 4, down, key))
+        self._send(pack("!BBxxI", 4, down, key))
 
     def pointerEvent(self, x, y, buttonmask=0):
         """Indicates either pointer movement or a pointer button press or release. The pointer is
            now at (x-position, y-position), and the current state of buttons 1 to 8 are represented
            by bits 0 to 7 of button-mask respectively, 0 meaning up, 1 meaning down (pressed).
         """
-        self.transport.write(pack("!BBHH", 5, buttonmask, x, y))
+        self._send(pack("!BBHH", 5, buttonmask, x, y))
 
     def clientCutText(self, message):
         """The client has new ASCII text in its cut buffer.
            (aka clipboard)
         """
-        self.transport.write(pack("!BxxxI", 6, len(message)) + message)
+        self._send(pack("!BxxxI", 6, len(message)) + message)
 
     #------------------------------------------------------
     # callbacks
-    # override these in your application
+    # override these in your application, the defaults queue
+    # the events for events()
     #------------------------------------------------------
     def vncConnectionMade(self):
         """connection is initialized and ready.
            typicaly, the pixel format is set here."""
+        self._event(ServerInit(self.width, self.height, self.name, self.pixelFormat))
 
     def vncRequestPassword(self):
         """a password is needed to log on, use sendPassword() to
            send one."""
-        if self.factory.password is None:
-            log.msg("need a password")
-            self.transport.loseConnection()
+        if self.password is None:
+            self._event(PasswordRequired())
             return
-        self.sendPassword(self.factory.password)
+        self.sendPassword(self.password)
 
     def vncAuthFailed(self, reason):
         """called when the authentication failed.
            the connection is closed."""
         log.msg("Cannot connect %s" % reason)
+        self._event(AuthFailed(reason))
 
     def beginUpdate(self):
         """called before a series of updateRectangle(),
            copyRectangle() or fillRectangle()."""
+        self._event(UpdateBegin())
 
     def commitUpdate(self, rectangles=None):
         """called after a series of updateRectangle(), copyRectangle()
@@ -780,35 +1581,110 @@ class RFBClient(Protocol):
            update with FramebufferUpdateRequest(incremental=1).
            argument is a list of tuples (x,y,w,h) with the updated
            rectangles."""
+        self._event(UpdateCommitted(rectangles))
 
     def updateRectangle(self, x, y, width, height, data):
         """new bitmap data. data is a string in the pixel format set
            up earlier."""
+        #data may be a view of the receive buffer
+        self._event(RectangleDecoded(x, y, width, height, bytes(data)))
 
     def copyRectangle(self, srcx, srcy, x, y, width, height):
         """used for copyrect encoding. copy the given rectangle
            (src, srxy, width, height) to the target coords (x,y)"""
+        self._event(RectangleCopied(srcx, srcy, x, y, width, height))
 
     def fillRectangle(self, x, y, width, height, color):
         """fill the area with the color. the color is a string in
            the pixel format set up earlier"""
-        #fallback variant, use update recatngle
-        #override with specialized function for better performance
-        self.updateRectangle(x, y, width, height, color*width*height)
+        self._event(RectangleFilled(x, y, width, height, bytes(color)))
+
+    def toPixels(self, data, width, height):
+        """convert data in the pixel format set up earlier to a
+           height x width x 3 array, channels in the order of self.channels.
+           decoders that support it draw straight into self.framebuffer
+           (a framebuffer.Framebuffer) instead of calling updateRectangle()
+           and fillRectangle(), this is used for the pixel conversion then.
+           the default goes through self.pixelFormat, see PixelFormat."""
+        return self.pixelFormat.toPixels(data, width, height)
 
     def updateCursor(self, x, y, width, height, image, mask):
         """ New cursor, focuses at (x, y)
         """
+        self._event(CursorShape(x, y, width, height, bytes(image), bytes(mask)))
+
+    def updatePointerPos(self, x, y):
+        """ The pointer moved to (x, y), from the PointerPos pseudo
+            encoding. with PSEUDO_CURSOR_ENCODING the server no longer
+            draws the cursor into the screen, this is where it goes.
+        """
+        self._event(PointerPos(x, y))
 
     def updateDesktopSize(self, width, height):
-        """ New desktop size of width*height. """
+        """ New desktop size of width*height, from the DesktopSize or the
+            ExtendedDesktopSize pseudo encoding (then self.screens has the
+            monitor layout). self.width and self.height are already set,
+            resize self.framebuffer here. """
+        self._event(DesktopSize(width, height))
+
+    def endOfContinuousUpdates(self):
+        """the server supports continuous updates, sent once after
+           PSEUDO_CONTINUOUS_UPDATES_ENCODING was in setEncodings(), or
+           it stopped them after enableContinuousUpdates(0). may come
+           again, continuousUpdates tells if they are on.
+           use enableContinuousUpdates() to have updates pushed."""
+        self._event(EndOfContinuousUpdates())
 
     def bell(self):
         """bell"""
+        self._event(Bell())
 
     def copy_text(self, text):
         """The server has new ASCII text in its cut buffer.
            (aka clipboard)"""
+        self._event(CutText(text))
+
+
+class RFBClient(RFBConnection, Protocol):
+    """RFBConnection as a Twisted protocol. the messages are written to
+       the transport right away and the callbacks are the interface, no
+       events are queued. password and shared come from the factory."""
+
+    def __init__(self):
+        RFBConnection.__init__(self)
+
+    def connectionMade(self):
+        self.password = self.factory.password
+        self.shared = self.factory.shared
+
+    def dataReceived(self, data):
+        self.receiveData(data)
+
+    def _send(self, data):
+        self.transport.write(data)
+
+    def _event(self, event):
+        pass
+
+    def _close(self, reason):
+        self.closed = True
+        self.transport.loseConnection()
+
+    def vncRequestPassword(self):
+        """a password is needed to log on, use sendPassword() to
+           send one."""
+        if self.password is None:
+            log.msg("need a password")
+            self._close("need a password")
+            return
+        self.sendPassword(self.password)
+
+    def fillRectangle(self, x, y, width, height, color):
+        """fill the area with the color. the color is a string in
+           the pixel format set up earlier"""
+        #fallback variant, use update recatngle
+        #override with specialized function for better performance
+        self.updateRectangle(x, y, width, height, color*width*height)
 
 class RFBFactory(protocol.ClientFactory):
     """A factory for remote frame buffer connections."""
@@ -816,25 +1692,24 @@ class RFBFactory(protocol.ClientFactory):
     # the class of the protocol to build
     # should be overriden by application to use a derrived class
     protocol = RFBClient
+    # leave the cursor to the server, updateCursor() is then not called
+    nocursor = False
 
     def __init__(self, password = None, shared = 0):
         self.password = password
         self.shared = shared
 
-class RFBDes(pyDes.des):
+#the bits of each byte in reverse order
+_REVERSED = bytes(int('{:08b}'.format(b)[::-1], 2) for b in range(256))
+
+class RFBDes(fastdes.DES):
     def setKey(self, key):
         """RFB protocol for authentication requires client to encrypt
            challenge sent by server with password using DES method. However,
            bits in each byte of the password are put in reverse order before
-           using it as encryption key."""
-        newkey = []
-        for bsrc in key.encode('ascii'):
-            btgt = 0
-            for i in range(8):
-                if bsrc & (1 << i):
-                    btgt = btgt | (1 << 7-i)
-            newkey.append(chr(btgt))
-        super(RFBDes, self).setKey(newkey)
+           using it as encryption key. the key schedule of each password is
+           computed once, see fastdes.schedule()"""
+        super(RFBDes, self).setKey(key.encode('ascii').translate(_REVERSED))
 
 
 # --- test code only, see vncviewer.py
@@ -842,6 +1717,8 @@ class RFBDes(pyDes.des):
 if __name__ == '__main__':
 
     from PIL import Image
+    from twisted.application import internet, service
+    from twisted.internet import reactor
     import msvcrt  # Windows only!
 
     # Init PIL to make sure it will not try to import plugin libraries
@@ -855,6 +1732,7 @@ if __name__ == '__main__':
         def vncConnectionMade(self):
             self.screen = None
             self.cursor = None
+            self.x = self.y = 0
             self.FirstTime = True
             self.image_mode = "RGBX"
 
@@ -900,6 +1778,9 @@ if __name__ == '__main__':
             self.cfocus = x, y
             self.drawCursor()
 
+        def updatePointerPos(self, x, y):
+            self.x, self.y = x, y
+
         def drawCursor(self):
             if not self.cursor:
                 return
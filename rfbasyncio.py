@@ -0,0 +1,100 @@
+"""
+RFB client on asyncio streams.
+
+Runs a rfb.RFBConnection over an asyncio StreamReader/StreamWriter pair,
+the received bytes go to the connection, what it wants to send goes to
+the writer and its events come out of RFBStream.events(). There is no
+reactor, so many sessions can share one event loop (uvloop works too).
+
+    async def record(host):
+        stream = await connect(host, password="secret")
+        async for event in stream.events():
+            if isinstance(event, rfb.ServerInit):
+                stream.connection.setEncodings([rfb.RAW_ENCODING])
+                stream.connection.framebufferUpdateRequest()
+            elif isinstance(event, rfb.UpdateCommitted):
+                stream.connection.framebufferUpdateRequest(incremental=1)
+
+MIT License
+"""
+# flake8: noqa
+
+import asyncio
+
+import rfb
+
+
+class RFBStream(object):
+    """a RFBConnection on an asyncio stream pair"""
+
+    def __init__(self, reader, writer, connection):
+        self.reader = reader
+        self.writer = writer
+        self.connection = connection
+        self.chunksize = 65536      # bytes per read
+
+    async def flush(self):
+        """write what the connection has to send"""
+        data = self.connection.dataToSend()
+        if data:
+            self.writer.write(data)
+            await self.writer.drain()
+
+    async def events(self):
+        """the events of the connection until it is closed. messages
+           queued on the connection in between, like a setEncodings()
+           on ServerInit, are sent before the next read"""
+        try:
+            while not self.connection.closed:
+                await self.flush()
+                data = await self.reader.read(self.chunksize)
+                if not data:
+                    yield rfb.ConnectionClosed("connection lost")
+                    return
+                self.connection.receiveData(data)
+                for event in self.connection.events():
+                    yield event
+            await self.flush()
+        finally:
+            self.close()
+
+    def close(self):
+        self.writer.close()
+
+
+async def connect(host, port=5900, password=None, shared=0, connection_class=rfb.RFBConnection):
+    """open a connection to a VNC server, returns a RFBStream"""
+    (reader, writer) = await asyncio.open_connection(host, port)
+    return RFBStream(reader, writer, connection_class(password, shared))
+
+
+# --- test code only, prints the events of a session
+
+if __name__ == '__main__':
+    import sys
+
+    async def main(host, port, password):
+        stream = await connect(host, port, password)
+        updates = 0
+        async for event in stream.events():
+            if isinstance(event, (rfb.RectangleDecoded, rfb.RectangleFilled)):
+                continue    # too many
+            print(event)
+            if isinstance(event, rfb.ServerInit):
+                stream.connection.setEncodings([rfb.ZRLE_ENCODING, rfb.COPY_RECTANGLE_ENCODING, rfb.RAW_ENCODING])
+                stream.connection.framebufferUpdateRequest()
+            elif isinstance(event, rfb.UpdateCommitted):
+                updates += 1
+                if updates == 10:
+                    break
+                stream.connection.framebufferUpdateRequest(incremental=1)
+
+    try:
+        import uvloop
+        uvloop.install()
+    except ImportError:
+        pass
+    host = sys.argv[1] if len(sys.argv) > 1 else "localhost"
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 5900
+    password = sys.argv[3] if len(sys.argv) > 3 else None
+    asyncio.get_event_loop().run_until_complete(main(host, port, password))
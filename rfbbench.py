@@ -0,0 +1,335 @@
+#!/usr/bin/python
+#
+# Benchmarks for the RFB client decoders in rfb.py
+#
+# Feeds synthetic server streams (see rfbsynth.py) into a RFBConnection in
+# socket sized chunks, no reactor or network involved, and reports the
+# parse rate in bytes per second.
+#
+# python rfbbench.py -e raw hextile zrle -W 1920 -H 1080 -n 5
+#
+
+import sys
+import struct
+import argparse
+from timeit import default_timer as timer
+import rfb
+import rfbsynth
+from framebuffer import Framebuffer
+
+ENCODINGS = {
+    'raw': rfb.RAW_ENCODING,
+    'hextile': rfb.HEXTILE_ENCODING,
+    'zlib': rfb.ZLIB_ENCODING,
+    'zlibhex': rfb.ZLIBHEX_ENCODING,
+    'zrle': rfb.ZRLE_ENCODING,
+    'tight': rfb.TIGHT_ENCODING,
+    'tight-jpeg': rfb.TIGHT_ENCODING,
+}
+
+#lossy encodings, decoded screen is not compared on --verify
+JPEG_QUALITY = {
+    'tight-jpeg': 75,
+}
+
+
+class BenchClient(rfb.RFBConnection):
+    """client that decodes everything into a framebuffer"""
+
+    def vncConnectionMade(self):
+        self.updates = 0
+        self.framebuffer = Framebuffer(self.width, self.height)
+
+    def commitUpdate(self, rectangles=None):
+        self.updates += 1
+
+    def updateRectangle(self, x, y, width, height, data):
+        self.framebuffer.update(x, y, self.toPixels(data, width, height))
+
+    def fillRectangle(self, x, y, width, height, color):
+        self.framebuffer.fill(x, y, width, height, self.toPixels(color, 1, 1)[0, 0])
+
+    def copyRectangle(self, srcx, srcy, x, y, width, height):
+        self.framebuffer.copy(srcx, srcy, x, y, width, height)
+
+
+class RecordingClient(BenchClient):
+    """keeps every drawing callback, to compare decoders"""
+
+    def vncConnectionMade(self):
+        BenchClient.vncConnectionMade(self)
+        self.framebuffer = None
+        self.drawn = []
+
+    def updateRectangle(self, x, y, width, height, data):
+        self.drawn.append(('update', x, y, width, height, bytes(data)))
+
+    def fillRectangle(self, x, y, width, height, color):
+        self.drawn.append(('fill', x, y, width, height, bytes(color)))
+
+
+# --- reference ZRLE decoder, the pure python version that was replaced by
+# the numpy decoder in rfb.py. Used for the before/after numbers and to
+# check that the output is the same.
+
+def _zrle_next_index(it, pixels_in_tile, bits):
+    num_pixels = 0
+    mask = (1 << bits) - 1
+    while True:
+        b = next(it)
+        for n in range(0, 8, bits):
+            yield (b >> (8 - bits - n)) & mask
+            num_pixels += 1
+            if num_pixels == pixels_in_tile:
+                return
+
+
+class ReferenceZRLEMixin(object):
+
+    def _handleDecodeZRLEdata(self, block, x, y, width, height):
+        tx = x
+        ty = y
+
+        data = self._zlib_stream.decompress(block)
+        it = iter(data)
+
+        def cpixel(i):
+            yield next(i)
+            yield next(i)
+            yield next(i)
+            # Alpha channel
+            yield 0xff
+
+        while True:
+            try:
+                subencoding = next(it)
+            except StopIteration:
+                break
+
+            # calc tile size
+            tw = th = 64
+            if x + width - tx < 64:
+                tw = x + width - tx
+            if y + height - ty < 64:
+                th = y + height - ty
+
+            pixels_in_tile = tw * th
+
+            # decode next tile
+            num_pixels = 0
+            pixel_data = bytearray()
+            palette_size = subencoding & 127
+            if subencoding & 0x80:
+                # RLE
+
+                def do_rle(pixel):
+                    run_length_next = next(it)
+                    run_length = run_length_next
+                    while run_length_next == 255:
+                        run_length_next = next(it)
+                        run_length += run_length_next
+                    pixel_data.extend(pixel * (run_length + 1))
+                    return run_length + 1
+
+                if palette_size == 0:
+                    # plain RLE
+                    while num_pixels < pixels_in_tile:
+                        color = bytearray(cpixel(it))
+                        num_pixels += do_rle(color)
+                    if num_pixels != pixels_in_tile:
+                        raise ValueError("too many pixels")
+                else:
+                    palette = [bytearray(cpixel(it)) for p in range(palette_size)]
+
+                    while num_pixels < pixels_in_tile:
+                        palette_index = next(it)
+                        if palette_index & 0x80:
+                            palette_index &= 0x7F
+                            # run of length > 1, more bytes follow to determine run length
+                            num_pixels += do_rle(palette[palette_index])
+                        else:
+                            # run of length 1
+                            pixel_data.extend(palette[palette_index])
+                            num_pixels += 1
+                    if num_pixels != pixels_in_tile:
+                        raise ValueError("too many pixels")
+
+                self.updateRectangle(tx, ty, tw, th, bytes(pixel_data))
+            else:
+                # No RLE
+                if palette_size == 0:
+                    # Raw pixel data
+                    pixel_data = b''.join(bytes(cpixel(it)) for _ in range(pixels_in_tile))
+                    self.updateRectangle(tx, ty, tw, th, bytes(pixel_data))
+                elif palette_size == 1:
+                    # Fill tile with plain color
+                    color = bytearray(cpixel(it))
+                    self.fillRectangle(tx, ty, tw, th, bytes(color))
+                else:
+                    if palette_size > 16:
+                        raise ValueError(
+                            "Palette of size {0} is not allowed".format(palette_size))
+
+                    palette = [bytearray(cpixel(it)) for _ in range(palette_size)]
+                    if palette_size == 2:
+                        bits = 1
+                    elif palette_size == 3 or palette_size == 4:
+                        bits = 2
+                    else:
+                        bits = 4
+
+                    for palette_index in _zrle_next_index(it, pixels_in_tile, bits):
+                        pixel_data.extend(palette[palette_index])
+                    self.updateRectangle(tx, ty, tw, th, bytes(pixel_data))
+
+            # Next tile
+            tx = tx + 64
+            if tx >= x + width:
+                tx = x
+                ty = ty + 64
+
+        self._doConnection()
+
+
+class ReferenceZRLEClient(ReferenceZRLEMixin, BenchClient):
+    pass
+
+
+class ReferenceZRLERecordingClient(ReferenceZRLEMixin, RecordingClient):
+    pass
+
+
+# --- reference RRE/CoRRE decoders, one unpack() and fillRectangle() per
+# subrect as before the numpy version (with the CoRRE loop fixed).
+
+class ReferenceRREClient(BenchClient):
+
+    def vncConnectionMade(self):
+        BenchClient.vncConnectionMade(self)
+        self.framebuffer = None
+        self.screen = Framebuffer(self.width, self.height)
+
+    def updateRectangle(self, x, y, width, height, data):
+        self.screen.update(x, y, self.toPixels(data, width, height))
+
+    def fillRectangle(self, x, y, width, height, color):
+        self.screen.fill(x, y, width, height, self.toPixels(color, 1, 1)[0, 0])
+
+    def _handleRRESubRectangles(self, block, topx, topy, width, height):
+        self._referenceSubrects(block, "!%dsHHHH" % self.bypp, 8, topx, topy)
+
+    def _handleDecodeCORRERectangles(self, block, topx, topy, width, height):
+        self._referenceSubrects(block, "!%dsBBBB" % self.bypp, 4, topx, topy)
+
+    def _referenceSubrects(self, block, format, coords, topx, topy):
+        pos = 0
+        end = len(block)
+        sz = self.bypp + coords
+        while pos < end:
+            (color, x, y, width, height) = struct.unpack(format, block[pos:pos+sz])
+            self.fillRectangle(topx + x, topy + y, width, height, color)
+            pos += sz
+        self._doConnection()
+
+
+def make_client(client_class=BenchClient):
+    return client_class()
+
+
+def feed(client, stream, chunksize):
+    """feed the whole stream, return the seconds spent in the client.
+       the version greeting is sent on its own, as a server waits for
+       the client version before it continues"""
+    view = memoryview(stream)
+    start = timer()
+    client.receiveData(view[:12].tobytes())
+    for pos in range(12, len(stream), chunksize):
+        client.receiveData(view[pos:pos + chunksize].tobytes())
+        client.dataToSend()
+        client.events()
+    return timer() - start
+
+
+def bench_stream(name, stream, frames, chunksize, repeat, client_class=BenchClient):
+    best = None
+    for n in range(repeat):
+        client = make_client(client_class)
+        seconds = feed(client, stream, chunksize)
+        if client.updates != frames:
+            raise RuntimeError("%s: decoded %d of %d updates" % (name, client.updates, frames))
+        if best is None or seconds < best:
+            best = seconds
+    print("%-10s %12d bytes %10.3f s %10.1f MB/s %8.1f fps" % (
+        name, len(stream), best, len(stream) / best / 1e6, frames / best))
+    sys.stdout.flush()
+    return best
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="RFB client decoder benchmark")
+    parser.add_argument("-e", dest='encodings', nargs='+', default=list(ENCODINGS), choices=list(ENCODINGS), help="Encodings to run")
+    parser.add_argument("-W", dest='width', default=1920, type=int, help="Screen width")
+    parser.add_argument("-H", dest='height', default=1080, type=int, help="Screen height")
+    parser.add_argument("-n", dest='frames', default=5, type=int, help="Number of full screen updates")
+    parser.add_argument("-b", dest='bpp', default=32, type=int, choices=sorted(rfbsynth.PIXEL_FORMATS), help="Bits per pixel")
+    parser.add_argument("-c", dest='chunksize', default=65536, type=int, help="Bytes per dataReceived() call")
+    parser.add_argument("-r", dest='repeat', default=3, type=int, help="Repeats, the best run is reported")
+    parser.add_argument("--verify", action='store_true', help="Check the decoder output against the reference decoders")
+    parser.add_argument("--subrects", type=int, help="RRE/CoRRE with this many random subrects per update instead")
+    parser.add_argument("--subrect-size", dest='subrectsize', default=32, type=int, help="Maximum width and height of the subrects")
+    args = parser.parse_args(argv)
+
+    if args.subrects:
+        return bench_subrects(args)
+
+    print("%dx%d, %d bpp, %d updates, %d byte chunks" % (args.width, args.height, args.bpp, args.frames, args.chunksize))
+    for name in args.encodings:
+        stream = rfbsynth.stream(ENCODINGS[name], args.width, args.height, args.frames,
+                                 quality=JPEG_QUALITY.get(name), bpp=args.bpp)
+        bench_stream(name, stream, args.frames, args.chunksize, args.repeat)
+        if args.verify and name not in JPEG_QUALITY:
+            verify_screen(name, stream, rfbsynth.screen(rfbsynth.frame(args.width, args.height, args.frames - 1), args.bpp),
+                          args.chunksize)
+        if name == 'zrle' and args.bpp == 32:
+            #the reference decoder only knows 3 byte CPIXELs
+            bench_stream('zrle-ref', stream, args.frames, args.chunksize, args.repeat, ReferenceZRLEClient)
+            if args.verify:
+                verify_zrle(stream, args.chunksize)
+
+
+def bench_subrects(args):
+    print("%dx%d, %d updates of %d subrects up to %dx%d, %d byte chunks" % (
+        args.width, args.height, args.frames, args.subrects, args.subrectsize, args.subrectsize, args.chunksize))
+    for (name, encoding) in (('rre', rfb.RRE_ENCODING), ('corre', rfb.CORRE_ENCODING)):
+        (stream, image) = rfbsynth.subrect_stream(encoding, args.width, args.height, args.frames, args.subrects,
+                                                 size=args.subrectsize)
+        bench_stream(name, stream, args.frames, args.chunksize, args.repeat)
+        bench_stream(name + '-ref', stream, args.frames, args.chunksize, args.repeat, ReferenceRREClient)
+        if args.verify:
+            verify_screen(name, stream, image, args.chunksize)
+            verify_screen(name + '-callbacks', stream, image, args.chunksize, ReferenceRREClient)
+
+
+def verify_screen(name, stream, image, chunksize, client_class=BenchClient):
+    """the decoded screen has to match the last image sent"""
+    client = make_client(client_class)
+    feed(client, stream, chunksize)
+    screen = client.framebuffer or client.screen
+    if not (screen.array == image[:, :, :3]).all():
+        raise RuntimeError("%s: decoded screen differs from the image sent" % name)
+    print("%s: decoded screen is identical to the image sent" % name)
+
+
+def verify_zrle(stream, chunksize):
+    """the numpy ZRLE decoder has to draw exactly what the reference does"""
+    client = make_client(RecordingClient)
+    feed(client, stream, chunksize)
+    reference = make_client(ReferenceZRLERecordingClient)
+    feed(reference, stream, chunksize)
+    if client.drawn != reference.drawn:
+        raise RuntimeError("zrle: output differs from reference decoder")
+    print("zrle: %d tiles identical to reference decoder" % len(client.drawn))
+
+
+if __name__ == '__main__':
+    main()
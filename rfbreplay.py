@@ -0,0 +1,158 @@
+#!/usr/bin/python
+#
+# Record and replay RFB server streams
+#
+# A capture is what a server sent, with the time it arrived:
+#
+#   header  b"RFBCAP01"
+#   chunk   !dI seconds since the start and length, then the bytes
+#
+# gzip compressed when the file name ends with .gz. Set a StreamTap as
+# RFBConnection.tap to record one (RemoteCapture.py -tap), replay it
+# into a client without a server or reactor:
+#
+# python rfbreplay.py captures/zrle.rfbcap.gz          as fast as possible
+# python rfbreplay.py -s 1 session.rfbcap              at the recorded speed
+# python rfbreplay.py --fixtures captures              write the synthetic captures
+#
+
+import os
+import sys
+import gzip
+import time
+import struct
+import argparse
+from timeit import default_timer as timer
+import rfb
+import rfbsynth
+from rfbbench import BenchClient
+from encodingselect import name as encodingname
+
+MAGIC = b"RFBCAP01"
+CHUNK = struct.Struct("!dI")
+
+#synthetic captures: name -> (encoding, scrolling)
+FIXTURES = {
+    'raw': (rfb.RAW_ENCODING, False),
+    'hextile': (rfb.HEXTILE_ENCODING, False),
+    'zrle': (rfb.ZRLE_ENCODING, False),
+    'copyrect-scroll': (rfb.HEXTILE_ENCODING, True),
+}
+
+
+def _open(path, mode):
+    if path.endswith('.gz'):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+
+class StreamTap(object):
+    """writes the bytes a client receives to a capture file"""
+
+    def __init__(self, path):
+        self._file = _open(path, 'wb')
+        self._file.write(MAGIC)
+        self._start = timer()
+
+    def write(self, data):
+        self._file.write(CHUNK.pack(timer() - self._start, len(data)))
+        self._file.write(data)
+
+    def close(self):
+        self._file.close()
+
+
+def write_capture(path, chunks):
+    """write a capture of (seconds, data) chunks"""
+    with _open(path, 'wb') as f:
+        f.write(MAGIC)
+        for (seconds, data) in chunks:
+            f.write(CHUNK.pack(seconds, len(data)))
+            f.write(data)
+
+
+def read_capture(path):
+    """the (seconds, data) chunks of a capture"""
+    with _open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a RFB capture" % path)
+        while True:
+            header = f.read(CHUNK.size)
+            if len(header) < CHUNK.size:
+                return
+            (seconds, length) = CHUNK.unpack(header)
+            yield (seconds, f.read(length))
+
+
+def replay(path, client_class=BenchClient, speed=None):
+    """feed a capture into a new client_class(), at speed times the
+       recorded speed or as fast as possible with None.
+       returns the client, the seconds and the bytes.
+       the capture is read first, reading and unzipping is not timed"""
+    chunks = list(read_capture(path))
+    client = client_class()
+    size = 0
+    start = timer()
+    for (seconds, data) in chunks:
+        if speed:
+            wait = start + seconds / speed - timer()
+            if wait > 0:
+                time.sleep(wait)
+        client.receiveData(data)
+        client.dataToSend()
+        client.events()
+        size += len(data)
+    return client, timer() - start, size
+
+
+def report(name, client, seconds, size):
+    print("%-16s %5d frames %7.1f fps %8.1f MB/s %8.3f s" % (
+        name, client.updates, client.updates / seconds, size / seconds / 1e6, seconds))
+    for (encoding, (rectangles, pixels, nbytes, decode)) in sorted(client.encodingStats.items()):
+        print("  %-14s %7d rects %8.2f Mpixel %10d bytes %8.3f s decode %7.1f ns/pixel" % (
+            encodingname(encoding), rectangles, pixels / 1e6, nbytes, decode,
+            decode / pixels * 1e9 if pixels else 0))
+
+
+def fixture_chunks(encoding, scrolling, width=320, height=240, frames=10, fps=10.0, chunksize=65536):
+    """a synthetic session as (seconds, data) chunks, the handshake at the
+       start and one update every 1/fps seconds, in socket sized pieces"""
+    if scrolling:
+        messages = rfbsynth.scroll_updates(encoding, width, height, frames)
+    else:
+        messages = rfbsynth.updates(encoding, width, height, frames)
+    #a server waits for the client version after sending its own
+    handshake = rfbsynth.server_handshake(width, height)
+    chunks = [(0.0, handshake[:12]), (0.0, handshake[12:])]
+    for (n, message) in enumerate(messages):
+        for pos in range(0, len(message), chunksize):
+            chunks.append(((n + 1) / fps, message[pos:pos + chunksize]))
+    return chunks
+
+
+def write_fixtures(folder):
+    for (name, (encoding, scrolling)) in FIXTURES.items():
+        path = os.path.join(folder, name + '.rfbcap.gz')
+        write_capture(path, fixture_chunks(encoding, scrolling))
+        print("%s %d bytes" % (path, os.path.getsize(path)))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay RFB server captures")
+    parser.add_argument("captures", nargs='*', help="Capture files")
+    parser.add_argument("-s", dest='speed', default=None, type=float,
+                        help="Replay at this times the recorded speed, default as fast as possible")
+    parser.add_argument("--fixtures", dest='fixtures', default=None,
+                        help="Write the synthetic captures to this folder")
+    args = parser.parse_args()
+
+    if args.fixtures:
+        write_fixtures(args.fixtures)
+    for path in args.captures:
+        (client, seconds, size) = replay(path, speed=args.speed)
+        report(os.path.basename(path), client, seconds, size)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,640 @@
+"""
+Synthetic RFB server streams.
+
+Builds the server side of a RFB session (handshake, ServerInit and
+FramebufferUpdate messages) from numpy images, so that the client
+decoders in rfb.py can be exercised and benchmarked without a live
+VNC server.
+
+Images are HxWx4 uint8 arrays in the client default pixel format
+(32 bpp, depth 24, little endian, red/green/blue shift 0/8/16), that is
+the bytes of a pixel are R, G, B, X. For 16 and 8 bpp streams they are
+converted to HxWx2 or HxWx1 arrays in the formats of PIXEL_FORMATS.
+
+MIT License
+"""
+# flake8: noqa
+
+import io
+import zlib
+from struct import pack
+import numpy as np
+from PIL import Image
+import rfb
+
+#pixel formats by bits per pixel: bpp, depth, bigendian, truecolor,
+#red/green/blue max and red/green/blue shift. 32 is the same as the
+#RFBClient.setPixelFormat() defaults, 16 is RGB565 and 8 is BGR233
+PIXEL_FORMATS = {
+    32: (32, 24, 0, 1, 255, 255, 255, 0, 8, 16),
+    16: (16, 16, 0, 1, 31, 63, 31, 11, 5, 0),
+    8: (8, 8, 0, 1, 7, 7, 3, 0, 3, 6),
+}
+
+#pixel format as sent in ServerInit
+PIXEL_FORMAT = pack("!BBBBHHHBBBxxx", *PIXEL_FORMATS[32])
+
+
+def pixel_format(bpp=32):
+    return rfb.PixelFormat(*PIXEL_FORMATS[bpp])
+
+
+def to_format(img, bpp):
+    """HxWx4 image to HxWx(bpp/8) pixels in PIXEL_FORMATS[bpp]"""
+    if bpp == 32:
+        return img
+    height, width = img.shape[:2]
+    data = pixel_format(bpp).fromPixels(img[:, :, :3])
+    return np.frombuffer(data, np.uint8).reshape(height, width, bpp // 8)
+
+
+def screen(img, bpp=32):
+    """what the client shows for img sent with bpp bits per pixel, RGB"""
+    height, width = img.shape[:2]
+    return pixel_format(bpp).toPixels(to_format(img, bpp).tobytes(), width, height)
+
+
+def server_handshake(width, height, name=b"synthetic", bpp=32):
+    """version, 'no authentication' (RFB 3.3) and ServerInit"""
+    return (b"RFB 003.003\n" +
+            pack("!I", 1) +
+            pack("!HH16sI", width, height, pack("!BBBBHHHBBBxxx", *PIXEL_FORMATS[bpp]), len(name)) + name)
+
+
+def _values(pixels):
+    """the pixel values of a (..., bypp) array of little endian pixels"""
+    values = np.zeros(pixels.shape[:-1], dtype=np.uint32)
+    for n in range(pixels.shape[-1]):
+        values |= pixels[..., n].astype(np.uint32) << (8 * n)
+    return values
+
+
+def _pixel(value, bypp):
+    """bytes of a pixel value"""
+    return np.array([value], dtype="<u4").view(np.uint8)[:bypp].tobytes()
+
+
+def framebuffer_update(rectangles):
+    """FramebufferUpdate message.
+       rectangles is a list of (x, y, width, height, encoding, payload)"""
+    parts = [pack("!BxH", 0, len(rectangles))]
+    for (x, y, width, height, encoding, payload) in rectangles:
+        parts.append(pack("!HHHHi", x, y, width, height, encoding))
+        parts.append(payload)
+    return b''.join(parts)
+
+
+def end_of_continuous_updates():
+    """EndOfContinuousUpdates, also tells the client the server supports them"""
+    return pack("!B", 150)
+
+
+def fence(flags, payload=b''):
+    """Fence message"""
+    return pack("!BxxxIB", 248, flags, len(payload)) + payload
+
+
+def desktop(width, height, seed=0):
+    """a desktop like test image: flat background, a few windows with
+       'text' and a noisy video area"""
+    rnd = np.random.RandomState(seed)
+    img = np.empty((height, width, 4), dtype=np.uint8)
+    img[:, :] = (58, 110, 165, 255)
+    #task bar
+    img[-40:, :] = (32, 32, 32, 255)
+    for n in range(6):
+        wx = rnd.randint(0, max(1, width - width // 3))
+        wy = rnd.randint(0, max(1, height - height // 3))
+        ww = rnd.randint(width // 6, width // 3 + 1)
+        wh = rnd.randint(height // 6, height // 3 + 1)
+        img[wy:wy + wh, wx:wx + ww] = (240, 240, 240, 255)
+        img[wy:wy + 24, wx:wx + ww] = (0, 84, 166, 255)
+        #text lines, two colour glyph blocks
+        text = img[wy + 30:wy + wh - 4, wx + 4:wx + ww - 4]
+        glyphs = rnd.randint(0, 5, size=text.shape[:2]) == 0
+        glyphs[np.arange(text.shape[0]) % 16 >= 10] = False
+        text[glyphs] = (0, 0, 0, 255)
+    #video area
+    vh, vw = height // 4, width // 4
+    img[height // 2:height // 2 + vh, width // 2:width // 2 + vw, :3] = \
+        rnd.randint(0, 256, size=(vh, vw, 3))
+    return img
+
+
+def _cpixel(pixel):
+    """a 32 bpp pixel without the unused byte, other pixels as they are"""
+    if len(pixel) == 4:
+        return bytes(pixel[:3])
+    return bytes(pixel)
+
+
+# --- RAW
+
+def encode_raw(img):
+    return img.tobytes()
+
+
+# --- CopyRect
+
+def encode_copyrect(srcx, srcy):
+    return pack("!HH", srcx, srcy)
+
+
+# --- RRE, CoRRE
+
+def subrects(width, height, count, seed=0, size=32):
+    """background pixel and count random subrects (pixel, x, y, w, h)
+       inside width x height, at most size pixels wide and high"""
+    rnd = np.random.RandomState(seed)
+    bg = np.append(rnd.randint(0, 256, 3), 255).astype(np.uint8)
+    pixels = rnd.randint(0, 256, size=(count, 4)).astype(np.uint8)
+    pixels[:, 3] = 255
+    w = rnd.randint(1, min(size, width) + 1, count)
+    h = rnd.randint(1, min(size, height) + 1, count)
+    x = rnd.randint(0, width - w + 1)
+    y = rnd.randint(0, height - h + 1)
+    return bg, list(zip(pixels, x.tolist(), y.tolist(), w.tolist(), h.tolist()))
+
+
+def draw_subrects(img, bg, rects):
+    """what the client should show, one subrect after the other"""
+    img[:, :] = bg
+    for (pixel, x, y, w, h) in rects:
+        img[y:y + h, x:x + w] = pixel
+    return img
+
+
+def encode_rre(bg, rects, compact=False):
+    """RRE payload, CoRRE with compact (all coordinates below 256)"""
+    coord = "!BBBB" if compact else "!HHHH"
+    parts = [pack("!I", len(rects)), bytes(bg)]
+    for (pixel, x, y, w, h) in rects:
+        parts.append(bytes(pixel))
+        parts.append(pack(coord, x, y, w, h))
+    return b''.join(parts)
+
+
+def subrect_stream(encoding, width, height, frames, count, seed=0, size=32):
+    """handshake plus frames updates of count random subrects each. RRE
+       sends one rectangle for the screen, CoRRE one per 255x255 tile.
+       returns the stream and the last screen"""
+    parts = [server_handshake(width, height)]
+    img = np.empty((height, width, 4), dtype=np.uint8)
+    tile = 255 if encoding == rfb.CORRE_ENCODING else max(width, height)
+    tiles = [(tx, ty, min(tile, width - tx), min(tile, height - ty))
+             for ty in range(0, height, tile) for tx in range(0, width, tile)]
+    for n in range(frames):
+        rectangles = []
+        for (i, (tx, ty, tw, th)) in enumerate(tiles):
+            share = count // len(tiles) + (i < count % len(tiles))
+            (bg, rects) = subrects(tw, th, share, seed + n * len(tiles) + i, size)
+            draw_subrects(img[ty:ty + th, tx:tx + tw], bg, rects)
+            payload = encode_rre(bg, rects, encoding == rfb.CORRE_ENCODING)
+            rectangles.append((tx, ty, tw, th, encoding, payload))
+        parts.append(framebuffer_update(rectangles))
+    return b''.join(parts), img
+
+
+# --- Hextile
+
+def _row_runs(mask):
+    """(x, y, w, 1) runs of True in a 2d mask, one list entry per run"""
+    runs = []
+    for sy, row in enumerate(mask):
+        sx = 0
+        width = len(row)
+        while sx < width:
+            if row[sx]:
+                ex = sx + 1
+                while ex < width and ex - sx < 16 and row[ex]:
+                    ex += 1
+                runs.append((sx, sy, ex - sx, 1))
+                sx = ex
+            else:
+                sx += 1
+    return runs
+
+
+def encode_hextile(img):
+    """Hextile payload of a whole image, always with background specified"""
+    return b''.join(hextile_tiles(img))
+
+
+def hextile_tiles(img):
+    """the Hextile tiles of an image, line after line"""
+    height, width = img.shape[:2]
+    bypp = img.shape[2]
+    parts = []
+    for ty in range(0, height, 16):
+        for tx in range(0, width, 16):
+            tile = img[ty:ty + 16, tx:tx + 16]
+            th, tw = tile.shape[:2]
+            flat = tile.reshape(-1, bypp)
+            colors, counts = np.unique(_values(flat), return_counts=True)
+            bg = colors[np.argmax(counts)]
+            bgpix = _pixel(bg, bypp)
+            if len(colors) == 1:
+                parts.append(pack("!B", 2) + bgpix)
+                continue
+            raw = pack("!B", 1) + tile.tobytes()
+            pixels = _values(tile)
+            runs = _row_runs(pixels != bg)
+            if len(colors) == 2:
+                fg = colors[colors != bg][0]
+                fgpix = _pixel(fg, bypp)
+                body = b''.join(pack("!BB", (sx << 4) | sy, ((sw - 1) << 4) | (sh - 1))
+                                for (sx, sy, sw, sh) in runs)
+                encoded = pack("!B", 2 | 4 | 8) + bgpix + fgpix + \
+                          pack("!B", len(runs)) + body
+            else:
+                #split runs on colour changes
+                coloured = []
+                for (sx, sy, sw, sh) in runs:
+                    start = sx
+                    for px in range(sx + 1, sx + sw + 1):
+                        if px == sx + sw or pixels[sy, px] != pixels[sy, start]:
+                            coloured.append((start, sy, px - start, pixels[sy, start]))
+                            start = px
+                body = b''.join(_pixel(c, bypp) + pack("!BB", (sx << 4) | sy, (sw - 1) << 4)
+                                for (sx, sy, sw, c) in coloured)
+                runs = coloured
+                encoded = pack("!B", 2 | 8 | 16) + bgpix + \
+                          pack("!B", len(runs)) + body
+            if len(runs) > 255 or len(encoded) >= len(raw):
+                parts.append(raw)
+            else:
+                parts.append(encoded)
+    return parts
+
+
+# --- Zlib
+
+class ZlibEncoder(object):
+    """raw pixel data through one zlib stream for the connection"""
+
+    def __init__(self, level=6):
+        self._zlib = zlib.compressobj(level)
+
+    def encode(self, img):
+        return self.compress(img.tobytes())
+
+    def compress(self, data):
+        data = self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+        return pack("!L", len(data)) + data
+
+
+# --- ZlibHex
+
+class ZlibHexEncoder(object):
+    """Hextile with raw tiles (0x20) and larger encoded tiles (0x40)
+       compressed, each with its own zlib stream"""
+
+    def __init__(self, level=6):
+        self._raw = zlib.compressobj(level)
+        self._encoded = zlib.compressobj(level)
+
+    def encode(self, img):
+        return self.encode_tiles(hextile_tiles(img))
+
+    def encode_tiles(self, tiles):
+        """the payload of hextile_tiles()"""
+        parts = []
+        for tile in tiles:
+            subencoding = tile[0]
+            if subencoding & 1:
+                data = self._raw.compress(tile[1:]) + self._raw.flush(zlib.Z_SYNC_FLUSH)
+                parts.append(pack("!BH", 0x20, len(data)) + data)
+            elif len(tile) > 16:
+                data = self._encoded.compress(tile[1:]) + self._encoded.flush(zlib.Z_SYNC_FLUSH)
+                parts.append(pack("!BH", subencoding | 0x40, len(data)) + data)
+            else:
+                parts.append(tile)
+        return b''.join(parts)
+
+
+# --- ZRLE
+
+def _rle_length(length):
+    """run length as (length-1) in 255 steps"""
+    length -= 1
+    return b'\xff' * (length // 255) + pack("!B", length % 255)
+
+
+class ZRLEEncoder(object):
+    """ZRLE uses one zlib stream for the whole connection"""
+
+    def __init__(self, level=6):
+        self._zlib = zlib.compressobj(level)
+
+    def encode(self, img):
+        return self.compress(self.tiles(img))
+
+    def tiles(self, img):
+        """the uncompressed tile data, does not depend on the stream"""
+        height, width = img.shape[:2]
+        parts = []
+        for ty in range(0, height, 64):
+            for tx in range(0, width, 64):
+                parts.append(self._tile(img[ty:ty + 64, tx:tx + 64]))
+        return b''.join(parts)
+
+    def compress(self, data):
+        data = self._zlib.compress(data) + self._zlib.flush(zlib.Z_SYNC_FLUSH)
+        return pack("!L", len(data)) + data
+
+    def _tile(self, tile):
+        th, tw, bypp = tile.shape
+        pixels = _values(tile)
+        flat = pixels.ravel()
+        colors, first = np.unique(flat, return_index=True)
+        colors = flat[np.sort(first)]
+        cpixels = [_cpixel(_pixel(c, bypp)) for c in colors]
+        if len(colors) == 1:
+            return pack("!B", 1) + cpixels[0]
+
+        #run lengths
+        change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+        starts = np.concatenate(([0], change))
+        lengths = np.diff(np.concatenate((starts, [len(flat)])))
+        candidates = [pack("!B", 0) + (tile[:, :, :3] if bypp == 4 else tile).tobytes()]
+
+        order = np.argsort(colors)
+        indices = order[np.searchsorted(colors[order], pixels)].astype(np.uint8)
+
+        if len(colors) <= 16:
+            bits = 1 if len(colors) == 2 else 2 if len(colors) <= 4 else 4
+            per_byte = 8 // bits
+            padded = np.zeros((th, -(-tw // per_byte) * per_byte), dtype=np.uint8)
+            padded[:, :tw] = indices
+            shifts = np.arange(8 - bits, -1, -bits, dtype=np.uint8)
+            packed = (padded.reshape(th, -1, per_byte) << shifts).sum(axis=2, dtype=np.uint8)
+            candidates.append(pack("!B", len(colors)) + b''.join(cpixels) + packed.tobytes())
+
+        if len(colors) < 128:
+            flat_indices = indices.ravel()
+            body = []
+            for (start, length) in zip(starts.tolist(), lengths.tolist()):
+                if length == 1:
+                    body.append(pack("!B", flat_indices[start]))
+                else:
+                    body.append(pack("!B", flat_indices[start] | 0x80) + _rle_length(length))
+            candidates.append(pack("!B", 128 + len(colors)) + b''.join(cpixels) + b''.join(body))
+
+        body = []
+        for (start, length) in zip(starts.tolist(), lengths.tolist()):
+            body.append(_cpixel(_pixel(flat[start], bypp)) + _rle_length(length))
+        candidates.append(pack("!B", 128) + b''.join(body))
+        return min(candidates, key=len)
+
+
+# --- Tight
+
+def _compact_length(length):
+    """1 to 3 bytes, 7, 7 and 8 bits"""
+    data = bytearray([length & 0x7f])
+    if length > 0x7f:
+        data[0] |= 0x80
+        data.append((length >> 7) & 0x7f)
+        if length > 0x3fff:
+            data[1] |= 0x80
+            data.append((length >> 14) & 0xff)
+    return bytes(data)
+
+
+def gradient_errors(rgb, maxes=(255, 255, 255)):
+    """prediction errors of the tight gradient filter, rgb is a HxWx3
+       array of colour components, maxes their max values"""
+    values = rgb.astype(np.int32)
+    left = np.zeros_like(values)
+    left[:, 1:] = values[:, :-1]
+    up = np.zeros_like(values)
+    up[1:] = values[:-1]
+    upleft = np.zeros_like(values)
+    upleft[1:, 1:] = values[:-1, :-1]
+    maxes = np.array(maxes, dtype=np.int32)
+    predicted = np.clip(left + up - upleft, 0, maxes)
+    return (values - predicted) & maxes
+
+
+class TightEncoder(object):
+    """Tight with the four zlib streams of a connection: 0 for copy,
+       1 for palette, 2 for gradient data.
+       Images are split in tiles, each sent as its own rectangle: fill,
+       palette for up to 16 colours, JPEG if a quality is given, else
+       gradient (or copy, gradient=False).
+       img is in the pixel format format, a tuple like PIXEL_FORMATS[bpp]
+       (see to_format()). TPIXELs are R, G, B for 24 bit true colour and
+       the pixels as they are otherwise, as in rfb._tightPixelSize()."""
+
+    def __init__(self, quality=None, gradient=True, tile=128, level=6, format=PIXEL_FORMATS[32]):
+        self.quality = quality
+        self.gradient = gradient
+        self.tile = tile
+        self.pixelFormat = rfb.PixelFormat(*format)
+        pf = self.pixelFormat
+        self._rgb24 = pf.truecolor and pf.bpp == 32 and pf.depth == 24 and (pf.redmax, pf.greenmax, pf.bluemax) == (255, 255, 255)
+        self._zlib = [zlib.compressobj(level) for n in range(4)]
+
+    def rectangles(self, img, x0=0, y0=0):
+        """list of (x, y, width, height, TIGHT_ENCODING, payload)"""
+        height, width = img.shape[:2]
+        rects = []
+        for ty in range(0, height, self.tile):
+            for tx in range(0, width, self.tile):
+                pixels = img[ty:ty + self.tile, tx:tx + self.tile]
+                th, tw = pixels.shape[:2]
+                rects.append((x0 + tx, y0 + ty, tw, th, rfb.TIGHT_ENCODING, self._rect(self._tpixels(pixels))))
+        return rects
+
+    def _data(self, stream, data):
+        if len(data) < 12:
+            return data
+        z = self._zlib[stream]
+        data = z.compress(data) + z.flush(zlib.Z_SYNC_FLUSH)
+        return _compact_length(len(data)) + data
+
+    def _tpixels(self, pixels):
+        """HxWx(TPIXEL size) array of the TPIXELs of pixels"""
+        if not self._rgb24:
+            return np.ascontiguousarray(pixels)
+        pf = self.pixelFormat
+        offsets = [shift // 8 if not pf.bigendian else 3 - shift // 8 for shift in (pf.redshift, pf.greenshift, pf.blueshift)]
+        if offsets == [0, 1, 2]:
+            return np.ascontiguousarray(pixels[..., :3])
+        return pixels[..., offsets]
+
+    def _rgb(self, tpixels):
+        if self._rgb24:
+            return tpixels
+        th, tw = tpixels.shape[:2]
+        return self.pixelFormat.toPixels(tpixels.tobytes(), tw, th)
+
+    def _gradient(self, tpixels):
+        if self._rgb24:
+            return gradient_errors(tpixels).astype(np.uint8).tobytes()
+        #on the colour components of the pixel format
+        pf = self.pixelFormat
+        shifts = (pf.redshift, pf.greenshift, pf.blueshift)
+        maxes = (pf.redmax, pf.greenmax, pf.bluemax)
+        th, tw = tpixels.shape[:2]
+        values = np.frombuffer(tpixels.tobytes(), pf.dtype).reshape(th, tw).astype(np.uint32)
+        components = np.stack([(values >> shift) & m for (shift, m) in zip(shifts, maxes)], axis=-1)
+        errors = gradient_errors(components, maxes).astype(np.uint32)
+        values = (errors[..., 0] << shifts[0]) | (errors[..., 1] << shifts[1]) | (errors[..., 2] << shifts[2])
+        return values.astype(pf.dtype).tobytes()
+
+    def _rect(self, pixels):
+        """payload of one tile of TPIXELs"""
+        th, tw = pixels.shape[:2]
+        flat = pixels.reshape(-1, pixels.shape[2])
+        colors, first, indices = np.unique(_values(flat), return_index=True, return_inverse=True)
+        if len(colors) == 1:
+            return pack("!B", 0x80) + flat[0].tobytes()
+        if len(colors) <= 16:
+            palette = flat[first]
+            indices = indices.reshape(th, tw).astype(np.uint8)
+            if len(colors) == 2:
+                data = np.packbits(indices, axis=1).tobytes()
+            else:
+                data = indices.tobytes()
+            return (pack("!BBB", 0x40 | (1 << 4), 1, len(colors) - 1) +
+                    palette.tobytes() + self._data(1, data))
+        if self.quality is not None:
+            out = io.BytesIO()
+            Image.fromarray(self._rgb(pixels)).save(out, 'JPEG', quality=self.quality)
+            data = out.getvalue()
+            return pack("!B", 0x90) + _compact_length(len(data)) + data
+        if self.gradient:
+            return pack("!BB", 0x40 | (2 << 4), 2) + self._data(2, self._gradient(pixels))
+        return pack("!B", 0) + self._data(0, pixels.tobytes())
+
+
+# --- complete streams
+
+def desktop_size(width, height):
+    """DesktopSize pseudo rectangle"""
+    return (0, 0, width, height, rfb.PSEUDO_DESKTOP_SIZE_ENCODING, b'')
+
+
+def extended_desktop_size(width, height, reason=0, status=0):
+    """ExtendedDesktopSize pseudo rectangle with one screen"""
+    payload = pack("!Bxxx", 1) + pack("!IHHHHI", 0, 0, 0, width, height, 0)
+    return (reason, status, width, height, rfb.PSEUDO_EXTENDED_DESKTOP_SIZE_ENCODING, payload)
+
+
+def cursor(hotx, hoty, img, mask):
+    """Cursor pseudo rectangle, img in the pixel format, mask HxW bool"""
+    height, width = mask.shape
+    return (hotx, hoty, width, height, rfb.PSEUDO_CURSOR_ENCODING,
+            img.tobytes() + np.packbits(mask, axis=1).tobytes())
+
+
+def pointer_pos(x, y):
+    """PointerPos pseudo rectangle"""
+    return (x, y, 0, 0, rfb.PSEUDO_POINTER_POS_ENCODING, b'')
+
+
+def frame(width, height, n, seed=0):
+    """frame n of a desktop with changing video area"""
+    img = desktop(width, height, seed)
+    if n:
+        vh, vw = height // 4, width // 4
+        img[height // 2:height // 2 + vh, width // 2:width // 2 + vw, :3] = \
+            np.random.RandomState(seed + n).randint(0, 256, size=(vh, vw, 3))
+    return img
+
+
+class UpdateEncoder(object):
+    """rectangles of one encoding for a session, keeps the zlib streams
+       the encodings share over the connection.
+       except for tight, encoding is done in two steps: prepare() does the
+       work that does not depend on the zlib streams, its result can be
+       cached and used on other connections, finish() makes the payload.
+       format is the pixel format of the images, see TightEncoder"""
+
+    def __init__(self, encoding, quality=None, format=PIXEL_FORMATS[32]):
+        self.encoding = encoding
+        self._tight = TightEncoder(quality, format=format)
+        self._zrle = ZRLEEncoder()
+        self._zlib = ZlibEncoder()
+        self._zlibhex = ZlibHexEncoder()
+
+    def rectangles(self, img, x=0, y=0):
+        """list of (x, y, width, height, encoding, payload) for img at (x, y)"""
+        if self.encoding == rfb.TIGHT_ENCODING:
+            return self._tight.rectangles(img, x, y)
+        height, width = img.shape[:2]
+        return [(x, y, width, height, self.encoding, self.finish(self.prepare(img)))]
+
+    def prepare(self, img):
+        encoding = self.encoding
+        if encoding == rfb.RAW_ENCODING or encoding == rfb.ZLIB_ENCODING:
+            return encode_raw(img)
+        elif encoding == rfb.HEXTILE_ENCODING:
+            return encode_hextile(img)
+        elif encoding == rfb.ZRLE_ENCODING:
+            return self._zrle.tiles(img)
+        elif encoding == rfb.ZLIBHEX_ENCODING:
+            return hextile_tiles(img)
+        raise ValueError("encoding %d not supported" % encoding)
+
+    def finish(self, prepared):
+        encoding = self.encoding
+        if encoding == rfb.ZRLE_ENCODING:
+            return self._zrle.compress(prepared)
+        elif encoding == rfb.ZLIB_ENCODING:
+            return self._zlib.compress(prepared)
+        elif encoding == rfb.ZLIBHEX_ENCODING:
+            return self._zlibhex.encode_tiles(prepared)
+        return prepared
+
+
+def updates(encoding, width, height, frames, seed=0, quality=None, bpp=32):
+    """frames full screen updates in the given encoding, see frame().
+       quality is the JPEG quality for tight, bpp the bits per pixel,
+       see PIXEL_FORMATS. a list of messages"""
+    encoder = UpdateEncoder(encoding, quality, PIXEL_FORMATS[bpp])
+    return [framebuffer_update(encoder.rectangles(to_format(frame(width, height, n, seed), bpp)))
+            for n in range(frames)]
+
+
+def stream(encoding, width, height, frames, seed=0, quality=None, bpp=32):
+    """handshake plus frames full screen updates, see updates()"""
+    return server_handshake(width, height, bpp=bpp) + b''.join(
+        updates(encoding, width, height, frames, seed, quality, bpp))
+
+
+def document(width, height, seed=0):
+    """a page of text lines, black glyph blocks on white"""
+    rnd = np.random.RandomState(seed)
+    img = np.empty((height, width, 4), dtype=np.uint8)
+    img[:, :] = (255, 255, 255, 255)
+    glyphs = rnd.randint(0, 4, size=(height, width - 16)) == 0
+    glyphs[np.arange(height) % 16 >= 10] = False
+    #ragged line ends
+    ends = rnd.randint(width // 3, width - 16, size=height // 16 + 1)
+    glyphs[np.arange(width - 16)[None, :] >= ends[np.arange(height) // 16][:, None]] = False
+    img[:, 8:-8][glyphs] = (0, 0, 0, 255)
+    return img
+
+
+def scroll_updates(encoding, width, height, frames, step=16, seed=0):
+    """a text page scrolling up by step lines per frame, the way servers
+       send it: CopyRect for what moved and the new lines at the bottom in
+       the given encoding. the first update is the full screen. a list of
+       messages"""
+    page = document(width, height + frames * step, seed)
+    encoder = UpdateEncoder(encoding)
+    messages = [framebuffer_update(encoder.rectangles(page[:height]))]
+    for n in range(1, frames):
+        top = n * step
+        rectangles = [(0, 0, width, height - step, rfb.COPY_RECTANGLE_ENCODING, encode_copyrect(0, step))]
+        rectangles += encoder.rectangles(page[top + height - step:top + height], 0, height - step)
+        messages.append(framebuffer_update(rectangles))
+    return messages
+
+
+def scroll_screen(width, height, frames, step=16, seed=0):
+    """the last screen of scroll_updates(), RGB"""
+    top = (frames - 1) * step
+    return document(width, height + frames * step, seed)[top:top + height, :, :3]
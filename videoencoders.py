@@ -0,0 +1,141 @@
+"""
+Video encoders, the openers of a VideoWorker.
+
+An encoder is called with (filename, size, fps) and returns the writer of
+that file, with write(frame) of a HxWx3 uint8 BGR frame and release().
+The encoders only hold their settings and pickle, a PoolWriter sends
+them to its encoder processes.
+
+    opencv      cv2.VideoWriter with a fourcc, avc1 needs the openh264 DLL on Windows
+    pyav        libavcodec in this process through PyAV (pip install av)
+    ffmpeg      an ffmpeg process, the frames go to it over a pipe as raw BGR
+
+pyav and ffmpeg take the settings of the codec, for libx264:
+
+    preset      ultrafast .. veryslow, slower presets give smaller files for more CPU
+    crf         0..51, constant quality, lower is better and bigger, 23 is x264's default
+    gop         frames from one keyframe to the next, None for the codec's default
+    threads     encoder threads per file, 0 for one per core. with an encoder
+                pool recording many files at once 1 or 2 is enough
+
+The sizes must be even for yuv420p, RemoteCapture pads the frames.
+
+MIT License
+"""
+# flake8: noqa
+
+import subprocess
+from fractions import Fraction
+import numpy as np
+
+
+class OpenCVEncoder(object):
+    """cv2.VideoWriter, the codec picked by fourcc"""
+
+    def __init__(self, fourcc="avc1"):
+        self.fourcc = fourcc
+
+    def __call__(self, filename, size, fps):
+        import cv2
+        writer = cv2.VideoWriter(filename, cv2.VideoWriter_fourcc(*self.fourcc), fps, size)
+        if not writer.isOpened():
+            raise IOError("OpenCV cannot write %s with fourcc %s" % (filename, self.fourcc))
+        return writer
+
+
+def _x264options(preset, crf, gop, threads):
+    # ffmpeg's option names, of the command line and of libavcodec
+    options = {}
+    if preset is not None:
+        options['preset'] = preset
+    if crf is not None:
+        options['crf'] = str(crf)
+    if gop is not None:
+        options['g'] = str(gop)
+    if threads is not None:
+        options['threads'] = str(threads)
+    return options
+
+
+class PyAVEncoder(object):
+    """PyAV, libavcodec and the muxer in this process"""
+
+    def __init__(self, codec="libx264", preset="veryfast", crf=23, gop=None, threads=0):
+        self.codec = codec
+        self.options = _x264options(preset, crf, gop, threads)
+
+    def __call__(self, filename, size, fps):
+        return PyAVWriter(filename, size, fps, self.codec, self.options)
+
+
+class PyAVWriter(object):
+
+    def __init__(self, filename, size, fps, codec, options):
+        import av
+        self._av = av
+        self._container = av.open(filename, 'w')
+        try:
+            self._stream = self._container.add_stream(codec, rate=Fraction(fps).limit_denominator(1001))
+            (self._stream.width, self._stream.height) = size
+            self._stream.pix_fmt = 'yuv420p'
+            self._stream.options = options
+        except Exception:
+            self._container.close()
+            raise
+
+    def write(self, frame):
+        frame = self._av.VideoFrame.from_ndarray(frame, format='bgr24')
+        self._container.mux(self._stream.encode(frame))
+
+    def release(self):
+        try:
+            self._container.mux(self._stream.encode())     # flush the frames the encoder holds back
+        finally:
+            self._container.close()
+
+
+class FFmpegEncoder(object):
+    """an ffmpeg process per file, ffmpeg is the executable"""
+
+    def __init__(self, codec="libx264", preset="veryfast", crf=23, gop=None, threads=0, ffmpeg="ffmpeg"):
+        self.codec = codec
+        self.options = _x264options(preset, crf, gop, threads)
+        self.ffmpeg = ffmpeg
+
+    def __call__(self, filename, size, fps):
+        return FFmpegWriter(filename, size, fps, self.codec, self.options, self.ffmpeg)
+
+
+class FFmpegWriter(object):
+
+    def __init__(self, filename, size, fps, codec, options, ffmpeg):
+        command = [ffmpeg, '-hide_banner', '-nostats', '-loglevel', 'error', '-y',
+                   '-f', 'rawvideo', '-pix_fmt', 'bgr24', '-s', '%dx%d' % size, '-r', str(fps), '-i', '-',
+                   '-c:v', codec, '-pix_fmt', 'yuv420p']
+        for (name, value) in options.items():
+            command += ['-' + name, value]
+        self._process = subprocess.Popen(command + [filename], stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def write(self, frame):
+        try:
+            self._process.stdin.write(np.ascontiguousarray(frame).data)
+        except BrokenPipeError:
+            self.release()      # raises ffmpeg's error
+            raise
+
+    def release(self):
+        if not self._process.stdin.closed:
+            try:
+                self._process.stdin.close()
+            except BrokenPipeError:
+                pass
+        error = self._process.stderr.read()
+        if self._process.wait() != 0:
+            raise IOError("ffmpeg exit code %d: %s" % (self._process.returncode, error.decode('utf-8', 'replace').strip()))
+
+
+ENCODERS = {
+    "opencv": OpenCVEncoder,
+    "pyav": PyAVEncoder,
+    "ffmpeg": FFmpegEncoder,
+}
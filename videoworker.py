@@ -0,0 +1,438 @@
+"""
+Video encoding on a worker thread.
+
+The reactor thread hands frames to a VideoWorker and goes back to the
+socket, the worker thread opens the video files, encodes the frames and
+closes the files in the order they were asked for. Encoders like
+OpenCV's release the GIL while they compress, so the decoding goes on
+meanwhile.
+
+The videos have a constant frame rate on the wall clock, a FrameClock
+tells how many frames are due. When the screen did not change the last
+frame is repeated, repeat() queues no pixels. The length of a video is
+the time it was recorded, however many updates the server sent.
+
+The queue holds at most maxframes frames. When the encoder falls behind
+the policy decides which frame is lost:
+
+    drop-oldest     the oldest queued frame, the video skips ahead
+    drop-newest     the new frame, the video lags but has no jumps
+    block           wait up to timeout seconds for room, then drop the new frame
+
+A dropped frame becomes a repeat of the frame before it, so the timeline
+keeps its length. open(), close() and the repeats are never dropped and
+do not count against maxframes.
+
+Frames come from buffer() and go back to it once they are written (or
+dropped), after a few frames there is no allocation per frame.
+
+Closing a file (release() of its writer, the moov box of an mp4 or the
+wait for the encoder process) runs on a finalizer thread, the next file
+is started meanwhile. With a manifest each finished file adds a line
+file,start,end,frames,bytes to that CSV, start and end on the wall clock
+of the timeline, in the order the files were opened.
+
+With timestamps each file gets a name.csv next to it, with the time of
+every frame on the timeline (its slot), when its screen was taken and
+whether it is a repeat.
+
+With a PoolWriter the encoding itself runs in a process of an
+EncoderPool, so the sessions of one process can use all the cores. The
+worker thread then only sends the frames:
+
+    pool = EncoderPool(os.cpu_count())
+    worker = VideoWorker(functools.partial(PoolWriter, pool, opener))
+
+The frames go to the process in chunks of a few, the writer of a file
+stays in its process between the chunks. Any number of files share the
+processes, each process takes the chunks of its files in turn. Only
+when the processes can't keep up with all of them the frames wait, and
+drop by the policy.
+
+MIT License
+"""
+# flake8: noqa
+
+import os
+import time
+import threading
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import numpy as np
+from timeit import default_timer as timer
+
+POLICIES = ("drop-oldest", "drop-newest", "block")
+
+#the writers of the files open in an encoder process, by PoolWriter
+#serial: [writer, last frame, error]
+_files = {}
+
+
+class FrameClock(object):
+    """the frames of a constant fps timeline starting now, frame n is
+       due n / fps seconds after the start. the ticks asking for them
+       come about then, early or late, so a frame is due from half a
+       frame before its time"""
+
+    def __init__(self, fps):
+        self.fps = fps
+        self.start = timer()
+        self.wallstart = time.time()
+        self.frames = 0     # frames taken with due()
+
+    def due(self, now=None, least=0):
+        """the number of frames due since the last call, at least least.
+           they are taken, the next call counts on from there"""
+        now = timer() if now is None else now
+        count = max(int((now - self.start) * self.fps + 0.5) + 1 - self.frames, least)
+        self.frames += count
+        return count
+
+    def slot(self, frame):
+        """the wall clock time, as time.time(), of frame"""
+        return self.wallstart + frame / self.fps
+
+
+class VideoWorker(object):
+    """a thread writing frames to video files. opener(filename, size, fps)
+       returns the writer of a file, an object with write(frame) and
+       release(), and optionally repeat() to write the last frame again
+       cheaper than write() does. histogram, a metrics.Histogram, gets
+       the seconds of each write"""
+
+    def __init__(self, opener, maxframes=30, policy="drop-oldest", timeout=1.0, histogram=None, timestamps=False):
+        if policy not in POLICIES:
+            raise ValueError("unknown overflow policy %r, one of %s" % (policy, ", ".join(POLICIES)))
+        self.opener = opener
+        self.maxframes = maxframes
+        self.policy = policy
+        self.timeout = timeout
+        self.histogram = histogram
+        self.timestamps = timestamps
+        self.queued = 0         # frames accepted into the queue
+        self.dropped = 0        # frames lost to the overflow policy, repeated instead
+        self.encoded = 0        # frames written by the writer
+        self.repeated = 0       # repeats written by the writer
+        self.errors = 0         # writers that could not be opened or failed
+        self.allocated = 0      # frame buffers allocated by buffer()
+        self.finalizing = 0     # files closing on the finalizer
+        self.lasterror = None
+        self._items = deque()   # ('open', filename, size, fps, manifest), ('frame', frame, slot, taken), ('repeat', slot), ('close',), ('stop',)
+        self._frames = 0        # frames in _items
+        self._writer = None
+        self._file = None       # (filename, fps, manifest) of the writer
+        self._first = None      # slot of the first frame in the file
+        self._last = None       # (frame, taken) last written to the file
+        self._csv = None
+        self._index = 0         # frames in the file
+        self._free = []         # frame buffers to reuse
+        self._lock = threading.Condition()
+        self._finalizer = ThreadPoolExecutor(1)     # one at a time, the manifest stays in order
+        self._thread = threading.Thread(target=self._run, name="video encoder")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def pending(self):
+        """frames in the queue"""
+        return self._frames
+
+    def open(self, filename, size, fps, manifest=None):
+        """start a new file, after the frames queued so far. manifest is
+           the CSV to list it in once it is finished"""
+        self._put(('open', filename, size, fps, manifest))
+
+    def close(self):
+        """finish the file, after the frames queued so far"""
+        self._put(('close',))
+
+    def buffer(self, shape):
+        """an uint8 array for a frame to write(), one the worker is done
+           with if there is one. new ones are zeros"""
+        with self._lock:
+            while self._free:
+                frame = self._free.pop()
+                if frame.shape == shape:
+                    return frame
+                #from before a resize, let it go
+        self.allocated += 1
+        return np.zeros(shape, dtype=np.uint8)
+
+    def write(self, frame, slot=None):
+        """queue a frame, the worker owns it from now on, don't change it.
+           slot is its time on the timeline (FrameClock.slot()), now if
+           None. returns False when the frame was dropped"""
+        taken = time.time()
+        slot = taken if slot is None else slot
+        with self._lock:
+            if self._frames >= self.maxframes:
+                if self.policy == "drop-newest":
+                    return self._drop(frame, slot)
+                if self.policy == "drop-oldest":
+                    self._dropOldest()
+                else:
+                    deadline = timer() + self.timeout
+                    while self._frames >= self.maxframes:
+                        wait = deadline - timer()
+                        if wait <= 0:
+                            return self._drop(frame, slot)
+                        self._lock.wait(wait)
+            self._items.append(('frame', frame, slot, taken))
+            self._frames += 1
+            self.queued += 1
+            self._lock.notify_all()
+        return True
+
+    def repeat(self, slot=None):
+        """queue a repeat of the last frame"""
+        self._put(('repeat', time.time() if slot is None else slot))
+
+    def stop(self, timeout=None):
+        """encode what is queued, close the file and end the thread. the
+           files still closing are waited for"""
+        self._put(('stop',))
+        self._thread.join(timeout)
+        self._finalizer.shutdown(wait=True)
+
+    def _put(self, item):
+        with self._lock:
+            self._items.append(item)
+            self._lock.notify_all()
+
+    def _drop(self, frame, slot):
+        self.dropped += 1
+        self._free.append(frame)
+        self._items.append(('repeat', slot))
+        self._lock.notify_all()
+        return False
+
+    def _dropOldest(self):
+        for (n, item) in enumerate(self._items):
+            if item[0] == 'frame':
+                self._items[n] = ('repeat', item[2])
+                self._free.append(item[1])
+                self._frames -= 1
+                self.dropped += 1
+                return
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while not self._items:
+                    self._lock.wait()
+                item = self._items.popleft()
+                if item[0] == 'frame':
+                    self._frames -= 1
+                    self._lock.notify_all()     # room for a blocked write()
+            if item[0] == 'frame':
+                self._write(item[1], item[2], item[3])
+            elif item[0] == 'repeat':
+                self._repeat(item[1])
+            elif item[0] == 'open':
+                self._release()
+                try:
+                    self._writer = self.opener(*item[1:4])
+                    self._file = (item[1], item[3], item[4])
+                    if self.timestamps:
+                        self._csv = open(os.path.splitext(item[1])[0] + '.csv', 'w')
+                        self._csv.write("frame,slot,taken,repeat\n")
+                except Exception as e:
+                    self._failed(e)
+            else:
+                self._release()
+                if item[0] == 'stop':
+                    return
+
+    def _write(self, frame, slot, taken):
+        if self._writer is None:
+            self._recycle(frame)    # no file open, the frame has nowhere to go
+            return
+        start = timer()
+        try:
+            self._writer.write(frame)
+        except Exception as e:
+            self._failed(e)
+            self._recycle(frame)
+            return
+        if self.histogram is not None:
+            self.histogram.observe(timer() - start)
+        self.encoded += 1
+        if self._last is not None:
+            self._recycle(self._last[0])
+        self._last = (frame, taken)
+        self._stamp(slot, 0)
+
+    def _repeat(self, slot):
+        if self._writer is None or self._last is None:
+            return      # nothing to repeat in this file yet
+        try:
+            if hasattr(self._writer, 'repeat'):
+                self._writer.repeat()
+            else:
+                self._writer.write(self._last[0])
+        except Exception as e:
+            self._failed(e)
+            return
+        self.repeated += 1
+        self._stamp(slot, 1)
+
+    def _stamp(self, slot, repeat):
+        if self._first is None:
+            self._first = slot
+        if self._csv is not None:
+            self._csv.write("%d,%.3f,%.3f,%d\n" % (self._index, slot, self._last[1], repeat))
+        self._index += 1
+
+    def _release(self):
+        if self._writer is not None:
+            with self._lock:
+                self.finalizing += 1
+            (filename, fps, manifest) = self._file
+            end = None if self._first is None else self._first + self._index / fps
+            self._finalizer.submit(self._finish, self._writer, filename, manifest, self._first, end, self._index)
+            self._writer = None
+        if self._csv is not None:
+            self._csv.close()
+            self._csv = None
+        if self._last is not None:
+            self._recycle(self._last[0])
+        self._last = None
+        self._first = None
+        self._index = 0
+
+    def _finish(self, writer, filename, manifest, start, end, frames):
+        # on the finalizer thread
+        try:
+            writer.release()
+            if manifest is not None and frames:
+                new = not os.path.exists(manifest)
+                with open(manifest, 'a') as f:
+                    if new:
+                        f.write("file,start,end,frames,bytes\n")
+                    f.write("%s,%.3f,%.3f,%d,%d\n" % (os.path.basename(filename), start, end, frames, os.path.getsize(filename)))
+        except Exception as e:
+            self._failed(e)
+        finally:
+            with self._lock:
+                self.finalizing -= 1
+
+    def _recycle(self, frame):
+        with self._lock:
+            self._free.append(frame)
+
+    def _failed(self, error):
+        self.errors += 1
+        self.lasterror = "%s: %s" % (type(error).__name__, error)
+        print("Video encoder error %s" % self.lasterror)
+
+
+def encodeChunk(opener, serial, filename, size, fps, frames, final):
+    """runs in an encoder process, writes frames (bytes, or None to write
+       the last frame again) to the file. the first chunk of a file opens
+       it with opener(filename, size, fps), the final one releases it.
+       returns the number of frames. after an error the next chunks of
+       the file raise it too, the final one still releases it"""
+    (width, height) = size
+    if serial not in _files:
+        _files[serial] = [None, None, None]
+        try:
+            _files[serial][0] = opener(filename, size, fps)
+        except Exception as e:
+            _files[serial][2] = e
+    state = _files[serial]
+    count = 0
+    try:
+        if state[2] is None:
+            for data in frames:
+                if data is not None:
+                    state[1] = np.frombuffer(data, np.uint8).reshape(height, width, -1)
+                state[0].write(state[1])
+                count += 1
+    except Exception as e:
+        state[2] = e
+    finally:
+        if final:
+            del _files[serial]
+            if state[0] is not None:
+                state[0].release()
+    if state[2] is not None:
+        raise state[2]
+    return count
+
+
+class EncoderPool(object):
+    """processes encoding the files of PoolWriters. the writer of a file
+       lives in one process, so each process is a ProcessPoolExecutor of
+       its own, taking the chunks of its files in order. a new file goes
+       to the process with the fewest open files"""
+
+    def __init__(self, processes):
+        self.processes = [ProcessPoolExecutor(1) for n in range(processes)]
+        self.files = [0] * processes    # open files per process
+        self._lock = threading.Lock()
+
+    def assign(self):
+        """the process for a new file"""
+        with self._lock:
+            n = self.files.index(min(self.files))
+            self.files[n] += 1
+            return n
+
+    def done(self, n):
+        """a file of process n is closed"""
+        with self._lock:
+            self.files[n] -= 1
+
+    def submit(self, n, function, *args):
+        return self.processes[n].submit(function, *args)
+
+    def shutdown(self):
+        for process in self.processes:
+            process.shutdown()
+
+
+_serials = itertools.count()
+
+
+class PoolWriter(object):
+    """a writer for VideoWorker, encoding with opener in a process of
+       pool, an EncoderPool. the opener must be picklable, a module level
+       function or object. frames are sent chunk frames at a time, at
+       most inflight chunks of a file are on their way, write() waits for
+       the process beyond"""
+
+    def __init__(self, pool, opener, filename, size, fps, chunk=5, inflight=2):
+        self._pool = pool
+        self._process = pool.assign()
+        self._file = (opener, next(_serials), filename, size, fps)
+        self._chunk = chunk
+        self._inflight = inflight
+        self._frames = []       # bytes of a frame, None for a repeat
+        self._futures = deque()
+
+    def write(self, frame):
+        self._frames.append(np.ascontiguousarray(frame).tobytes())     # a copy, the frame is reused
+        if len(self._frames) >= self._chunk:
+            self._send()
+
+    def repeat(self):
+        """the last frame again, without sending it again"""
+        self._frames.append(None)
+        if len(self._frames) >= self._chunk:
+            self._send()
+
+    def _send(self):
+        while self._futures and (len(self._futures) >= self._inflight or self._futures[0].done()):
+            self._futures.popleft().result()    # an error of the encoder process is raised here
+        (frames, self._frames) = (self._frames, [])
+        self._futures.append(self._pool.submit(self._process, encodeChunk, *self._file, frames, False))
+
+    def release(self):
+        try:
+            # the chunks before are done first, an error of one is raised by the final one too
+            final = self._pool.submit(self._process, encodeChunk, *self._file, self._frames, True)
+            self._futures.clear()
+            self._frames = []
+            final.result()
+        finally:
+            self._pool.done(self._process)